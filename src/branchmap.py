@@ -15,124 +15,234 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+
+from dataclasses import dataclass, field
 from pathlib import PurePosixPath
-from typing import Optional
+from typing import Optional, final
 
 from git import Branch
 from p4.filelog import ChangeList
 
 
+@final
+@dataclass(frozen=True)
+class Rule:
+    # Relative to //depot/. A path ending with a slash matches everything
+    # below that directory; otherwise the rule is for that one file.
+    path: str
+    # None means the path is not converted.
+    branch: Optional[Branch]
+    # Changes to the path, in these changelists, are not converted.
+    excluded_changelists: frozenset[ChangeList] = frozenset()
+    # The directory, relative to //depot/, which becomes the top of the
+    # branch. Only needed when that is not the path itself.
+    branch_root: Optional[str] = None
+
+    def get_branch_root(self) -> str:
+        return self.path if self.branch_root is None else self.branch_root
+
+
+def _changelists(*changelists: int) -> frozenset[ChangeList]:
+    return frozenset(ChangeList(changelist) for changelist in changelists)
+
+
+_ZDOS_EXCLUDED_CHANGELISTS = _changelists(
+    # Added files from ow_devel/ to ow_devel/zdos, so these disappear
+    # because we merge those into the one dir/branch.
+    31810,
+    31812,
+    # The files were then deleted in the original dir; we deleted that
+    # commit because, again, we merged the dirs.
+    31816,
+)
+
+
+def _zdos_rule(path: str) -> Rule:
+    # Before ow_devel/zdos/ was created, ZDOS lived in these paths in
+    # ow_devel/. We merge the two into the one branch.
+    return Rule(path, Branch("ZDOS"), _ZDOS_EXCLUDED_CHANGELISTS, "ow_devel/")
+
+
+# The most specific rule for a path wins, so the order here does not
+# matter.
+#
+# Note: No RDOS-b2, because sort of same root as RDOS. And the root
+# doesn't exist for RDOS-br1.
+#
+# Note: We don't make a F77_DLL branch because the folder
+# openwatcom/bld/f77_dll was never used.
+RULES: list[Rule] = [
+    Rule("openwatcom/", Branch("openwatcom")),
+    Rule("ow_devel/CVDebug_dev5/", Branch("CVDebug_dev")),
+    Rule("ow_devel/fortran.F03.dev/", Branch("F2003_Development")),
+    Rule("ow_devel/fortran.F95.dev/", Branch("F95_Development")),
+    Rule("ow_devel/rdos/", Branch("RDOS")),
+    Rule("V2/", Branch("V2")),
+    # Accidental move of wasm and wmake.dev (in addition to zdos), then
+    # reverted.
+    Rule("ow_devel/bld/wasm/", Branch("WASM"), _changelists(31816, 31829)),
+    # An experiment in branching, plus accidental commit. The proper
+    # branch was soon created as ow_devel/zdos.
+    Rule("ow_devel/zdos19/", None),
+    Rule("ow_devel/zdos/", Branch("ZDOS"), _ZDOS_EXCLUDED_CHANGELISTS),
+    _zdos_rule("ow_devel/bld/build/"),
+    _zdos_rule("ow_devel/bld/clib/"),
+    _zdos_rule("ow_devel/bld/hdr/"),
+    _zdos_rule("ow_devel/binnt/"),
+    _zdos_rule("ow_devel/binw/"),
+    _zdos_rule("ow_devel/binz/wlink.lnk"),
+    _zdos_rule("ow_devel/docs/"),
+    # In addition to legit changes, wasm and wmake.dev were accidentally
+    # removed in 31813. And this accidental change was undone in 31829.
+    Rule(
+        "ow_devel/zdos/bld/wasm/",
+        Branch("ZDOS"),
+        _ZDOS_EXCLUDED_CHANGELISTS | _changelists(31813, 31829),
+        "ow_devel/zdos/",
+    ),
+    Rule(
+        "ow_devel/zdos/bld/wmake.dev/",
+        Branch("ZDOS"),
+        _ZDOS_EXCLUDED_CHANGELISTS | _changelists(31813, 31829),
+        "ow_devel/zdos/",
+    ),
+    # Mistakenly created when moving zdos branch from ow_devel/binz/
+    # (etc) to ow_devel/zdos/binz/.
+    Rule("ow_devel/binz/zdos/wlink.lnk", None),
+    # Typoed path (missing slash in bld/hdr) which was immediately
+    # deleted.
+    Rule("ow_devel/bldhdr/watcom/zapi.mh", None),
+    Rule("ow_devel/dwarf3/", Branch("dwarf3")),
+    Rule("ow_devel/long_double/", Branch("long_double")),
+    Rule("ow_release/1.0/", Branch("openwatcom_1.0")),
+    Rule("ow_devel/intel_owl/", Branch("openwatcom_bld_devel")),
+    Rule("ow_devel/plusplus.dev/", Branch("plusplus.dev")),
+    Rule("ow_devel/plusplus.ext/", Branch("plusplus.ext")),
+    # Accidental move of wasm and wmake.dev (in addition to zdos), then
+    # reverted.
+    Rule("ow_devel/bld/wmake.dev/", Branch("wmake.dev"), _changelists(31816, 31829)),
+    # No p4 branchspec exists, but the folder's there. 32369 was an
+    # accidental branch to ow_devel/bld/ which was shortly deleted, in
+    # 32374. 31811 and 31816 belong in zdos as opposed to wlink.
+    Rule(
+        "ow_devel/bld/wl/",
+        Branch("wlink"),
+        _changelists(31811, 31816, 32369, 32374),
+    ),
+    # Part of the commit 32369 (which is mentioned above). In contrast
+    # to ow_devel/bld/wl, these folders here NEVER had anything
+    # interesting.
+    Rule("ow_devel/bld/cvpack/", None),
+    Rule("ow_devel/bld/watcom/", None),
+    # No branchspec either, but an interesting historical curiosity.
+    Rule("ow_devel/fortran.dev/", Branch("fortran.dev")),
+    # These files were added and deleted in separate commits to the rest
+    # of fortran.dev, and this was done just to understand p4 branching.
+    Rule("ow_devel/fortran.dev/bld/F03/c/", None),
+    # A file copied into the wrong location; it was deleted, and copied
+    # (from the original source) into the correct location.
+    Rule("ow_release/bld/wipfc/cpp/fts.cpp", None),
+    # 4OS2 command shell
+    Rule("public/4os2/", None),
+    # Tool by Neil Russell to give p4 a CVS feel
+    Rule("public/c4/", None),
+    # OpenGL man page conversion tool
+    Rule("public/convman/", None),
+    # dmake, a make implementation
+    Rule("public/dmake/", None),
+    # NASM assembler
+    Rule("public/nasm/", None),
+    # A helpdesk/knowledge base app
+    Rule("public/ozh/", None),
+    # Project files for Open Watcom libc, for Visual Slick Edit. But
+    # never part of an Open Watcom release.
+    Rule("public/wcclibc/", None),
+    # A non-trivial Linux hello world app for Open Watcom. However, it
+    # was never distributed as part of the tarballs.
+    Rule("public/wcclinux/", None),
+    # Word Perfect VESA driver
+    Rule("public/wp51vesa/", None),
+    # Robots.txt for the depot.
+    Rule("robots.txt", None),
+]
+
+
+# A trie of path components. Looking up a path then costs time
+# proportional to its depth, rather than to the number of rules.
+@final
+@dataclass
+class _Node:
+    children: dict[str, "_Node"] = field(default_factory=dict)
+    # The rule for everything below this directory.
+    dir_rule: Optional[Rule] = None
+    # The rule for this exact file.
+    file_rule: Optional[Rule] = None
+
+
+def compile_rules(rules: list[Rule]) -> _Node:
+    root = _Node()
+    for rule in rules:
+        components = rule.path.removesuffix("/").split("/")
+        node = root
+        for component in components:
+            node = node.children.setdefault(component, _Node())
+        if rule.path.endswith("/"):
+            if node.dir_rule is not None:
+                raise ValueError(f"duplicate rule for {rule.path}")
+            node.dir_rule = rule
+        else:
+            if node.file_rule is not None:
+                raise ValueError(f"duplicate rule for {rule.path}")
+            node.file_rule = rule
+    return root
+
+
+def find_rule(trie: _Node, rel_path: str) -> Optional[Rule]:
+    components = rel_path.split("/")
+    rule = None
+    node = trie
+    for component in components[:-1]:
+        child = node.children.get(component)
+        if child is None:
+            return rule
+        node = child
+        if node.dir_rule is not None:
+            rule = node.dir_rule
+    child = node.children.get(components[-1])
+    if child is not None and child.file_rule is not None:
+        return child.file_rule
+    return rule
+
+
+_TRIE = compile_rules(RULES)
+
+
 def get_branch_for_path(
     path: PurePosixPath, changelist: ChangeList
 ) -> Optional[Branch]:
     assert str(path).startswith("//depot/")
     rel_path = str(path).removeprefix("//depot/")
-    if rel_path.startswith("openwatcom/"):
-        return Branch("openwatcom")
-    if rel_path.startswith("ow_devel/CVDebug_dev5/"):
-        return Branch("CVDebug_dev")
-    if rel_path.startswith("ow_devel/fortran.F03.dev/"):
-        return Branch("F2003_Development")
-    if rel_path.startswith("ow_devel/fortran.F95.dev/"):
-        return Branch("F95_Development")
-    if rel_path.startswith("ow_devel/rdos/"):
-        return Branch("RDOS")
-    if rel_path.startswith("V2/"):
-        return Branch("V2")
-    if rel_path.startswith("ow_devel/bld/wasm/"):
-        if changelist in {ChangeList(31816), ChangeList(31829)}:
-            return None
-        return Branch("WASM")
-    if rel_path.startswith("ow_devel/zdos19/"):
-        return None
-    if (
-        rel_path.startswith("ow_devel/zdos/")
-        or rel_path.startswith("ow_devel/bld/build/")
-        or rel_path.startswith("ow_devel/bld/clib/")
-        or rel_path.startswith("ow_devel/bld/hdr/")
-        or rel_path.startswith("ow_devel/binnt/")
-        or rel_path.startswith("ow_devel/binw/")
-        or rel_path == "ow_devel/binz/wlink.lnk"
-        or rel_path.startswith("ow_devel/docs/")
-    ):
-        if changelist in {
-            # Added files from ow_devel/ to ow_devel/zdos, so these
-            # disappear because we merge those into the one dir/branch.
-            ChangeList(31810),
-            ChangeList(31812),
-            # The files were then deleted in the original dir; we
-            # deleted that commit because, again, we merged the dirs.
-            ChangeList(31816),
-        }:
-            return None
-        if changelist in {
-            # In addition to legit changes, wasm and wmake.dev were
-            # accidentally removed
-            ChangeList(31813),
-            ChangeList(31829),  # And this accidental change was undone.
-        }:
-            if rel_path.startswith("ow_devel/zdos/bld/wasm/") or rel_path.startswith(
-                "ow_devel/zdos/bld/wmake.dev/"
-            ):
-                return None
-        return Branch("ZDOS")
-    if rel_path == "ow_devel/binz/zdos/wlink.lnk":
-        return None
-    if rel_path == "ow_devel/bldhdr/watcom/zapi.mh":
-        return None
-    if rel_path.startswith("ow_devel/dwarf3/"):
-        return Branch("dwarf3")
-    if rel_path.startswith("ow_devel/long_double/"):
-        return Branch("long_double")
-    if rel_path.startswith("ow_release/1.0/"):
-        return Branch("openwatcom_1.0")
-    if rel_path.startswith("ow_devel/intel_owl/"):
-        return Branch("openwatcom_bld_devel")
-    if rel_path.startswith("ow_devel/plusplus.dev/"):
-        return Branch("plusplus.dev")
-    if rel_path.startswith("ow_devel/plusplus.ext/"):
-        return Branch("plusplus.ext")
-    if rel_path.startswith("ow_devel/bld/wmake.dev/"):
-        if changelist in {ChangeList(31816), ChangeList(31829)}:
-            return None
-        return Branch("wmake.dev")
-    if rel_path.startswith("ow_devel/bld/wl/"):
-        if changelist in {
-            ChangeList(31811),
-            ChangeList(31816),
-            ChangeList(32369),
-            ChangeList(32374),
-        }:
-            return None
-        return Branch("wlink")
-    if rel_path.startswith("ow_devel/bld/cvpack/") or rel_path.startswith(
-        "ow_devel/bld/watcom/"
-    ):
-        return None
-    if rel_path.startswith("ow_devel/fortran.dev/"):
-        if rel_path.startswith("ow_devel/fortran.dev/bld/F03/c/"):
-            return None
-        return Branch("fortran.dev")
-    if rel_path == "ow_release/bld/wipfc/cpp/fts.cpp":
-        return None
-    if rel_path.startswith("public/4os2/"):
+    rule = find_rule(_TRIE, rel_path)
+    if rule is None:
+        raise ValueError(path, changelist)
+    if changelist in rule.excluded_changelists:
         return None
-    if rel_path.startswith("public/c4/"):
-        return None
-    if rel_path.startswith("public/convman/"):
-        return None
-    if rel_path.startswith("public/dmake/"):
-        return None
-    if rel_path.startswith("public/nasm/"):
-        return None
-    if rel_path.startswith("public/ozh/"):
-        return None
-    if rel_path.startswith("public/wcclibc/"):
-        return None
-    if rel_path.startswith("public/wcclinux/"):
-        return None
-    if rel_path.startswith("public/wp51vesa/"):
+    return rule.branch
+
+
+def split_path(
+    rel_path: str, changelist: Optional[ChangeList]
+) -> Optional[tuple[Branch, str]]:
+    # For splitting the depot into branches: which branch a path,
+    # relative to //depot/, belongs to, and where it goes in that
+    # branch. Unlike get_branch_for_path, paths which no rule mentions
+    # are quietly left out.
+    rule = find_rule(_TRIE, rel_path)
+    if rule is None or rule.branch is None:
         return None
-    if rel_path == "robots.txt":
+    if changelist in rule.excluded_changelists:
         return None
-    raise ValueError(path, changelist)
+    branch_root = rule.get_branch_root()
+    if not rel_path.startswith(branch_root):
+        raise ValueError(f"{rel_path} is not below {branch_root}")
+    return rule.branch, rel_path.removeprefix(branch_root)
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# The graph of commits from which make_merges works out each commit's
+# parents. This used to be a networkx DiGraph, which holds a dict of
+# dicts per commit, and which make_merges then copied in full to reverse
+# the edges. All we ever ask of the graph is each commit's parents, in
+# an order where every commit comes after its parents. So instead the
+# commits are numbered in the order they are added, and the edges are
+# kept in arrays of these numbers.
+
+from array import array
+from typing import Optional, final
+
+from commit_index import Commit
+
+
+@final
+class CommitGraph:
+    def __init__(self) -> None:
+        self.commits: list[Commit] = []
+        self.ids: dict[Commit, int] = {}
+        # Each edge, from parent to child.
+        self._edge_parents = array("l")
+        self._edge_children = array("l")
+        # The parents of commit i are
+        # _parents[_parent_offsets[i] : _parent_offsets[i + 1]], in the
+        # order in which the commits were added. Worked out from the
+        # edges when first needed. array[int] is quoted, here and below,
+        # as array is only subscriptable from Python 3.12.
+        self._parent_offsets: Optional["array[int]"] = None
+        self._parents = array("l")
+
+    def add_commit(self, commit: Commit) -> None:
+        if commit not in self.ids:
+            self.ids[commit] = len(self.commits)
+            self.commits.append(commit)
+            self._parent_offsets = None
+
+    def add_edge(self, parent: Commit, child: Commit) -> None:
+        self.add_commit(parent)
+        self.add_commit(child)
+        self._edge_parents.append(self.ids[parent])
+        self._edge_children.append(self.ids[child])
+        self._parent_offsets = None
+
+    def _group_parents(self) -> "array[int]":
+        # A counting sort of the edges by child, so that the parents
+        # come straight from the edges, without a reversed copy of the
+        # graph.
+        if self._parent_offsets is not None:
+            return self._parent_offsets
+        num_commits = len(self.commits)
+        counts = array("l", [0]) * (num_commits + 1)
+        for child in self._edge_children:
+            counts[child + 1] += 1
+        for i in range(num_commits):
+            counts[i + 1] += counts[i]
+        unsorted = array("l", [0]) * len(self._edge_parents)
+        next_slot = counts[:-1]
+        for parent, child in zip(self._edge_parents, self._edge_children):
+            unsorted[next_slot[child]] = parent
+            next_slot[child] += 1
+        # Then each commit's parents are sorted, without duplicates, as
+        # networkx gave them: the order of the parents was the order in
+        # which their commits were added.
+        offsets = array("l", [0])
+        parents = array("l")
+        for i in range(num_commits):
+            commit_parents = unsorted[counts[i] : counts[i + 1]]
+            if len(commit_parents) > 1:
+                commit_parents = array("l", sorted(set(commit_parents)))
+            parents.extend(commit_parents)
+            offsets.append(len(parents))
+        self._parent_offsets = offsets
+        self._parents = parents
+        return offsets
+
+    def get_parents(self, commit_id: int) -> "array[int]":
+        offsets = self._group_parents()
+        return self._parents[offsets[commit_id] : offsets[commit_id + 1]]
+
+    def topological_order(self) -> "array[int]":
+        # Every commit after its parents, raising an exception if there
+        # is a cycle. One depth first search over the parents does both:
+        # a commit is finished once all of its parents are, and meeting
+        # a commit we are still in the middle of means a cycle.
+        offsets = self._group_parents()
+        parents = self._parents
+        unvisited, in_progress, finished = 0, 1, 2
+        state = bytearray(len(self.commits))
+        order = array("l")
+        stack_commits: list[int] = []
+        stack_next: list[int] = []
+        for root in range(len(self.commits)):
+            if state[root] != unvisited:
+                continue
+            state[root] = in_progress
+            stack_commits.append(root)
+            stack_next.append(offsets[root])
+            while stack_commits:
+                commit_id = stack_commits[-1]
+                i = stack_next[-1]
+                if i == offsets[commit_id + 1]:
+                    stack_commits.pop()
+                    stack_next.pop()
+                    state[commit_id] = finished
+                    order.append(commit_id)
+                    continue
+                stack_next[-1] = i + 1
+                parent = parents[i]
+                if state[parent] == unvisited:
+                    state[parent] = in_progress
+                    stack_commits.append(parent)
+                    stack_next.append(offsets[parent])
+                elif state[parent] == in_progress:
+                    raise Exception(
+                        f"the commit graph has a cycle, through {self.commits[parent]}"
+                    )
+        return order
@@ -0,0 +1,319 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Which git commit is which p4 changelist, on which branch. Both
+# make_merges and make_tags need this, so we work it out with one git
+# log over every branch, and save it in the git directory for next
+# time.
+#
+# Next time may be an incremental conversion, after rewrite_history.py
+# has made the merges permanent, so that the branches now share history.
+# The saved index is then extended by the commits since, which do not
+# yet have any merges. rewrite_history.py keeps the saved index up to
+# date with the commits it rewrites.
+
+import argparse
+import functools
+import os
+import re
+import sys
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import NewType, Optional
+
+from git import Branch, git, git_lines
+from p4.filelog import ChangeList
+
+GitHash = NewType("GitHash", str)
+
+
+@dataclass(frozen=True)
+class Commit:
+    changelist: ChangeList
+    branch: Branch
+    hash: GitHash
+
+    def __str__(self):
+        return f"{self.changelist} {self.branch}"
+
+
+# Each branch, oldest commit first.
+CommitIndex = dict[Branch, list[Commit]]
+
+# Bump this whenever the saved format changes.
+_INDEX_FORMAT = 1
+
+_NULL_HASH = GitHash("0" * 40)
+
+_EXCLUDED_BRANCHES = {Branch("__p4_export__everything_no_branches")}
+
+
+def _get_branch_tips() -> dict[Branch, GitHash]:
+    tips = {}
+    for line in git(
+        ["for-each-ref", "--format=%(objectname) %(refname)", "refs/heads/"]
+    ).splitlines():
+        hash, ref = line.split(" ", 1)
+        branch = Branch(ref.removeprefix("refs/heads/"))
+        if branch not in _EXCLUDED_BRANCHES:
+            tips[branch] = GitHash(hash)
+    return tips
+
+
+# The changelist is in a line of the commit message's body: not the
+# subject, which is from the description, and could say anything.
+# History is split into branches before rewrite_history.py tidies the
+# messages, so we also recognise the line as p4-fusion wrote it.
+_CHANGELIST_LINE_RE = re.compile(
+    r'P4:([0-9]+)|\[p4-fusion: depot-paths = "[^"]*": change = ([0-9]+)\]'
+)
+
+
+def get_changelist(message_line: str) -> Optional[ChangeList]:
+    match = _CHANGELIST_LINE_RE.fullmatch(message_line)
+    if match is None:
+        return None
+    return ChangeList(int(match.group(1) or match.group(2)))
+
+
+def _build_commit_index(
+    tips: dict[Branch, GitHash], saved_tips: Optional[dict[Branch, GitHash]] = None
+) -> Optional[CommitIndex]:
+    # The commits since saved_tips, if any. git log only shows each
+    # commit once, along with the branch by which it was first reached.
+    # That's fine because, after splitting, the branches do not share
+    # any history. We check that assumption as we go: each commit's
+    # parents must be on the same branch, or else be the saved tip of
+    # that branch. Returns None if the branches did not simply move on
+    # from the saved tips.
+    #
+    # Replacements are ignored so that the index is still valid after
+    # make_merges has grafted the branches together.
+    if saved_tips is None:
+        saved_tips = {}
+    commit_to_branch: dict[GitHash, Branch] = {
+        hash: branch for branch, hash in saved_tips.items()
+    }
+    parents: list[tuple[GitHash, list[GitHash]]] = []
+    index: CommitIndex = {branch: [] for branch in tips}
+    hash = GitHash("")
+    branch = Branch("")
+    changelist: Optional[ChangeList] = None
+
+    def add_commit() -> None:
+        if changelist is None:
+            raise Exception(
+                f"unknown p4 changeset for git hash {hash} in branch {branch}"
+            )
+        index[branch].append(Commit(changelist, branch, hash))
+
+    lines = git_lines(
+        ["--no-replace-objects", "log", "--source", "--format=%x00%H %S%n%P%n%b"]
+        + [f"refs/heads/{branch}" for branch in tips]
+        + [f"^{hash}" for hash in saved_tips.values()]
+        + ["--"],
+        # Messages are not all UTF-8 until rewrite_history.py has run.
+        errors="replace",
+    )
+    for line in lines:
+        if line.startswith("\0"):
+            if hash:
+                add_commit()
+            commit_hash, ref = line[len("\0") :].split(" ", 1)
+            hash = GitHash(commit_hash)
+            branch = Branch(ref.removeprefix("refs/heads/"))
+            commit_to_branch[hash] = branch
+            parents.append((hash, [GitHash(parent) for parent in next(lines).split()]))
+            changelist = None
+        elif changelist is None:
+            changelist = get_changelist(line)
+    if hash:
+        add_commit()
+    for hash, commit_parents in parents:
+        if not commit_parents and commit_to_branch[hash] in saved_tips:
+            # The branch was started afresh.
+            return None
+        for parent in commit_parents:
+            if parent not in commit_to_branch:
+                # The branch was rewritten, since the saved tips.
+                return None
+            if commit_to_branch[parent] != commit_to_branch[hash]:
+                raise Exception(
+                    f"commit {hash} in branch {commit_to_branch[hash]} has parent"
+                    f" {parent} in branch {commit_to_branch[parent]}"
+                )
+    for branch, commits in index.items():
+        if not commits and tips[branch] != saved_tips.get(branch, tips[branch]):
+            # The branch went back, or elsewhere.
+            return None
+    # git log shows the newest commits first.
+    for commits in index.values():
+        commits.reverse()
+    return index
+
+
+def _get_index_filename() -> str:
+    git_dir = git(["rev-parse", "--absolute-git-dir"]).strip()
+    return os.path.join(git_dir, "mergetastic", "commit-index")
+
+
+def _read_commit_index(
+    filename: str,
+) -> Optional[tuple[dict[Branch, GitHash], CommitIndex]]:
+    # The branch tips for which the index was saved, and the index.
+    try:
+        with open(filename, "rt", encoding="utf-8") as f:
+            if next(f, None) != f"format {_INDEX_FORMAT}\n":
+                return None
+            saved_tips = {}
+            index: CommitIndex = {}
+            for line in f:
+                match line.split():
+                    case ["tip", branch, hash]:
+                        saved_tips[Branch(branch)] = GitHash(hash)
+                        index[Branch(branch)] = []
+                    case [hash, changelist, branch]:
+                        commit = Commit(
+                            ChangeList(int(changelist)), Branch(branch), GitHash(hash)
+                        )
+                        index[commit.branch].append(commit)
+                    case _:
+                        return None
+    except FileNotFoundError:
+        return None
+    return saved_tips, index
+
+
+def _write_commit_index(
+    filename: str, tips: dict[Branch, GitHash], index: CommitIndex
+) -> None:
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "wt", encoding="utf-8") as f:
+        f.write(f"format {_INDEX_FORMAT}\n")
+        for branch, hash in tips.items():
+            f.write(f"tip {branch} {hash}\n")
+        for commits in index.values():
+            for commit in commits:
+                f.write(f"{commit.hash} {commit.changelist} {commit.branch}\n")
+    os.replace(tmp_filename, filename)
+
+
+@functools.cache
+def get_commit_index() -> CommitIndex:
+    # The saved index is reused for as long as no branch has moved, and
+    # extended when the branches have only gained commits.
+    tips = _get_branch_tips()
+    filename = _get_index_filename()
+    saved = _read_commit_index(filename)
+    if saved is not None and saved[0] == tips:
+        return saved[1]
+    index = None
+    if saved is not None and saved[0].keys() <= tips.keys():
+        saved_tips, saved_index = saved
+        new_commits = _build_commit_index(tips, saved_tips)
+        if new_commits is not None:
+            index = {
+                branch: saved_index.get(branch, []) + commits
+                for branch, commits in new_commits.items()
+            }
+    if index is None:
+        index = _build_commit_index(tips)
+        assert index is not None
+    _write_commit_index(filename, tips, index)
+    return index
+
+
+def read_commit_index(filename: str) -> CommitIndex:
+    # A saved index, whichever branch tips it was saved for.
+    saved = _read_commit_index(filename)
+    if saved is None:
+        raise Exception(f"not a commit index: {filename}")
+    return saved[1]
+
+
+def remap_commit_index(commit_map: dict[GitHash, GitHash]) -> None:
+    # After git filter-repo has rewritten the commits in commit_map, so
+    # that the saved index can still be reused. The saved index must be
+    # for the branch tips from before the rewrite.
+    filename = _get_index_filename()
+    saved = _read_commit_index(filename)
+    if saved is None:
+        return
+    # filter-repo maps the commits which it pruned to the null hash.
+    index = {
+        branch: [
+            Commit(commit.changelist, branch, commit_map.get(commit.hash, commit.hash))
+            for commit in commits
+            if commit_map.get(commit.hash) != _NULL_HASH
+        ]
+        for branch, commits in saved[1].items()
+    }
+    _write_commit_index(filename, _get_branch_tips(), index)
+
+
+def save_commit_index(index: CommitIndex) -> None:
+    # For when we know the index without reading it from the branches,
+    # because we just wrote them, as import_p4.py does. Their commits
+    # share history from the start, which reading it would not allow.
+    _write_commit_index(_get_index_filename(), _get_branch_tips(), index)
+
+
+def get_last_changelist() -> Optional[ChangeList]:
+    # The newest changelist on any branch.
+    return max(
+        (
+            commit.changelist
+            for commits in get_commit_index().values()
+            for commit in commits
+        ),
+        default=None,
+    )
+
+
+@functools.cache
+def _get_changelist_branch_to_commits() -> (
+    dict[tuple[ChangeList, Branch], list[Commit]]
+):
+    changelist_branch_to_commits = defaultdict[tuple[ChangeList, Branch], list[Commit]](
+        list
+    )
+    for commits in get_commit_index().values():
+        for commit in commits:
+            changelist_branch_to_commits[(commit.changelist, commit.branch)].append(
+                commit
+            )
+    return changelist_branch_to_commits
+
+
+def find_commits(changelist: ChangeList, branch: Branch) -> list[Commit]:
+    return _get_changelist_branch_to_commits().get((changelist, branch), [])
+
+
+def main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Print the newest changelist converted, on any branch."
+    )
+    parser.parse_args(args)
+    changelist = get_last_changelist()
+    if changelist is None:
+        raise Exception("no branch has any commits")
+    print(changelist)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# For depots too large for make_merges to hold in memory: the filelog's
+# revisions, the commit index, and each commit's dependencies, together
+# with the parsed filelog and the commit graph, can outgrow the machine.
+# With make_merges.py --store, they are kept in an SQLite database
+# instead, and the grafts are worked out from it with indexed queries.
+# Memory is then bounded by SQLite's page cache, which is configurable,
+# and by the few bounded caches in front of it, rather than by the size
+# of the depot. Any sorting which does not fit in the cache spills to
+# temporary files.
+
+import functools
+import os
+import sqlite3
+from collections.abc import Iterable, Iterator
+from pathlib import PurePosixPath
+from typing import Any, Optional, Self, final
+
+import more_itertools
+
+from commit_index import Commit, CommitIndex, GitHash
+from git import Branch
+from p4.filelog import ChangeList, FileVersion
+
+# The rows written with each executemany, to bound the memory held by
+# the batches streamed into the database.
+_BATCH_SIZE = 10000
+
+_SCHEMA = """
+CREATE TABLE revisions (
+    path TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    changelist INTEGER NOT NULL,
+    PRIMARY KEY (path, version)
+) WITHOUT ROWID;
+
+-- Numbered as CommitGraph numbers them: branch by branch, in the order
+-- of the commit index, and oldest first within each branch. Previous
+-- is the commit before on the same branch, if any.
+CREATE TABLE commits (
+    id INTEGER PRIMARY KEY,
+    changelist INTEGER NOT NULL,
+    branch TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    previous INTEGER,
+    UNIQUE (changelist, branch)
+);
+
+CREATE TABLE dependencies (
+    commit_id INTEGER NOT NULL,
+    dep_id INTEGER NOT NULL,
+    PRIMARY KEY (commit_id, dep_id)
+) WITHOUT ROWID;
+
+-- The parents of each commit from other branches, as get_grafts works
+-- them out from the dependencies.
+CREATE TABLE merges (
+    child INTEGER NOT NULL,
+    parent INTEGER NOT NULL,
+    PRIMARY KEY (child, parent)
+) WITHOUT ROWID;
+"""
+
+
+@final
+class DependencyStore:
+    # A fresh database in directory, removed again on leaving the with
+    # block: it is only scratch space.
+    def __init__(self, directory: str, *, cache_size: int) -> None:
+        # cache_size is in MiB.
+        self.filename = os.path.join(directory, "make_merges.sqlite")
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.__db = sqlite3.connect(self.filename, isolation_level=None)
+        # Nothing is lost by a crash that would not be rebuilt anyway.
+        self.__db.execute("PRAGMA journal_mode = OFF")
+        self.__db.execute("PRAGMA synchronous = OFF")
+        self.__db.execute(f"PRAGMA cache_size = {-cache_size * 1024}")
+        self.__db.execute("PRAGMA temp_store = FILE")
+        self.__db.executescript(_SCHEMA)
+        # Each revision's commit is looked up once as a target, and
+        # again each time it is the source of an integration.
+        self.find_commit = functools.lru_cache(maxsize=1 << 16)(self.__find_commit)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.__db.close()
+        os.remove(self.filename)
+
+    def __insert_many(self, sql: str, rows: Iterable[tuple[Any, ...]]) -> int:
+        num_rows = 0
+        self.__db.execute("BEGIN")
+        for batch in more_itertools.chunked(rows, _BATCH_SIZE):
+            self.__db.executemany(sql, batch)
+            num_rows += len(batch)
+        self.__db.execute("COMMIT")
+        return num_rows
+
+    def add_revisions(
+        self, revisions: Iterable[tuple[PurePosixPath, FileVersion, ChangeList]]
+    ) -> int:
+        # As make_merges.get_changelist_index, returning how many.
+        try:
+            return self.__insert_many(
+                "INSERT INTO revisions (path, version, changelist) VALUES (?, ?, ?)",
+                (
+                    (str(path), version, changelist)
+                    for path, version, changelist in revisions
+                ),
+            )
+        except sqlite3.IntegrityError:
+            raise Exception("duplicate file version") from None
+
+    def add_commits(self, commit_index: CommitIndex) -> int:
+        # Returns how many.
+        def rows() -> Iterator[tuple[int, int, str, str, Optional[int]]]:
+            commit_id = 0
+            for branch, commits in commit_index.items():
+                previous = None
+                for commit in sorted(commits, key=lambda commit: commit.changelist):
+                    yield commit_id, commit.changelist, branch, commit.hash, previous
+                    previous = commit_id
+                    commit_id += 1
+
+        return self.__insert_many(
+            "INSERT INTO commits (id, changelist, branch, hash, previous)"
+            " VALUES (?, ?, ?, ?, ?)",
+            rows(),
+        )
+
+    def find_changelist(self, path: PurePosixPath, version: FileVersion) -> ChangeList:
+        row = self.__db.execute(
+            "SELECT changelist FROM revisions WHERE path = ? AND version = ?",
+            (str(path), version),
+        ).fetchone()
+        if row is None:
+            raise Exception(f"unknown file version: {path}#{version}")
+        return ChangeList(row[0])
+
+    def __find_commit(self, changelist: ChangeList, branch: Branch) -> Optional[int]:
+        row = self.__db.execute(
+            "SELECT id FROM commits WHERE changelist = ? AND branch = ?",
+            (changelist, branch),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def add_dependencies(self, commit_deps: Iterable[tuple[int, int]]) -> None:
+        # Each commit, and a commit on which it depends, by id. The same
+        # pair can come any number of times.
+        self.__insert_many(
+            "INSERT OR IGNORE INTO dependencies (commit_id, dep_id) VALUES (?, ?)",
+            commit_deps,
+        )
+
+    def __get_commit(self, commit_id: int) -> Commit:
+        changelist, branch, hash = self.__db.execute(
+            "SELECT changelist, branch, hash FROM commits WHERE id = ?", (commit_id,)
+        ).fetchone()
+        return Commit(ChangeList(changelist), Branch(branch), GitHash(hash))
+
+    def iter_grafts(
+        self, since: Optional[ChangeList] = None
+    ) -> Iterator[tuple[Commit, list[Commit]]]:
+        # As make_merges.get_grafts, in order of changelist, then branch.
+        #
+        # From the dependencies on each other branch, the parent is the
+        # latest of them, excluding any from the same changelist. SQLite
+        # takes the other columns from the row with the maximum.
+        self.__db.execute("BEGIN")
+        self.__db.execute(
+            """
+            INSERT INTO merges (child, parent)
+            SELECT child, parent FROM (
+                SELECT d.commit_id AS child, dep.id AS parent, MAX(dep.changelist)
+                FROM dependencies AS d
+                JOIN commits AS c ON c.id = d.commit_id
+                JOIN commits AS dep ON dep.id = d.dep_id
+                WHERE dep.branch != c.branch AND dep.changelist != c.changelist
+                GROUP BY d.commit_id, dep.branch
+            )
+            """
+        )
+        self.__db.execute("COMMIT")
+        # Only a merge, or the start of a branch, needs a graft. The
+        # commits are streamed in order of changelist, which is a
+        # topological order so long as every parent is from an earlier
+        # changelist. In p4 the source of an integration always is,
+        # having been submitted first; so rather than hold the graph to
+        # search it, we just check, which also rules out any cycle.
+        commits = self.__db.execute(
+            """
+            SELECT id, previous FROM commits
+            WHERE changelist > ?
+                AND (previous IS NULL OR id IN (SELECT child FROM merges))
+            ORDER BY changelist, branch
+            """,
+            (-1 if since is None else since,),
+        )
+        for commit_id, previous in commits:
+            commit = self.__get_commit(commit_id)
+            parent_ids = [
+                parent_id
+                for (parent_id,) in self.__db.execute(
+                    "SELECT parent FROM merges WHERE child = ?", (commit_id,)
+                )
+            ]
+            if previous is not None:
+                parent_ids.append(previous)
+            # In the order get_grafts gives them.
+            parents = [self.__get_commit(parent_id) for parent_id in sorted(parent_ids)]
+            for parent in parents:
+                if parent.changelist >= commit.changelist:
+                    raise Exception(
+                        f"commit {commit} has parent {parent}, which is not older"
+                    )
+            yield commit, parents
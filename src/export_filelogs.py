@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Exports the filelog of every file in the depot. This used to be one p4
+# filelog per file, run by GNU parallel --keep-order: a process, and a
+# round trip to the server, for each of the depot's files, with the
+# output held up behind whichever file was slowest.
+#
+# Instead, each p4 filelog is given a batch of files, and a few workers
+# run these concurrently. Each worker appends to its own shard of the
+# output, in whatever order its batches finish; the filelog parser reads
+# a directory of shards just as well as the one file.
+#
+# An incremental conversion only exports the filelogs of the files which
+# changed since last time, with --update. Their new filelogs replace the
+# old ones in the existing shards.
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import time
+
+from list_files import read_files
+from p4.filelog import get_filelog_files
+from p4 import client
+from p4.client import Client
+from stats import Step
+
+
+async def export_filelogs(
+    p4: Client, paths: list[str], out_dir: str, *, batch_size: int
+) -> None:
+    # Written to a temporary directory and then renamed, so that nothing
+    # ever parses the output of an export which did not finish.
+    tmp_dir = f"{out_dir.rstrip('/')}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.mkdir(tmp_dir)
+    tz = await p4.get_server_timezone()
+    batches = [paths[i : i + batch_size] for i in range(0, len(paths), batch_size)]
+    batches.reverse()
+
+    async def export_shard(shard_filename: str, step: Step) -> None:
+        # Paths which are not UTF-8 are written as p4 gave them.
+        with open(
+            shard_filename, "wt", encoding="utf-8", errors="surrogateescape"
+        ) as shard:
+            while batches:
+                batch = batches.pop()
+                for changed_file in await p4.filelog(batch, tz):
+                    print(changed_file, file=shard)
+                step.advance(len(batch))
+
+    # As many workers as can run at once, so that there is always a
+    # batch waiting for the server.
+    with Step("export filelogs", total=len(paths), unit="files") as step:
+        async with asyncio.TaskGroup() as tasks:
+            for worker in range(p4.limit.maximum):
+                shard_filename = os.path.join(tmp_dir, f"filelog{worker:03}.txt")
+                tasks.create_task(export_shard(shard_filename, step))
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.rename(tmp_dir, out_dir)
+
+
+async def update_filelogs(
+    p4: Client, paths: list[str], out_dir: str, *, batch_size: int
+) -> None:
+    # Otherwise there would be nothing to append the new filelogs to,
+    # and they would be lost along with the old ones.
+    shards = get_filelog_files(out_dir) if os.path.exists(out_dir) else []
+    if not shards:
+        raise Exception(f"no filelogs in {out_dir} to update")
+    new_dir = f"{out_dir.rstrip('/')}.new"
+    await export_filelogs(p4, paths, new_dir, batch_size=batch_size)
+    replaced = {path.encode("utf-8", errors="surrogateescape") for path in paths}
+    new_shards = get_filelog_files(new_dir)
+    # Each new shard is appended to one of the old shards, so that their
+    # number stays the same however many updates there are. Every shard
+    # is replaced in one go, and the files are dropped from all of the
+    # shards before anything is appended, so if we are interrupted, the
+    # next update still ends up with each file's filelog exactly once.
+    for i, shard in enumerate(shards):
+        tmp_filename = f"{shard}.tmp"
+        with open(tmp_filename, "wb") as out:
+            with open(shard, "rb") as f:
+                keep = True
+                for line in f:
+                    if line.startswith(b"//"):
+                        keep = line.rstrip() not in replaced
+                    if keep:
+                        out.write(line)
+            for new_shard in new_shards[i :: len(shards)]:
+                with open(new_shard, "rb") as f:
+                    shutil.copyfileobj(f, out)
+        os.replace(tmp_filename, shard)
+    shutil.rmtree(new_dir)
+
+
+def main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Export the filelog of every file listed in FILES, into OUT_DIR."
+    )
+    parser.add_argument("files", metavar="FILES", help="one depot path per line")
+    parser.add_argument("out_dir", metavar="OUT_DIR")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="number of files per p4 command",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="replace these files' filelogs in the existing OUT_DIR,"
+        " rather than exporting OUT_DIR afresh",
+    )
+    client.add_arguments(parser)
+    options = parser.parse_args(args)
+    paths = read_files(options.files)
+    start = time.perf_counter()
+    export = update_filelogs if options.update else export_filelogs
+    asyncio.run(
+        export(
+            client.from_arguments(options),
+            paths,
+            options.out_dir,
+            batch_size=options.batch_size,
+        )
+    )
+    elapsed = time.perf_counter() - start
+    print(f"Exported {len(paths)} filelogs in {elapsed:.1f} s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Exports each label's spec, as p4 label -o writes it, followed by the
+# label's changelist: the newest of the changelists of the files in the
+# label. make_tags.py then makes a tag from each of these files.
+
+import argparse
+import asyncio
+import os
+import re
+import sys
+
+from p4 import client
+from p4.client import Client
+from stats import Step
+
+
+def format_label_spec(fields: dict[str, str]) -> str:
+    # The text form of the spec, from the fields of p4 -G label -o. A
+    # field of several lines, like View, comes as View0, View1, and so
+    # on; the text puts each line of such fields, and of the
+    # description, on its own line after a tab.
+    lines = []
+    list_fields: dict[str, list[str]] = {}
+    for name, value in fields.items():
+        match = re.fullmatch("([A-Za-z]+)([0-9]+)", name)
+        if match is not None:
+            list_fields.setdefault(match.group(1), []).append(value)
+        elif "\n" in value or name == "Description":
+            lines += [f"{name}:"] + [f"\t{line}" for line in value.splitlines()]
+            lines.append("")
+        else:
+            lines += [f"{name}:\t{value}", ""]
+    for name, values in list_fields.items():
+        lines += [f"{name}:"] + [f"\t{value}" for value in values]
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+async def export_label(p4: Client, name: str, filename: str, step: Step) -> None:
+    fields = await p4.label(name)
+    changelists = [
+        revision.changelist
+        async for revision in p4.iter_files(f"@{name}", allow_empty=True)
+    ]
+    if not changelists:
+        # Nothing to tag, and no changelist to tag it at.
+        print(f"Skipping label {name}, which has no files", file=sys.stderr)
+        step.advance()
+        return
+    with open(filename, "wt", encoding="utf-8", errors="surrogateescape") as f:
+        f.write(format_label_spec(fields))
+        f.write(f"Changelist:\t{max(changelists)}")
+    step.advance()
+
+
+async def export_labels(p4: Client, out_dir: str) -> None:
+    os.makedirs(out_dir, exist_ok=True)
+    names = await p4.labels()
+    with Step("export labels", total=len(names), unit="labels") as step:
+        async with asyncio.TaskGroup() as tasks:
+            for i, name in enumerate(names, start=1):
+                filename = os.path.join(out_dir, f"p4-exported-label{i}.txt")
+                tasks.create_task(export_label(p4, name, filename, step))
+
+
+def main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Export every label, with its changelist, into OUT_DIR."
+    )
+    parser.add_argument("out_dir", metavar="OUT_DIR")
+    client.add_arguments(parser)
+    options = parser.parse_args(args)
+    asyncio.run(export_labels(client.from_arguments(options), options.out_dir))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Exports what we need from Perforce, besides the commits themselves:
+# the list of files, their filelogs, and the labels. All from the one
+# process, so that one budget limits how hard we work the server.
+#
+# With --since, for an incremental conversion, only the files changed
+# after that changelist are listed, and only their filelogs exported
+# again. The labels are always exported afresh: they are few, and can
+# change at any time.
+
+import argparse
+import asyncio
+import sys
+import time
+from typing import Optional
+
+from export_filelogs import export_filelogs, update_filelogs
+from export_labels import export_labels
+from list_files import list_files, write_files
+from p4 import client
+from p4.client import Client
+from p4.filelog import ChangeList
+
+
+async def export(
+    p4: Client,
+    *,
+    chunk_size: Optional[int],
+    batch_size: int,
+    since: Optional[ChangeList] = None,
+) -> None:
+    paths = await list_files(p4, chunk_size=chunk_size, since=since)
+    write_files("files.txt", paths)
+    export = export_filelogs if since is None else update_filelogs
+    # The labels are few, so they can share the server with the
+    # filelogs.
+    async with asyncio.TaskGroup() as tasks:
+        tasks.create_task(export(p4, paths, "filelogs", batch_size=batch_size))
+        tasks.create_task(export_labels(p4, "labels"))
+
+
+def main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Export files.txt, filelogs/ and labels/ from Perforce."
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        help="as for list_files.py",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="as for export_filelogs.py",
+    )
+    parser.add_argument(
+        "--since",
+        type=int,
+        metavar="CHANGELIST",
+        help="only export the files changed after this changelist,"
+        " updating the existing filelogs",
+    )
+    client.add_arguments(parser)
+    options = parser.parse_args(args)
+    p4 = client.from_arguments(options)
+    start = time.perf_counter()
+    asyncio.run(
+        export(
+            p4,
+            chunk_size=options.chunk_size,
+            batch_size=options.batch_size,
+            since=options.since,
+        )
+    )
+    elapsed = time.perf_counter() - start
+    print(
+        f"Exported from Perforce in {elapsed:.1f} s,"
+        f" with {p4.num_commands} p4 commands",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
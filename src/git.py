@@ -15,22 +15,250 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import contextlib
+import io
+import os
 import subprocess
-from typing import Mapping, NewType, Optional
+import tempfile
+import threading
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from typing import IO, Mapping, NewType, Optional, Self, final
+
+import more_itertools
+
+from stats import count_subprocess
 
 Branch = NewType("Branch", str)
 
 
+def _check(args: list[str], returncode: int, stderr: bytes) -> None:
+    if returncode != 0:
+        message = stderr.decode("utf-8", errors="replace").strip()
+        raise Exception(
+            f"git {' '.join(args)} failed with status {returncode}: {message}"
+        )
+
+
 def git(
     args: list[str],
     *,
     input: Optional[bytes] = None,
     env: Optional[Mapping[str, str]] = None,
 ) -> str:
+    count_subprocess()
     proc = subprocess.run(
         args=["git"] + args,
         input=input,
         capture_output=True,
         env=env,
     )
+    _check(args, proc.returncode, proc.stderr)
     return proc.stdout.decode("utf-8")
+
+
+def git_lines(args: list[str], *, errors: str = "strict") -> Iterator[str]:
+    # For commands with a lot of output, such as git log. Lines are
+    # processed as git produces them, rather than being collected into
+    # one big string first. errors is as for bytes.decode, for output
+    # which might not be UTF-8.
+    count_subprocess()
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(
+            args=["git"] + args, stdout=subprocess.PIPE, stderr=stderr
+        )
+        assert proc.stdout is not None
+        complete = False
+        try:
+            for line in io.TextIOWrapper(
+                proc.stdout, encoding="utf-8", errors=errors, newline="\n"
+            ):
+                yield line.removesuffix("\n")
+            complete = True
+        finally:
+            # If we stopped reading early, git could be blocked writing.
+            if not complete:
+                proc.kill()
+            proc.wait()
+        stderr.seek(0)
+        _check(args, proc.returncode, stderr.read())
+
+
+@contextlib.contextmanager
+def git_process(
+    args: list[str], *, stdin: Optional[int] = None, stdout: Optional[int] = None
+) -> Iterator[subprocess.Popen[bytes]]:
+    # For streaming into, or out of, git. On leaving the with block, we
+    # close git's input, wait for it to finish, and check it succeeded.
+    count_subprocess()
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(
+            args=["git"] + args, stdin=stdin, stdout=stdout, stderr=stderr
+        )
+        try:
+            yield proc
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        if proc.stdin is not None:
+            proc.stdin.close()
+        proc.wait()
+        if proc.stdout is not None:
+            proc.stdout.close()
+        stderr.seek(0)
+        _check(args, proc.returncode, stderr.read())
+
+
+@final
+@dataclass(frozen=True)
+class GitObject:
+    hash: str
+    type: str
+    size: int
+    # Only read by CatFile(contents=True).
+    content: Optional[bytes]
+
+
+@final
+class CatFile:
+    # A long-lived git cat-file --batch (or --batch-check) process, so
+    # that we can look up any number of objects without starting a
+    # process for each.
+
+    def __init__(self, *, contents: bool = True) -> None:
+        self.__contents = contents
+        self.__args = ["cat-file", "--batch" if contents else "--batch-check"]
+        count_subprocess()
+        self.__proc = subprocess.Popen(
+            args=["git"] + self.__args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        stdin, stdout, stderr = self.__pipes()
+        stdin.close()
+        stdout.close()
+        returncode = self.__proc.wait()
+        _check(self.__args, returncode, stderr.read())
+        stderr.close()
+
+    def __pipes(self) -> tuple[IO[bytes], IO[bytes], IO[bytes]]:
+        proc = self.__proc
+        assert proc.stdin and proc.stdout and proc.stderr
+        return proc.stdin, proc.stdout, proc.stderr
+
+    def lookup(self, name: str) -> Optional[GitObject]:
+        return more_itertools.one(self.lookup_many([name]))
+
+    def lookup_many(self, names: Iterable[str]) -> Iterator[Optional[GitObject]]:
+        # None for each object which does not exist.
+        names = list(names)
+        stdin, _, _ = self.__pipes()
+
+        def write_requests() -> None:
+            for name in names:
+                stdin.write(f"{name}\n".encode("utf-8"))
+            stdin.flush()
+
+        # Write from another thread. Otherwise, with enough requests,
+        # both us and git could block on full pipes.
+        writer = threading.Thread(target=write_requests)
+        writer.start()
+        num_read = 0
+        try:
+            while num_read < len(names):
+                obj = self.__read_response()
+                num_read += 1
+                yield obj
+        finally:
+            # Keep in step with git, even if we were not asked for all
+            # the responses.
+            while num_read < len(names):
+                self.__read_response()
+                num_read += 1
+            writer.join()
+
+    def __read_response(self) -> Optional[GitObject]:
+        _, stdout, _ = self.__pipes()
+        header = stdout.readline().decode("utf-8").split()
+        if len(header) != 3:
+            # <name> missing, or <name> ambiguous
+            return None
+        hash, type, size = header[0], header[1], int(header[2])
+        content = None
+        if self.__contents:
+            content = stdout.read(size)
+            stdout.read(len(b"\n"))
+        return GitObject(hash, type, size, content)
+
+
+def write_objects(object_type: str, contents: list[bytes]) -> list[str]:
+    # git hash-object can only read one object from stdin, but any
+    # number from files.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for i, content in enumerate(contents):
+            path = os.path.join(tmpdir, str(i))
+            with open(path, "wb") as f:
+                f.write(content)
+            paths.append(path)
+        return git(
+            ["hash-object", "-t", object_type, "-w", "--stdin-paths"],
+            input="".join(f"{path}\n" for path in paths).encode("utf-8"),
+        ).split()
+
+
+def update_refs(commands: list[str]) -> None:
+    # All of the updates happen in one transaction.
+    git(
+        ["update-ref", "--stdin"],
+        input="".join(f"{command}\n" for command in commands).encode("utf-8"),
+    )
+
+
+def _graft_commit(commit: bytes, parents: list[str]) -> bytes:
+    # Like git replace --graft: swap the parents, and drop any signature
+    # because it would no longer be valid.
+    header, sep, message = commit.partition(b"\n\n")
+    lines = []
+    in_signature = False
+    for line in header.split(b"\n"):
+        if line.startswith(b" ") and in_signature:
+            continue
+        in_signature = line.startswith(b"gpgsig")
+        if in_signature or line.startswith(b"parent "):
+            continue
+        lines.append(line)
+        if line.startswith(b"tree "):
+            lines += [f"parent {parent}".encode("utf-8") for parent in parents]
+    return b"\n".join(lines) + sep + message
+
+
+def replace_grafts(grafts: Mapping[str, list[str]], cat_file: CatFile) -> None:
+    # The equivalent of running git replace --graft for each commit, but
+    # with a handful of git processes instead of one per commit.
+    commits = list(grafts)
+    new_commits = []
+    for commit, obj in zip(commits, cat_file.lookup_many(commits)):
+        if obj is None or obj.type != "commit" or obj.content is None:
+            raise Exception(f"not a commit: {commit}")
+        new_commits.append(_graft_commit(obj.content, grafts[commit]))
+    replacements = write_objects("commit", new_commits)
+    update_refs(
+        [
+            f"create refs/replace/{commit} {replacement}"
+            for commit, replacement in zip(commits, replacements)
+            # git replace --graft does the same, when the parents are
+            # unchanged.
+            if commit != replacement
+        ]
+    )
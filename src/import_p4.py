@@ -0,0 +1,487 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Imports the depot straight into git, as an alternative to p4-fusion
+# followed by split_branches.py, make_merges.py and rewrite_history.py.
+# Between them, those write the history several times over: the whole
+# depot as one branch, then again as a branch per p4 branch, then a
+# replacement for each merge, and then every branch once more, to make
+# the merges permanent and to tidy the messages and authors.
+#
+# Instead we work everything out from the filelogs first: which commits
+# each branch gets, and, as make_merges.py would, their parents. Then a
+# single git fast-import stream writes each file's contents, printed
+# from p4, and each commit, in its final form, exactly once.
+#
+# This always imports the whole depot, into a new repository. It cannot
+# carry on an incremental conversion, which needs the p4-fusion
+# repository.
+
+import argparse
+import asyncio
+import datetime
+import hashlib
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import PurePosixPath
+from typing import IO, Optional, final
+
+from branchmap import split_path
+from commit_index import Commit, GitHash, save_commit_index
+from git import Branch, git, git_process
+from mailmap import Mailmap
+from make_merges import get_changelist_index, get_commit_to_deps, get_grafts
+from p4 import client
+from p4.client import Change, Client
+from p4.filelog import (
+    ChangedFile,
+    ChangeList,
+    FileChange,
+    FileVersion,
+    get_path_to_changed_file,
+)
+from rewrite_history import Replacements, parse_replacements
+from split_branches import quote_path
+from stats import Step
+
+Revision = tuple[PurePosixPath, FileVersion]
+
+# Revisions with no contents. (Purged and archived revisions do have
+# contents, in principle, but p4 print cannot give them to us.)
+DELETE_ACTIONS = {"delete", "move/delete", "purge", "archive"}
+
+# Perforce makes branches and copies as lazy copies, with the very same
+# contents as their source. Anything else, such as a merge, has its own.
+_COPY_ACTIONS = {"branch", "copy"}
+
+
+def get_mode(file_type: str) -> bytes:
+    # A file type is a base type, with any modifiers after a +, except
+    # for the older names which have modifiers built in, like xtext.
+    base, _, modifiers = file_type.partition("+")
+    if base == "symlink":
+        return b"120000"
+    if "x" in modifiers or base.startswith(("x", "kx", "cx", "ux")):
+        return b"100755"
+    return b"100644"
+
+
+def get_content_revisions(
+    path_to_changed_file: dict[PurePosixPath, ChangedFile]
+) -> dict[Revision, Revision]:
+    # For each revision which has contents, the revision which we print
+    # to get them: itself, unless it is a copy of another revision in
+    # the filelogs.
+    file_changes: dict[Revision, FileChange] = {
+        (changed_file.path, file_change.version): file_change
+        for changed_file in path_to_changed_file.values()
+        for file_change in changed_file.file_changes
+    }
+
+    def get_source(revision: Revision) -> Optional[Revision]:
+        file_change = file_changes[revision]
+        if file_change.action not in _COPY_ACTIONS:
+            return None
+        for sub_change in file_change.sub_changes:
+            if sub_change.action == f"{file_change.action} from":
+                source = (sub_change.path, max(sub_change.path_revs))
+                source_change = file_changes.get(source)
+                if source_change and source_change.action not in DELETE_ACTIONS:
+                    return source
+        return None
+
+    content_revisions: dict[Revision, Revision] = {}
+    for revision, file_change in file_changes.items():
+        if file_change.action in DELETE_ACTIONS:
+            continue
+        # Follow the copies of copies back to the original.
+        chain = []
+        content_revision = revision
+        while content_revision not in content_revisions:
+            if content_revision in chain:
+                raise Exception(f"revision {content_revision} is a copy of itself")
+            chain.append(content_revision)
+            source = get_source(content_revision)
+            if source is None:
+                content_revisions[content_revision] = content_revision
+                break
+            content_revision = source
+        content_revision = content_revisions[content_revision]
+        for copy in chain:
+            content_revisions[copy] = content_revision
+    return content_revisions
+
+
+@final
+class _Blobs:
+    # Writes each distinct contents once, as a blob, however many
+    # revisions have those contents. Whether two are the same is decided
+    # by their git hash, just as git would.
+
+    def __init__(self, out: IO[bytes]) -> None:
+        self.out = out
+        self.num_marks = 0
+        self.revision_to_mark: dict[Revision, int] = {}
+        self.__hash_to_mark: dict[bytes, int] = {}
+
+    def add(self, revision: Revision, contents: bytes) -> None:
+        hash = hashlib.sha1(b"blob %d\0" % len(contents))
+        hash.update(contents)
+        mark = self.__hash_to_mark.get(hash.digest())
+        if mark is None:
+            self.num_marks += 1
+            mark = self.num_marks
+            self.__hash_to_mark[hash.digest()] = mark
+            self.out.write(b"blob\nmark :%d\ndata %d\n" % (mark, len(contents)))
+            self.out.write(contents)
+            self.out.write(b"\n")
+        self.revision_to_mark[revision] = mark
+
+
+async def print_revisions(
+    p4: Client, revisions: list[Revision], blobs: _Blobs, *, batch_size: int
+) -> None:
+    # As many batches at once as the client allows, like the filelogs.
+    batches = [
+        revisions[i : i + batch_size] for i in range(0, len(revisions), batch_size)
+    ]
+    batches.reverse()
+
+    async def print_batches(step: Step) -> None:
+        while batches:
+            batch = batches.pop()
+            file_specs = [f"{path}#{version}" for path, version in batch]
+            async for path, version, contents in p4.print_files(file_specs):
+                blobs.add((PurePosixPath(path), version), contents)
+                step.advance()
+
+    with Step("print files", total=len(revisions), unit="files") as step:
+        async with asyncio.TaskGroup() as tasks:
+            for _ in range(p4.limit.maximum):
+                tasks.create_task(print_batches(step))
+    for revision in revisions:
+        if revision not in blobs.revision_to_mark:
+            raise Exception(f"p4 print did not give {revision[0]}#{revision[1]}")
+
+
+async def export_from_p4(
+    p4: Client, revisions: list[Revision], blobs: _Blobs, *, batch_size: int
+) -> tuple[dict[ChangeList, Change], datetime.tzinfo]:
+    # Everything we need from Perforce, besides the filelogs: each
+    # changelist's author, time and description, and the contents.
+    tz = await p4.get_server_timezone()
+    changes = {change.changelist: change for change in await p4.change_details()}
+    await print_revisions(p4, revisions, blobs, batch_size=batch_size)
+    return changes, tz
+
+
+FileState = tuple[bytes, int]
+
+
+@final
+@dataclass
+class _PlannedCommit:
+    commit: Commit
+    # The paths in the branch which the commit changes, with the mode
+    # and blob mark of each, or None for a deletion. For the commit
+    # which starts a branch, that is every file.
+    file_changes: list[tuple[bytes, Optional[FileState]]]
+
+
+def plan_commits(
+    path_to_changed_file: dict[PurePosixPath, ChangedFile],
+    content_revisions: dict[Revision, Revision],
+    blobs: _Blobs,
+) -> list[_PlannedCommit]:
+    # The commits, in the order of their changelists: one on each branch
+    # whose files a changelist changes, as split_branches.py would make.
+    # Each commit gets a mark, following the blobs', which stands in
+    # for its hash.
+    changelist_to_revisions = defaultdict[
+        ChangeList, list[tuple[PurePosixPath, FileChange]]
+    ](list)
+    for changed_file in path_to_changed_file.values():
+        for file_change in changed_file.file_changes:
+            changelist_to_revisions[file_change.changelist].append(
+                (changed_file.path, file_change)
+            )
+    branch_to_files = defaultdict[Branch, dict[bytes, FileState]](dict)
+    planned_commits = []
+    mark = blobs.num_marks
+    for changelist in sorted(changelist_to_revisions):
+        branch_to_file_changes: dict[
+            Branch, list[tuple[bytes, Optional[FileState]]]
+        ] = {}
+        for path, file_change in sorted(
+            changelist_to_revisions[changelist], key=lambda item: item[0]
+        ):
+            target = split_path(str(path).removeprefix("//depot/"), changelist)
+            if target is None:
+                continue
+            branch, branch_path = target
+            encoded_path = branch_path.encode("utf-8", "surrogateescape")
+            state = None
+            if file_change.action not in DELETE_ACTIONS:
+                content_revision = content_revisions[(path, file_change.version)]
+                state = (
+                    get_mode(file_change.chmod),
+                    blobs.revision_to_mark[content_revision],
+                )
+            branch_to_file_changes.setdefault(branch, []).append((encoded_path, state))
+        # As in split_branches.py, several depot paths can end up at the
+        # same path in a branch, so we compare the end result.
+        for branch, file_changes in branch_to_file_changes.items():
+            files = branch_to_files[branch]
+            before: dict[bytes, Optional[FileState]] = {}
+            for encoded_path, state in file_changes:
+                before.setdefault(encoded_path, files.get(encoded_path))
+                if state is None:
+                    files.pop(encoded_path, None)
+                else:
+                    files[encoded_path] = state
+            changed = [
+                (encoded_path, files.get(encoded_path))
+                for encoded_path in before
+                if files.get(encoded_path) != before[encoded_path]
+            ]
+            if changed:
+                mark += 1
+                commit = Commit(changelist, branch, GitHash(f":{mark}"))
+                planned_commits.append(_PlannedCommit(commit, changed))
+    return planned_commits
+
+
+def get_message(change: Change, replacements: list[Replacements]) -> bytes:
+    # As rewrite_history.py leaves the messages which p4-fusion writes.
+    message = change.description
+    for literals, regexes in replacements:
+        for literal, replacement in literals:
+            message = message.replace(literal, replacement)
+        for regex, replacement in regexes:
+            message = re.sub(regex, replacement, message)
+    return message.rstrip(b"\n") + b"\n\nP4:%d\n" % change.changelist
+
+
+def _format_offset(tz: datetime.tzinfo, time: int) -> str:
+    # The offset in force at the time, which differs either side of a
+    # change to or from daylight saving time.
+    offset = datetime.datetime.fromtimestamp(time, tz).utcoffset()
+    assert offset is not None
+    minutes = int(offset.total_seconds()) // 60
+    sign = "-" if minutes < 0 else "+"
+    return f"{sign}{abs(minutes) // 60:02}{abs(minutes) % 60:02}"
+
+
+def write_commits(
+    out: IO[bytes],
+    planned_commits: list[_PlannedCommit],
+    grafts: dict[Commit, list[Commit]],
+    changes: dict[ChangeList, Change],
+    tz: datetime.tzinfo,
+    *,
+    mailmap: Optional[Mailmap],
+    replacements: list[Replacements],
+) -> None:
+    previous: dict[Branch, Commit] = {}
+    for planned in planned_commits:
+        commit = planned.commit
+        change = changes.get(commit.changelist)
+        if change is None:
+            raise Exception(f"p4 changes did not give changelist {commit.changelist}")
+        last = previous.get(commit.branch)
+        parents = [last] if last is not None else []
+        if commit in grafts:
+            # The same parents as make_merges.py would graft, except
+            # that the branch's own previous commit always comes first.
+            parents = sorted(grafts[commit], key=lambda parent: parent != last)
+        for parent in parents:
+            if parent.changelist > commit.changelist:
+                raise Exception(f"{commit} merges from the later {parent}")
+        name, email = change.user.encode("utf-8", "surrogateescape"), b""
+        if mailmap is not None:
+            name, email = mailmap.translate(name, email)
+        offset = _format_offset(tz, change.time)
+        ident = b"%s <%s> %d %s" % (name, email, change.time, offset.encode("utf-8"))
+        message = get_message(change, replacements)
+        out.write(b"commit refs/heads/%s\n" % commit.branch.encode("utf-8"))
+        out.write(b"mark %s\n" % commit.hash.encode("utf-8"))
+        out.write(b"author %s\ncommitter %s\n" % (ident, ident))
+        out.write(b"data %d\n%s\n" % (len(message), message))
+        for i, parent in enumerate(parents):
+            command = b"from" if i == 0 else b"merge"
+            out.write(b"%s %s\n" % (command, parent.hash.encode("utf-8")))
+        if last is None and parents:
+            # A new branch, from another: its files are all of its own.
+            out.write(b"deleteall\n")
+        # Deletions first, in case a file is replaced by a directory.
+        for branch_path, state in planned.file_changes:
+            if state is None:
+                out.write(b"D " + quote_path(branch_path) + b"\n")
+        for branch_path, state in planned.file_changes:
+            if state is not None:
+                mode, mark = state
+                out.write(b"M %s :%d %s\n" % (mode, mark, quote_path(branch_path)))
+        out.write(b"\n")
+        previous[commit.branch] = commit
+
+
+def read_marks(filename: str) -> dict[GitHash, GitHash]:
+    # As git fast-import --export-marks writes them: ":MARK HASH".
+    with open(filename, "rt", encoding="utf-8") as f:
+        return {
+            GitHash(mark): GitHash(hash) for mark, hash in (line.split() for line in f)
+        }
+
+
+def main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Import the depot into the git repository, with a branch per"
+        " p4 branch, and merges, in one git fast-import."
+    )
+    parser.add_argument(
+        "--filelogs",
+        default="filelogs",
+        help="the filelog, or a directory of shards from export_filelogs.py",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes with which to parse the filelogs, and find"
+        " the dependencies between commits",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="number of files per p4 print",
+    )
+    parser.add_argument(
+        "--replace-message",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="as for rewrite_history.py",
+    )
+    parser.add_argument(
+        "--mailmap",
+        metavar="FILE",
+        help="as for rewrite_history.py, from Perforce usernames to full names",
+    )
+    client.add_arguments(parser)
+    options = parser.parse_args(args)
+    p4 = client.from_arguments(options)
+    # Each branch's first commit has no parent, so fast-import would
+    # stack the history onto any existing branch of the same name.
+    if git(["for-each-ref", "--count=1", "refs/heads/"]):
+        raise Exception("the repository already has branches")
+    replacements = [
+        parse_replacements(filename) for filename in options.replace_message
+    ]
+    mailmap = Mailmap(options.mailmap) if options.mailmap is not None else None
+    with Step("parse filelogs", unit="files") as step:
+        path_to_changed_file = get_path_to_changed_file(
+            options.filelogs, jobs=options.jobs
+        )
+        step.advance(len(path_to_changed_file))
+    content_revisions = get_content_revisions(path_to_changed_file)
+    # Only the contents which some branch has.
+    wanted = set()
+    for changed_file in path_to_changed_file.values():
+        rel_path = str(changed_file.path).removeprefix("//depot/")
+        for file_change in changed_file.file_changes:
+            revision = (changed_file.path, file_change.version)
+            if revision in content_revisions and split_path(
+                rel_path, file_change.changelist
+            ):
+                wanted.add(content_revisions[revision])
+    # The marks say which commit is which, for the commit index.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        marks_filename = os.path.join(tmp_dir, "marks")
+        with git_process(
+            ["fast-import", "--quiet", "--done", f"--export-marks={marks_filename}"],
+            stdin=subprocess.PIPE,
+        ) as fast_import:
+            out = fast_import.stdin
+            assert out is not None
+            out.write(b"feature done\n")
+            blobs = _Blobs(out)
+            changes, tz = asyncio.run(
+                export_from_p4(p4, sorted(wanted), blobs, batch_size=options.batch_size)
+            )
+            with Step("plan commits", unit="commits") as step:
+                planned_commits = plan_commits(
+                    path_to_changed_file, content_revisions, blobs
+                )
+                step.advance(len(planned_commits))
+            branch_to_commits: dict[Branch, set[Commit]] = {}
+            for planned in planned_commits:
+                commit = planned.commit
+                branch_to_commits.setdefault(commit.branch, set()).add(commit)
+            changed_files = path_to_changed_file.values()
+            with Step(
+                "find dependencies", total=len(changed_files), unit="files"
+            ) as step:
+                commit_to_deps = get_commit_to_deps(
+                    changed_files,
+                    get_changelist_index(changed_files),
+                    branch_to_commits,
+                    jobs=options.jobs,
+                    step=step,
+                )
+            with Step("work out grafts", unit="grafts") as step:
+                grafts = get_grafts(branch_to_commits, commit_to_deps)
+                step.advance(len(grafts))
+            with Step("write commits", unit="commits") as step:
+                write_commits(
+                    out,
+                    planned_commits,
+                    grafts,
+                    changes,
+                    tz,
+                    mailmap=mailmap,
+                    replacements=replacements,
+                )
+                step.advance(len(planned_commits))
+            out.write(b"done\n")
+        mark_to_hash = read_marks(marks_filename)
+    # Saved now, because otherwise make_tags.py would try to index the
+    # branches, which unlike after split_branches.py share history.
+    save_commit_index(
+        {
+            branch: [
+                Commit(commit.changelist, branch, mark_to_hash[commit.hash])
+                for commit in sorted(commits, key=lambda commit: commit.changelist)
+            ]
+            for branch, commits in branch_to_commits.items()
+        }
+    )
+    print(
+        f"Imported {len(planned_commits)} commits, with {blobs.num_marks} blobs,"
+        f" on {len(branch_to_commits)} branches",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
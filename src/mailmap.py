@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A mailmap, read as git filter-repo reads it, for when we write authors
+# and taggers ourselves rather than leaving it to filter-repo. This is
+# not quite as git reads a mailmap: the commit's name can be given
+# without an email address, which is how ours maps Perforce usernames
+# to full names, as in
+#
+#     Bart Oldeman <> BartO
+
+import re
+from typing import Optional, final
+
+_NAME_AND_EMAIL_RE = re.compile(rb"(.*?)\s*<([^>]*)>\s*")
+
+
+@final
+class Mailmap:
+    def __init__(self, filename: str) -> None:
+        # From the commit's name and email, where None matches any, to
+        # the proper name and email, where empty means unchanged.
+        self.__changes: dict[
+            tuple[Optional[bytes], Optional[bytes]], tuple[bytes, bytes]
+        ] = {}
+        with open(filename, "rb") as f:
+            for line_number, line in enumerate(f, start=1):
+                line = re.sub(rb"\s*#.*", b"", line).strip()
+                if not line:
+                    continue
+                match = _NAME_AND_EMAIL_RE.match(line)
+                if match is None:
+                    raise Exception(f"{filename}:{line_number}: bad mailmap line")
+                proper = (match.group(1), match.group(2))
+                rest = line[match.end() :]
+                if not rest:
+                    self.__changes[(None, proper[1])] = proper
+                    continue
+                match = _NAME_AND_EMAIL_RE.fullmatch(rest)
+                if match is None:
+                    self.__changes[(rest, None)] = proper
+                else:
+                    self.__changes[(match.group(1), match.group(2))] = proper
+
+    def translate(self, name: bytes, email: bytes) -> tuple[bytes, bytes]:
+        # The first entry which matches wins.
+        for (old_name, old_email), (new_name, new_email) in self.__changes.items():
+            if (old_email is None or email.lower() == old_email.lower()) and (
+                not old_name or name == old_name
+            ):
+                return new_name or name, new_email or email
+        return name, email
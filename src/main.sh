@@ -17,83 +17,185 @@
 
 set -eux -o pipefail
 
-repoDir="$1"
+repoDir="$(realpath --canonicalize-missing "$1")"
+# Either full, or incremental: convert only the changelists submitted
+# since the last conversion into repoDir, adding them onto its branches.
+# Or direct: like full, but import straight from p4 with import_p4.py,
+# instead of p4-fusion, split_branches.py, make_merges.py and
+# rewrite_history.py.
+mode="${2:-full}"
+# Given "verify", check the result against p4 at the end.
+verify="${3:-}"
+# Where to keep what is needed between runs; by default, beside repoDir,
+# so as not to bloat the repository itself.
+stateDir="$(realpath --canonicalize-missing "${4:-${repoDir%.git}.mergetastic}")"
 
 myDir="$(realpath "$(dirname "${BASH_SOURCE[0]}")")"
 dataDir="$(realpath "$myDir/../data/")"
 
-p4-fusion --client "$P4CLIENT" --port "$P4PORT" --user "$P4USER" --path //depot/... --lookAhead 1000 --includeBinaries true --src "$repoDir"
-
+# What we keep in stateDir between runs: the repository p4-fusion
+# writes to, which it carries on from next time; the filelogs, of which
+# next time only updates those files which change; and the manifest of
+# the stages this run has finished.
+fusionRepoDir="$stateDir/p4-fusion.git"
+manifest="$stateDir/stages"
+
+if [ -e "$repoDir/mergetastic/filelogs" ] && [ ! -e "$stateDir" ]; then
+  echo >&2 "$repoDir/mergetastic has the state of an earlier conversion: move it to $stateDir"
+  exit 1
+fi
+
+if [ "$mode" != incremental ]; then
+  git init --bare --quiet "$repoDir"
+fi
+mkdir -p "$stateDir"
 cd "$repoDir"
 
-# Get the filelog of every file, for creating the merges.
-LANG="C" # So ‘.*’ includes the non-UTF-8 bits of commit messages
-p4 changes -s submitted //depot/... | sed -E -e 's/^Change ([0-9]+) on .*/\1/' >changelists.txt
-echo "Exporting list of files. This can take a couple minutes."
-parallel <changelists.txt --will-cite -j4 -d'\n' -n1 "p4 describe -s {} | sed -e '1,/Affected files \.\.\./d' | grep '^\.\.\.' | sed -nE -e 's/ [a-z]+$//gp' | sed -nE -e 's/#[0-9]+$//gp' | sed -n -e 's/^\.\.\. //gp'" | sort | uniq >files.txt
-filelogCheckProgressCmd="$(realpath --relative-to="$repoDir" "$myDir/filelogs-export-check-progress.sh")"
-cat <<EOF
-Exporting filelog. This can easily take ten minutes.
-You can check the progress, in another terminal, by running:
-  $filelogCheckProgressCmd
-from the output git repo directory.
-EOF
-parallel <files.txt --will-cite -j8 -d'\n' --keep-order -n1 p4 filelog >filelogs.txt
-
-# Export labels.
-mkdir -p labels/
-labels="$(p4 labels | sed -e 's/^Label //' | sed -e 's/ .*//')"
-i=1
-for label in $labels; do
-  p4 label -o "$label" >"$repoDir/labels/p4-exported-label$i.txt"
-  taggedfiles="$(p4 files "@$label" | sort)"
-  changelist="$(echo "$taggedfiles" | grep -oE "change [0-9]+ \([a-zA-Z+]+\)$" | grep -Eo '[0-9]+' | sort -u | tail -n1)"
-  printf "Changelist:\t%s" "$changelist" >>"$repoDir/labels/p4-exported-label$i.txt"
-  i=$((i + 1))
-done
-cp "$dataDir/labels-extra/"* labels/
-
-# Get rid of the imaginary null-dated initial commit, created by
-# p4-fusion.
-secondCommit="$(git log --format="%H" | tail -n2 | head -n1)"
-git replace --graft "$secondCommit"
-# Our first call to filter-repo will not succeed without force.
-git filter-repo --force
-
-# Tweak commit messages.
-git filter-repo --replace-message "$myDir/message-replacements-changeset-format.txt"
-git filter-repo --replace-message "$dataDir/message-replacements-non-utf8.txt"
-
-git branch --move __p4_export__everything_no_branches
-"$myDir/split-branches.sh"
-
-pdm run "$myDir/make_tags.py" labels/*
-rm -rf "labels/"
-
-pdm run "$myDir/make_merges.py"
-rm changelists.txt files.txt filelogs.txt
-git filter-repo --replace-refs=delete-no-add
-
-branches=$(git for-each-ref refs/heads/ --format="%(refname)" | grep -v -F '__p4_export__everything_no_branches')
-longestBranch="$(echo "$branches" | parallel --will-cite -j1 -n1 "printf '%s ' {} && git rev-list --count {} --" | sort -nr -k2 | head -n1 | sed -E -e 's/ [0-9]+$//')"
-defaultBranch="$longestBranch"
-git symbolic-ref HEAD "$defaultBranch"
-
-git branch -D __p4_export__everything_no_branches
-
-# Delete email addresses for two reasons. First, p4-fusion may have
-# given us placeholder email addresses instead of empty ones, where
-# Perforce does not know the user’s email address. Second, I don’t think
-# it’s fair to put email addresses into a git log without asking: git
-# logs are more likely to be scraped by spammers than an old Perforce
-# depot. Besides, tags do not end up with email addresses, because
-# labels are exported using different commands to commits.
-#
-# So, if you want email addresses, add them to the mailmap.
-git filter-repo --email-callback 'return b""'
-# Convert from Perforce usernames, to full names.
-git filter-repo --mailmap "$dataDir/mailmap.txt"
-
-git gc --prune=now --aggressive
+# If a run fails, running it again carries on from the first stage it
+# had not finished. Each stage can be rerun after failing part way.
+if [ -e "$manifest" ]; then
+  if [ "$(head -n1 "$manifest")" != "mode $mode" ]; then
+    echo >&2 "$repoDir has an unfinished conversion ($(head -n1 "$manifest")): rerun that to finish it"
+    exit 1
+  fi
+else
+  echo "mode $mode" >"$manifest"
+fi
+
+# Each stage, and each step of the Python stages, appends a record of
+# its wall time, the largest peak RSS of its processes, and so on, to
+# stats.jsonl. Kept across runs, so that conversions can be compared.
+export MERGETASTIC_STATS="$stateDir/stats.jsonl"
+
+# Each stage runs in its own bash, under stats.py, which sees the peak
+# RSS of each of the stage's processes. So the stages' functions, and the
+# variables they use, are exported.
+export repoDir mode myDir dataDir stateDir fusionRepoDir
+
+stage() {
+  local name="$1"
+  shift
+  if grep -q -x -F "done $name" "$manifest"; then
+    echo "Skipping stage $name, which an earlier run finished"
+    return
+  fi
+  pdm run "$myDir/stats.py" "$name" bash -eux -o pipefail -c '"$@"' "$name" "$@"
+  echo "done $name" >>"$manifest"
+}
+
+# Where the last conversion got to, before anything changes.
+record_previous() {
+  git for-each-ref --format="%(objectname) %(refname)" refs/heads/ refs/tags/ >"$stateDir/previous-refs"
+  git -C "$fusionRepoDir" rev-parse HEAD >"$stateDir/previous-fusion-head"
+  pdm run "$myDir/commit_index.py" >"$stateDir/previous-changelist"
+}
+
+run_p4_fusion() {
+  p4-fusion --client "$P4CLIENT" --port "$P4PORT" --user "$P4USER" --path //depot/... --lookAhead 1000 --includeBinaries true --src "$fusionRepoDir"
+}
+
+# Export the list of files, and their filelogs, for creating the merges,
+# and the labels, for creating the tags. At most eight p4 commands run
+# at once, so as not to overwhelm the server.
+export_p4() {
+  cd "$stateDir"
+  pdm run "$myDir/export_p4.py" --max-concurrency 8 ${MERGETASTIC_SERVER_TIMEZONE:+--server-timezone "$MERGETASTIC_SERVER_TIMEZONE"} "$@"
+  cp "$dataDir/labels-extra/"* labels/
+  cd "$repoDir"
+}
+
+import_everything() {
+  git fetch --quiet --no-tags "$fusionRepoDir" "+HEAD:refs/heads/__p4_export__everything_no_branches"
+  if [ "$mode" = full ]; then
+    # Get rid of the imaginary null-dated initial commit, created by
+    # p4-fusion. Nothing else needs doing to make this permanent,
+    # because this branch is only read through the graft, by
+    # split_branches.py.
+    secondCommit="$(git log --format="%H" __p4_export__everything_no_branches | tail -n2 | head -n1)"
+    git replace -f --graft "$secondCommit"
+  fi
+}
+
+set_default_branch() {
+  if [ "$mode" != incremental ]; then
+    branches=$(git for-each-ref refs/heads/ --format="%(refname)" | grep -v -F '__p4_export__everything_no_branches')
+    longestBranch="$(echo "$branches" | parallel --will-cite -j1 -n1 "printf '%s ' {} && git rev-list --count {} --" | sort -nr -k2 | head -n1 | sed -E -e 's/ [0-9]+$//')"
+    defaultBranch="$longestBranch"
+    git symbolic-ref HEAD "$defaultBranch"
+  fi
+  # Which a direct conversion never made, but deleting it anyway is fine.
+  git update-ref -d refs/heads/__p4_export__everything_no_branches
+}
+
+# Tweak commit messages, make the merges permanent, and replace email
+# addresses and Perforce usernames with full names. All in one pass over
+# the history.
+rewrite_history() {
+  pdm run "$myDir/rewrite_history.py" \
+    --replace-message "$myDir/message-replacements-changeset-format.txt" \
+    --replace-message "$dataDir/message-replacements-non-utf8.txt" \
+    --mailmap "$dataDir/mailmap.txt" \
+    "$@"
+}
+
+# The history in its final form, in one pass: the same messages and
+# authors as rewrite_history gives, and the same merges as make_merges.
+import_p4() {
+  pdm run "$myDir/import_p4.py" --max-concurrency 8 --jobs "$(nproc)" \
+    ${MERGETASTIC_SERVER_TIMEZONE:+--server-timezone "$MERGETASTIC_SERVER_TIMEZONE"} \
+    --filelogs "$stateDir/filelogs" \
+    --replace-message "$dataDir/message-replacements-non-utf8.txt" \
+    --mailmap "$dataDir/mailmap.txt"
+}
+
+# Existing tags are left alone, so that the stage can be rerun, and so
+# that an incremental conversion only adds the new labels.
+make_tags() {
+  pdm run "$myDir/make_tags.py" --skip-existing "$stateDir/labels/"*
+}
+
+export -f record_previous run_p4_fusion export_p4 import_everything set_default_branch rewrite_history import_p4 make_tags
+
+if [ "$mode" = full ]; then
+  stage p4-fusion run_p4_fusion
+  stage export export_p4
+  stage import import_everything
+  stage split pdm run "$myDir/split_branches.py"
+  stage tags make_tags
+  stage merges pdm run "$myDir/make_merges.py" --jobs "$(nproc)" --filelogs "$stateDir/filelogs"
+  stage default-branch set_default_branch
+  stage rewrite rewrite_history
+  stage gc git gc --prune=now --aggressive
+elif [ "$mode" = direct ]; then
+  stage export export_p4
+  stage import import_p4
+  stage tags make_tags
+  stage default-branch set_default_branch
+  stage gc git gc --prune=now --aggressive
+else
+  stage record record_previous
+  stage p4-fusion run_p4_fusion
+  stage export export_p4 --since "$(cat "$stateDir/previous-changelist")"
+  stage import import_everything
+  stage split pdm run "$myDir/split_branches.py" --since "$(cat "$stateDir/previous-fusion-head")"
+  stage tags make_tags
+  stage merges pdm run "$myDir/make_merges.py" --jobs "$(nproc)" --filelogs "$stateDir/filelogs" --since "$(cat "$stateDir/previous-changelist")"
+  stage default-branch set_default_branch
+  stage rewrite rewrite_history --previous-refs "$stateDir/previous-refs"
+  stage gc git gc --prune=now
+fi
+
+# Its results are kept in the repository, so that after an incremental
+# conversion only what changed is checked again.
+if [ "$verify" = verify ]; then
+  stage verify pdm run "$myDir/verify.py" --max-concurrency 8 --jobs "$(nproc)"
+fi
+
+rm -rf "$stateDir/labels/" "$stateDir/files.txt" "$stateDir/previous-"*
+if [ "$mode" = direct ]; then
+  # Nothing carries on from a direct conversion.
+  rm -rf "$stateDir/filelogs" "$stateDir/filelogs.cache"
+fi
+rm "$manifest"
 
 echo "Finished successfully!"
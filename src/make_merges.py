@@ -15,91 +15,201 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import argparse
+import concurrent.futures
+import functools
+import gc
 import itertools
-import re
+import multiprocessing
+import sys
+from array import array
 from collections import defaultdict
-from dataclasses import dataclass
+from collections.abc import Callable, Iterator
 from pathlib import PurePosixPath
-from typing import NewType, Optional
+from typing import Iterable, Optional, TypeVar
 
 import more_itertools
-import networkx as nx
 
 from branchmap import get_branch_for_path
-from git import Branch, git
-from p4.filelog import ChangeList, ChangedFile, get_path_to_changed_file
-
-GitHash = NewType("GitHash", str)
-
-
-@dataclass(frozen=True)
-class Commit:
-    changelist: ChangeList
-    branch: Branch
-    hash: GitHash
-
-    def __str__(self):
-        return f"{self.changelist} {self.branch}"
-
-
-def get_branches() -> list[Branch]:
-    branches = [
-        Branch(branch.replace("*", "").strip())
-        for branch in git(["branch", "--list"]).splitlines()
-    ]
-    return [
-        branch for branch in branches if branch != "__p4_export__everything_no_branches"
-    ]
-
-
-def get_branch_to_commits(branches: list[Branch]) -> dict[Branch, set[Commit]]:
-    branch_to_commits: dict[Branch, set[Commit]] = dict()
-    for branch in branches:
-        commits = set()
-        lines = git(
-            ["log", "--reverse", "--format=%H%n%w(9999,1,1)%b", branch, "--"]
-        ).split("\n")
-        lines = [line for line in lines if line != ""]
-        chunks = more_itertools.split_before(
-            lines, lambda line: not line.startswith(" ")
-        )
-        for chunk in chunks:
-            hash = GitHash(chunk[0])
-            changelist = None
-            for line in chunk:
-                match = re.match(" P4:([0-9]+)$", line)
-                if match:
-                    changelist = ChangeList(int(match.group(1)))
-                    break
-            if changelist is None:
-                raise Exception(
-                    f"""unknown p4 changeset for git hash {hash} in branch {branch}.
-
-chunks: {chunk}"""
-                )
-            commit = Commit(changelist=changelist, branch=branch, hash=hash)
-            commits.add(commit)
-        branch_to_commits[branch] = commits
-    return branch_to_commits
+from commit_graph import CommitGraph
+from commit_index import Commit, CommitIndex, get_commit_index, read_commit_index
+from dependency_store import DependencyStore
+from git import Branch, CatFile, replace_grafts
+from p4.filelog import (
+    ChangeList,
+    ChangedFile,
+    FileVersion,
+    clear_caches,
+    get_path_to_changed_file,
+    iter_changed_files,
+    iter_changelists,
+    iter_integration_sources,
+)
+from stats import Step
+
+T = TypeVar("T")
+
+ChangeListIndex = dict[tuple[PurePosixPath, FileVersion], ChangeList]
+
+# With --store, the grafts are replaced this many at a time, so as not
+# to hold all of them at once.
+_REPLACE_BATCH_SIZE = 10000
+
+# With --store, how many revisions or files to read from the filelog
+# between clearing its parser's caches.
+_CLEAR_CACHES_EVERY = 10000
+
+
+def get_changelist_index(changed_files: Iterable[ChangedFile]) -> ChangeListIndex:
+    changelist_index: ChangeListIndex = {}
+    for changed_file in changed_files:
+        for file_change in changed_file.file_changes:
+            key = (changed_file.path, file_change.version)
+            if key in changelist_index:
+                raise Exception(f"duplicate file version: {key}")
+            changelist_index[key] = file_change.changelist
+    return changelist_index
+
+
+def get_changelist_index_for_sources(filename: str) -> ChangeListIndex:
+    # Only the sources of integrations need looking up, so when
+    # streaming the filelog we index just those.
+    sources = set(iter_integration_sources(filename))
+    return {
+        (path, version): changelist
+        for path, version, changelist in iter_changelists(filename)
+        if (path, version) in sources
+    }
 
 
 def get_commit_to_deps(
-    path_to_changed_file: dict[PurePosixPath, ChangedFile],
+    changed_files: Iterable[ChangedFile],
+    changelist_index: ChangeListIndex,
     branch_to_commits: dict[Branch, set[Commit]],
+    *,
+    jobs: int = 1,
+    step: Optional[Step] = None,
 ) -> defaultdict[Commit, set[Commit]]:
+    # The changed files need only be iterable once, which lets them be
+    # streamed from the filelog. Finding the source of an integration
+    # instead needs random access, which is what the changelist index
+    # is for. (Scanning the history of the source file would be
+    # quadratic, for heavily integrated files.) With more than one job,
+    # they are all held at once anyway, and split between processes.
+    if jobs > 1:
+        return _get_commit_to_deps_parallel(
+            list(changed_files), changelist_index, branch_to_commits, jobs, step
+        )
+    if step is not None:
+        changed_files = step.track(changed_files)
     commit_lookup_table = dict(
         ((commit.changelist, branch), commit)
         for (branch, commits) in branch_to_commits.items()
         for commit in commits
     )
 
+    def find_changelist(path: PurePosixPath, version: FileVersion) -> ChangeList:
+        return changelist_index[(path, version)]
+
     def find_commit(changelist: ChangeList, branch: Branch) -> Optional[Commit]:
         return commit_lookup_table.get((changelist, branch))
 
     commit_to_deps = defaultdict[Commit, set[Commit]](set)
-    for changed_file in path_to_changed_file.values():
+    for commit, dep_commit in iter_dependencies(
+        changed_files, find_changelist, find_commit
+    ):
+        commit_to_deps[commit].add(dep_commit)
+    return commit_to_deps
+
+
+# What _get_commit_to_deps_parallel shares with its workers: the changed
+# files, the changelist index, and each commit's id by changelist and
+# branch. The workers are forked, so they inherit these, rather than
+# each being sent a copy, and only ever read them.
+_shared: Optional[
+    tuple[list[ChangedFile], ChangeListIndex, dict[tuple[ChangeList, Branch], int]]
+] = None
+
+
+def _find_deps_in_shard(start: int, end: int) -> "array[int]":
+    # The dependencies of changed files [start, end), as pairs of commit
+    # ids in one flat array: each pair only once, in the order found, as
+    # that is all get_commit_to_deps keeps of them.
+    assert _shared is not None
+    changed_files, changelist_index, commit_ids = _shared
+    pairs = dict.fromkeys(
+        iter_dependencies(
+            changed_files[start:end],
+            lambda path, version: changelist_index[(path, version)],
+            lambda changelist, branch: commit_ids.get((changelist, branch)),
+        )
+    )
+    return array("l", itertools.chain.from_iterable(pairs))
+
+
+def _get_commit_to_deps_parallel(
+    changed_files: list[ChangedFile],
+    changelist_index: ChangeListIndex,
+    branch_to_commits: dict[Branch, set[Commit]],
+    jobs: int,
+    step: Optional[Step],
+) -> defaultdict[Commit, set[Commit]]:
+    # Every file's revisions can be looked at independently, so the
+    # files are split into shards, for a pool of processes. The shards'
+    # dependencies are added in the order of the files, just as without
+    # the pool: so the result is the same, even in the order of its
+    # commits and their sets, whatever the number of jobs.
+    global _shared
+    commits = [commit for commits in branch_to_commits.values() for commit in commits]
+    commit_ids = {
+        (commit.changelist, commit.branch): commit_id
+        for commit_id, commit in enumerate(commits)
+    }
+    # More shards than jobs, so that all of them keep busy until the end.
+    num_shards = max(1, min(len(changed_files), jobs * 8))
+    bounds = [len(changed_files) * i // num_shards for i in range(num_shards + 1)]
+    _shared = (changed_files, changelist_index, commit_ids)
+    # Otherwise the collector, in each worker, would write to every one
+    # of the shared objects, and so copy the pages they are in.
+    gc.freeze()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            futures = [
+                executor.submit(_find_deps_in_shard, start, end)
+                for start, end in itertools.pairwise(bounds)
+            ]
+            commit_to_deps = defaultdict[Commit, set[Commit]](set)
+            for (start, end), future in zip(itertools.pairwise(bounds), futures):
+                pairs = future.result()
+                for i in range(0, len(pairs), 2):
+                    commit_to_deps[commits[pairs[i]]].add(commits[pairs[i + 1]])
+                if step is not None:
+                    step.advance(end - start)
+    finally:
+        _shared = None
+        gc.unfreeze()
+    return commit_to_deps
+
+
+def iter_dependencies(
+    changed_files: Iterable[ChangedFile],
+    find_changelist: Callable[[PurePosixPath, FileVersion], ChangeList],
+    find_commit: Callable[[ChangeList, Branch], Optional[T]],
+) -> Iterator[tuple[T, T]]:
+    # Each commit, and a commit on which it depends, as often as the
+    # filelog says so. The commits are whatever find_commit gives: the
+    # Commit itself, or its id in a DependencyStore.
+    #
+    # Each revision is looked up once as a target, and again each time
+    # it is the source of an integration. The cache is bounded so that
+    # memory does not grow with the size of the filelog.
+    branch_for_path = functools.lru_cache(maxsize=1 << 16)(get_branch_for_path)
+
+    for changed_file in changed_files:
         for file_change in changed_file.file_changes:
-            branch = get_branch_for_path(changed_file.path, file_change.changelist)
+            branch = branch_for_path(changed_file.path, file_change.changelist)
             if branch is None:
                 continue
             commit = find_commit(file_change.changelist, branch)
@@ -110,28 +220,22 @@ def get_commit_to_deps(
                 continue
             for sub_change in file_change.sub_changes:
                 match sub_change.action:
-                    case "branch from" | "copy from" | "delete from" | "edit from" | "merge from":
+                    case (
+                        "branch from"
+                        | "copy from"
+                        | "delete from"
+                        | "edit from"
+                        | "merge from"
+                    ):
                         file_version = max(sub_change.path_revs)
-                        dep_file_change = more_itertools.one(
-                            [
-                                file_change
-                                for file_change in path_to_changed_file[
-                                    sub_change.path
-                                ].file_changes
-                                if file_change.version == file_version
-                            ]
-                        )
-                        dep_branch = get_branch_for_path(
-                            sub_change.path, dep_file_change.changelist
-                        )
+                        dep_changelist = find_changelist(sub_change.path, file_version)
+                        dep_branch = branch_for_path(sub_change.path, dep_changelist)
                         if dep_branch is not None:
-                            dep_commit = find_commit(
-                                dep_file_change.changelist, dep_branch
-                            )
+                            dep_commit = find_commit(dep_changelist, dep_branch)
                             if dep_commit is None:
                                 # Required check, as above.
                                 continue
-                            commit_to_deps[commit].add(dep_commit)
+                            yield commit, dep_commit
                     case "ignored":
                         # This could have been called "ignored from".
                         #
@@ -152,7 +256,13 @@ def get_commit_to_deps(
                         # ignores turned out to be the better decision,
                         # at least for that example.
                         pass
-                    case "branch into" | "copy into" | "delete into" | "edit into" | "merge into":
+                    case (
+                        "branch into"
+                        | "copy into"
+                        | "delete into"
+                        | "edit into"
+                        | "merge into"
+                    ):
                         # We look at the from side, which means the into
                         # side doesn’t tell us anything new.
                         pass
@@ -169,27 +279,26 @@ def get_commit_to_deps(
                         # This could have been called "ignored into". We
                         # don’t look at this, just like the other intos.
                         pass
-    return commit_to_deps
 
 
-def main() -> None:
-    path_to_changed_file: dict[PurePosixPath, ChangedFile] = get_path_to_changed_file()
-    branches: list[Branch] = get_branches()
-    branch_to_commits: dict[Branch, set[Commit]] = get_branch_to_commits(branches)
-    # We start off with each branch's boring linear history.
-    G = nx.DiGraph()
-    for branch in branches:
+def get_grafts(
+    branch_to_commits: dict[Branch, set[Commit]],
+    commit_to_deps: defaultdict[Commit, set[Commit]],
+    since: Optional[ChangeList] = None,
+) -> dict[Commit, list[Commit]]:
+    # The parents of each commit which needs a graft. We start off with
+    # each branch's boring linear history.
+    graph = CommitGraph()
+    for branch in branch_to_commits:
         commits = sorted(
             branch_to_commits[branch], key=lambda commit: commit.changelist
         )
-        G.add_nodes_from(commits)
-        G.add_edges_from(itertools.pairwise(commits))
-    # Now we look at dependencies of each commit, as calculated from the
-    # Perforce actions.
-    commit_to_deps: defaultdict[Commit, set[Commit]] = get_commit_to_deps(
-        path_to_changed_file, branch_to_commits
-    )
-    # We will make a couple simplifications.
+        for commit in commits:
+            graph.add_commit(commit)
+        for parent, child in itertools.pairwise(commits):
+            graph.add_edge(parent, child)
+    # Then we add the dependencies of each commit, as calculated from
+    # the Perforce actions. We will make a couple simplifications.
     for commit, all_deps in commit_to_deps.items():
         # IMHO the commit graph would be unhelpfully complex if we
         # considered in-branch actions as merges. We especially see this
@@ -208,22 +317,230 @@ def main() -> None:
             # dependency, as opposed to all of them. This is just to
             # avoid overcomplicating the git commit graph.
             latest_dep = max(deps_in_branch, key=lambda commit: commit.changelist)
-            G.add_edge(latest_dep, commit)
-    assert nx.is_directed_acyclic_graph(G)
+            graph.add_edge(latest_dep, commit)
     branch_starts = set(
         min(commits, key=lambda commit: commit.changelist)
         for commits in branch_to_commits.values()
     )
-    # Rewrite parents (to get merges)
-    H = G.reverse()
-    for cmt in nx.topological_sort(H):
-        adj = H.adj[cmt]
-        if len(adj) > 1 or cmt in branch_starts:
-            new_parents = [a.hash for a in adj]
-            # Somebody will need to call git filter-repo, to make these
-            # replacements permanent.
-            git(["replace", "--graft", cmt.hash] + new_parents)
+    # Rewrite parents (to get merges). Also checks there is no cycle.
+    grafts: dict[Commit, list[Commit]] = {}
+    for commit_id in graph.topological_order():
+        cmt = graph.commits[commit_id]
+        if since is not None and cmt.changelist <= since:
+            continue
+        parents = graph.get_parents(commit_id)
+        if len(parents) > 1 or cmt in branch_starts:
+            grafts[cmt] = [graph.commits[parent] for parent in parents]
+    return grafts
+
+
+# A plan is one line per graft: the commit, and then its new parents,
+# as for the old .git/info/grafts. A comment after each says which
+# changelists and branches those are, so that plans can be compared by
+# eye, say between two versions of the branchmap rules. The lines are in
+# order of changelist, and then branch, as get_sorted_grafts gives them.
+def write_plan(filename: str, grafts: Iterable[tuple[Commit, list[Commit]]]) -> None:
+    with open(filename, "wt", encoding="utf-8") as f:
+        for commit, parents in grafts:
+            hashes = " ".join([commit.hash] + [parent.hash for parent in parents])
+            sources = ", ".join(str(parent) for parent in parents)
+            f.write(f"{hashes}\t# {commit} <- {sources}".rstrip() + "\n")
+
+
+def get_sorted_grafts(
+    grafts: dict[Commit, list[Commit]]
+) -> list[tuple[Commit, list[Commit]]]:
+    return sorted(grafts.items(), key=lambda item: (item[0].changelist, item[0].branch))
+
+
+def read_plan(filename: str) -> dict[str, list[str]]:
+    grafts = {}
+    with open(filename, "rt", encoding="utf-8") as f:
+        for line in f:
+            hashes = line.partition("#")[0].split()
+            if hashes:
+                grafts[hashes[0]] = hashes[1:]
+    return grafts
+
+
+def _get_commit_index(filename: Optional[str]) -> CommitIndex:
+    if filename is not None:
+        return read_commit_index(filename)
+    return get_commit_index()
+
+
+def _clearing_caches(items: Iterable[T]) -> Iterator[T]:
+    # The items, streamed from the filelog, without the parser's caches
+    # growing with it.
+    for i, item in enumerate(items, start=1):
+        yield item
+        if i % _CLEAR_CACHES_EVERY == 0:
+            clear_caches()
+    clear_caches()
+
+
+def _make_merges_with_store(options: argparse.Namespace) -> None:
+    # As main does otherwise, but with the revisions, the commits and
+    # their dependencies in a DependencyStore rather than in memory. The
+    # filelog is streamed, as with --streaming, and so are the grafts.
+    with DependencyStore(options.store, cache_size=options.cache_size) as store:
+        with Step("index changelists", unit="revisions") as step:
+            step.advance(
+                store.add_revisions(
+                    _clearing_caches(iter_changelists(options.filelogs))
+                )
+            )
+        with Step("index commits", unit="commits") as step:
+            step.advance(store.add_commits(_get_commit_index(options.commit_index)))
+            # Which get_commit_index would otherwise keep hold of.
+            get_commit_index.cache_clear()
+        with Step("find dependencies", unit="files") as step:
+            store.add_dependencies(
+                iter_dependencies(
+                    step.track(_clearing_caches(iter_changed_files(options.filelogs))),
+                    store.find_changelist,
+                    store.find_commit,
+                )
+            )
+        # Working out the grafts is interleaved with writing them out, so
+        # the one step times both.
+        grafts = store.iter_grafts(options.since)
+        if options.plan is not None:
+            with Step("work out grafts", unit="grafts") as step:
+                write_plan(options.plan, step.track(grafts))
+            return
+        with Step("replace commits", unit="grafts") as step, CatFile() as cat_file:
+            for batch in more_itertools.chunked(grafts, _REPLACE_BATCH_SIZE):
+                replace_grafts(
+                    {
+                        commit.hash: [parent.hash for parent in parents]
+                        for commit, parents in batch
+                    },
+                    cat_file,
+                )
+                step.advance(len(batch))
+
+
+def main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Graft merges onto the branches, from the filelogs."
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--plan",
+        metavar="FILE",
+        help="write the grafts to FILE, rather than making them",
+    )
+    mode.add_argument(
+        "--apply",
+        metavar="FILE",
+        help="make the grafts planned in FILE, rather than working them out",
+    )
+    parser.add_argument(
+        "--filelogs",
+        default="filelogs",
+        help="the filelog, or a directory of shards from export_filelogs.py",
+    )
+    parse_mode = parser.add_mutually_exclusive_group()
+    parse_mode.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes with which to parse the filelogs, and find"
+        " the dependencies between commits",
+    )
+    parse_mode.add_argument(
+        "--streaming",
+        action="store_true",
+        help="stream the filelogs, rather than holding all of them in memory",
+    )
+    parse_mode.add_argument(
+        "--store",
+        metavar="DIR",
+        help="keep the filelogs' revisions, the commits, and their dependencies,"
+        " in an SQLite database in DIR, rather than in memory, for depots too"
+        " large for that",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        metavar="MIB",
+        help="with --store, the memory for the database's cache, in MiB",
+    )
+    parser.add_argument(
+        "--since",
+        type=int,
+        metavar="CHANGELIST",
+        help="only graft the commits after this changelist, for an incremental"
+        " conversion: the older commits already have their merges",
+    )
+    parser.add_argument(
+        "--commit-index",
+        metavar="FILE",
+        help="read the commit index from FILE, as saved in the git directory,"
+        " rather than from the branches",
+    )
+    options = parser.parse_args(args)
+    if options.apply is not None:
+        with Step("replace commits", unit="grafts") as step, CatFile() as cat_file:
+            plan = read_plan(options.apply)
+            replace_grafts(plan, cat_file)
+            step.advance(len(plan))
+        return
+    if options.store is not None:
+        _make_merges_with_store(options)
+        return
+    filename = options.filelogs
+    changed_files: Iterable[ChangedFile]
+    num_files: Optional[int] = None
+    if options.streaming:
+        with Step("index integration sources", unit="revisions") as step:
+            changelist_index = get_changelist_index_for_sources(filename)
+            step.advance(len(changelist_index))
+        changed_files = iter_changed_files(filename)
+    else:
+        with Step("parse filelogs", unit="files") as step:
+            path_to_changed_file = get_path_to_changed_file(filename, jobs=options.jobs)
+            step.advance(len(path_to_changed_file))
+        with Step("index changelists", unit="revisions") as step:
+            changelist_index = get_changelist_index(path_to_changed_file.values())
+            step.advance(len(changelist_index))
+        changed_files = path_to_changed_file.values()
+        num_files = len(path_to_changed_file)
+    with Step("index commits", unit="commits") as step:
+        commit_index = _get_commit_index(options.commit_index)
+        step.advance(sum(len(commits) for commits in commit_index.values()))
+    branch_to_commits: dict[Branch, set[Commit]] = {
+        branch: set(commits) for branch, commits in commit_index.items()
+    }
+    with Step("find dependencies", total=num_files, unit="files") as step:
+        commit_to_deps: defaultdict[Commit, set[Commit]] = get_commit_to_deps(
+            changed_files,
+            changelist_index,
+            branch_to_commits,
+            jobs=options.jobs,
+            step=step,
+        )
+    with Step("work out grafts", unit="grafts") as step:
+        grafts = get_grafts(branch_to_commits, commit_to_deps, options.since)
+        step.advance(len(grafts))
+    if options.plan is not None:
+        write_plan(options.plan, get_sorted_grafts(grafts))
+        return
+    # Somebody will need to call git filter-repo, to make these
+    # replacements permanent.
+    with Step("replace commits", unit="grafts") as step, CatFile() as cat_file:
+        replace_grafts(
+            {
+                commit.hash: [parent.hash for parent in parents]
+                for commit, parents in grafts.items()
+            },
+            cat_file,
+        )
+        step.advance(len(grafts))
 
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv[1:])
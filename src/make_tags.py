@@ -15,6 +15,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import argparse
+import calendar
 import datetime
 import itertools
 import sys
@@ -25,8 +27,10 @@ from typing import Iterable
 import more_itertools
 from branchmap import get_branch_for_path
 
-from git import git
+from commit_index import find_commits
+from git import git, update_refs, write_objects
 from p4.filelog import ChangeList
+from stats import Step
 
 
 @dataclass
@@ -71,39 +75,97 @@ def parse_label(lines: list[str]) -> Label:
     return Label(label, update, owner, description, view, changelist)
 
 
-def create_git_tag(lbl: Label) -> None:
-    changelist_pattern = f"^P4:{lbl.changelist}$"
+def read_label(filename: str) -> Label:
+    with open(filename, "rt") as f:
+        return parse_label([line.rstrip("\n") for line in f])
+
+
+def _clean_message(message: str) -> str:
+    # As git tag does, by default: drop comments and trailing
+    # whitespace, and blank lines at the start and end, and squash runs
+    # of blank lines into one.
+    lines: list[str] = []
+    num_blank_lines = 0
+    for line in message.split("\n"):
+        if line.startswith("#"):
+            continue
+        line = line.rstrip(" \t\r")
+        if line == "":
+            num_blank_lines += 1
+            continue
+        if num_blank_lines > 0 and lines:
+            lines.append("")
+        num_blank_lines = 0
+        lines.append(line)
+    return "".join(f"{line}\n" for line in lines)
+
+
+def _ident_name(name: str) -> str:
+    # As git does to names in identities.
+    name = name.replace("<", "").replace(">", "").replace("\n", "")
+    return name.strip("".join(map(chr, range(33))) + ".,:;<>\"\\'")
+
+
+def _git_date(when: datetime.datetime) -> str:
+    # A date without a timezone, as given to git, is in local time.
+    timestamp = int(when.timestamp())
+    offset = (calendar.timegm(when.timetuple()) - timestamp) // 60
+    sign = "-" if offset < 0 else "+"
+    return f"{timestamp} {sign}{abs(offset) // 60:02}{abs(offset) % 60:02}"
+
+
+def make_git_tag(lbl: Label) -> bytes:
+    # The tag object which git tag would make, with the label's owner as
+    # the tagger.
     branches = {
         get_branch_for_path(view_path, lbl.changelist) for view_path in lbl.view
     }
     branch = more_itertools.one(branches)
-    tag_name = lbl.label
-    commits = git(
-        ["log", f"--grep={changelist_pattern}", "--format=%H", branch, "--"]
-    ).splitlines()
-    commit = more_itertools.one(commits)
-    env = {
-        "GIT_COMMITTER_DATE": lbl.update.strftime("%Y-%m-%d %H:%M:%S"),
-        "GIT_COMMITTER_NAME": lbl.owner,
-        "GIT_COMMITTER_EMAIL": "",
-    }
-    git(
-        ["tag", "--file=-", tag_name, commit],
-        input=lbl.description.encode("utf-8"),
-        env=env,
+    if branch is None:
+        raise Exception(f"label {lbl.label} is not on any branch")
+    commit = more_itertools.one(find_commits(lbl.changelist, branch)).hash
+    tag = (
+        f"object {commit}\n"
+        "type commit\n"
+        f"tag {lbl.label}\n"
+        f"tagger {_ident_name(lbl.owner)} <> {_git_date(lbl.update)}\n"
+        "\n"
+        f"{_clean_message(lbl.description)}"
     )
-
-
-def process_spec(lines: list[str]) -> None:
-    label: Label = parse_label(lines)
-    create_git_tag(label)
+    return tag.encode("utf-8")
 
 
 def main(args: list[str]) -> None:
-    filenames = args
-    for filename in filenames:
-        with open(filename, "rt") as f:
-            process_spec([line.rstrip("\n") for line in f])
+    parser = argparse.ArgumentParser(
+        description="Make an annotated tag from each exported label."
+    )
+    parser.add_argument("filenames", metavar="LABEL_FILE", nargs="*")
+    parser.add_argument(
+        "--skip-existing",
+        action="store_true",
+        help="leave alone the labels which already have tags, for an"
+        " incremental conversion",
+    )
+    options = parser.parse_args(args)
+    existing_tags = set()
+    if options.skip_existing:
+        existing_tags = set(
+            git(["for-each-ref", "--format=%(refname:strip=2)", "refs/tags/"]).split()
+        )
+    labels = []
+    with Step("read labels", total=len(options.filenames), unit="labels") as step:
+        for filename in step.track(options.filenames):
+            lbl = read_label(filename)
+            if lbl.label not in existing_tags:
+                labels.append(lbl)
+    # We used to run git tag for each label. Instead we write every tag
+    # object with one git hash-object, which checks them just as git
+    # mktag would, and then create all of the refs at once.
+    with Step("make tags", total=len(labels), unit="tags") as step:
+        tags = write_objects("tag", [make_git_tag(lbl) for lbl in step.track(labels)])
+        update_refs(
+            [f"create refs/tags/{lbl.label} {tag}" for lbl, tag in zip(labels, tags)]
+        )
 
 
 if __name__ == "__main__":
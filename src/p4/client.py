@@ -0,0 +1,539 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Everything we ask of the Perforce server goes through here, so that
+# the whole export shares the one budget: how many p4 commands run at
+# once, and how many start each second. The server is shared with
+# other people, so we would rather be slow than be a nuisance.
+#
+# The number of commands at once adapts, like TCP's congestion window.
+# Each success lets a little more run at once, up to the maximum, while
+# each transient error (the server dropping or refusing connections)
+# halves it. The command which failed is then retried, after a backoff.
+
+import argparse
+import asyncio
+import datetime
+import io
+import marshal
+import random
+import re
+import shlex
+import time
+import zoneinfo
+from collections.abc import AsyncIterator, Sequence
+from dataclasses import dataclass
+from typing import Optional, final
+
+from p4.filelog import ChangedFile, ChangeList, FileVersion
+from stats import count_subprocess
+
+# p4 -G writes each record of its output as a marshalled dict. Far less
+# fragile than scraping the text output, which was written for people to
+# read.
+Record = dict[bytes, bytes]
+
+# Messages from p4 which mean the server, or the network to it, had a
+# moment, so that the same command might well work if we try again.
+_TRANSIENT_ERRORS = re.compile(
+    "|".join(
+        [
+            "Connect to server failed",
+            "TCP (connect|receive|send) (to .* )?failed",
+            "Partner exited unexpectedly",
+            "Connection (reset|refused|timed out)",
+            "Resource temporarily unavailable",
+            "Too many (open files|connections)",
+            "Server (is )?busy",
+        ]
+    ),
+    re.IGNORECASE,
+)
+
+# Warnings from p4 which only mean that a file spec matched no files.
+_NO_FILES = re.compile(
+    r" - (no such file\(s\)|file\(s\) not in label|no file\(s\) at that changelist"
+    r" number)\.$"
+)
+
+
+class TransientError(Exception):
+    pass
+
+
+def _decode(value: bytes) -> str:
+    # Depot paths, and descriptions, need not be UTF-8. Any other bytes
+    # are kept, so that paths can be given back to p4 unchanged.
+    return value.decode("utf-8", errors="surrogateescape")
+
+
+@final
+@dataclass(frozen=True)
+class FileRevision:
+    path: str
+    version: FileVersion
+    changelist: ChangeList
+    action: str
+
+
+@final
+@dataclass(frozen=True)
+class Change:
+    changelist: ChangeList
+    user: str
+    client: str
+    # Seconds since the epoch.
+    time: int
+    # As submitted, which need not be UTF-8.
+    description: bytes
+
+
+@final
+@dataclass(frozen=True)
+class FileDigest:
+    path: str
+    version: FileVersion
+    changelist: ChangeList
+    action: str
+    type: str
+    # The MD5 of the contents, in upper case hex, and their size. The
+    # server only has these for files which are not deleted.
+    digest: Optional[str]
+    size: Optional[int]
+
+
+@final
+class AdaptiveLimit:
+    def __init__(self, maximum: int, *, commands_per_second: Optional[float] = None):
+        self.maximum = maximum
+        self.limit = float(min(maximum, 4))
+        self.running = 0
+        self.interval = 0.0 if commands_per_second is None else 1 / commands_per_second
+        self.next_start = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.running < int(self.limit))
+            self.running += 1
+            # Space out the starts, for the rate limit.
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def release(self, *, succeeded: Optional[bool]) -> None:
+        async with self.condition:
+            self.running -= 1
+            if succeeded is True:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif succeeded is False:
+                self.limit = max(1.0, self.limit / 2)
+            self.condition.notify_all()
+
+
+@final
+class Client:
+    def __init__(
+        self,
+        p4: Sequence[str] = ("p4",),
+        *,
+        max_concurrency: int = 8,
+        commands_per_second: Optional[float] = None,
+        retries: int = 5,
+        backoff: float = 1.0,
+        server_timezone: Optional[str] = None,
+    ):
+        # p4 is the command to run p4, for example a fake p4 for testing.
+        # server_timezone is the server's timezone, such as
+        # "America/Los_Angeles", if it is not to be guessed.
+        self.p4 = p4
+        self.server_timezone = server_timezone
+        self.limit = AdaptiveLimit(
+            max_concurrency, commands_per_second=commands_per_second
+        )
+        self.retries = retries
+        self.backoff = backoff
+        self.num_commands = 0
+
+    async def iter_run(
+        self,
+        args: list[str],
+        *,
+        input: Optional[bytes] = None,
+        allow_empty: bool = False,
+    ) -> AsyncIterator[Record]:
+        # Yields each record of p4 -G as it arrives, so that even the
+        # biggest outputs need not fit in memory. A command is only
+        # retried if it failed before giving us any records.
+        for attempt in range(self.retries + 1):
+            num_records = 0
+            try:
+                async for record in self._iter_run_once(args, input, allow_empty):
+                    num_records += 1
+                    yield record
+                return
+            except TransientError:
+                if num_records > 0 or attempt == self.retries:
+                    raise
+            # Exponential backoff, with jitter so that the retries of
+            # commands which failed together do not all come back
+            # together.
+            await asyncio.sleep(self.backoff * 2**attempt * random.uniform(0.5, 1.5))
+
+    async def run(
+        self,
+        args: list[str],
+        *,
+        input: Optional[bytes] = None,
+        allow_empty: bool = False,
+    ) -> list[Record]:
+        # allow_empty is for when a file spec matching no files is fine,
+        # rather than an error.
+        return [
+            record
+            async for record in self.iter_run(
+                args, input=input, allow_empty=allow_empty
+            )
+        ]
+
+    async def _iter_run_once(
+        self, args: list[str], input: Optional[bytes], allow_empty: bool
+    ) -> AsyncIterator[Record]:
+        await self.limit.acquire()
+        # None for failures which say nothing about the server's load.
+        succeeded: Optional[bool] = None
+        try:
+            self.num_commands += 1
+            count_subprocess()
+            proc = await asyncio.create_subprocess_exec(
+                *self.p4,
+                "-G",
+                *args,
+                stdin=asyncio.subprocess.DEVNULL
+                if input is None
+                else asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            assert proc.stdout is not None and proc.stderr is not None
+            try:
+                # Written alongside reading the output, in case p4
+                # answers before it has read all of its input.
+                writer = asyncio.create_task(_write_input(proc, input))
+                stderr = asyncio.create_task(proc.stderr.read())
+                async for record in _read_records(proc.stdout):
+                    if record.get(b"code") == b"error":
+                        message = _decode(record[b"data"]).strip()
+                        _check_transient(args, message)
+                        if allow_empty and _NO_FILES.search(message):
+                            continue
+                    check_records(args, [record])
+                    yield record
+                await writer
+                returncode = await proc.wait()
+                message = _decode(await stderr).strip()
+            except BaseException:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+            if returncode != 0:
+                _check_transient(args, message)
+                raise Exception(
+                    f"p4 {' '.join(args)} failed with status {returncode}: {message}"
+                )
+            succeeded = True
+        except TransientError:
+            succeeded = False
+            raise
+        finally:
+            await self.limit.release(succeeded=succeeded)
+
+    async def get_server_timezone(self) -> datetime.tzinfo:
+        # The text output of p4 gives dates in the server's timezone,
+        # but -G gives seconds since the epoch. The server date looks
+        # like "2023/07/01 10:00:00 -0700 PDT". Its offset is only the
+        # one in force now, whereas each time needs the offset in force
+        # then, so we need the timezone itself.
+        [info] = await self.run(["info"])
+        date, time, offset, abbreviation = (
+            info[b"serverDate"].decode("utf-8").split(" ", 3)
+        )
+        now = datetime.datetime.strptime(
+            f"{date} {time} {offset}", "%Y/%m/%d %H:%M:%S %z"
+        )
+        if self.server_timezone is not None:
+            tz = zoneinfo.ZoneInfo(self.server_timezone)
+            if now.astimezone(tz).utcoffset() != now.utcoffset():
+                raise Exception(
+                    f"the server's date is {now}, whose offset from UTC is not"
+                    f" that of {self.server_timezone}"
+                )
+            return tz
+        return _guess_timezone(now, abbreviation)
+
+    async def changes(self, file_spec: str = "//depot/...") -> list[ChangeList]:
+        # The submitted changelists, oldest first.
+        records = await self.run(["changes", "-s", "submitted", file_spec])
+        return sorted(ChangeList(int(record[b"change"])) for record in records)
+
+    async def change_details(self, file_spec: str = "//depot/...") -> list[Change]:
+        # The submitted changelists, oldest first, with their whole
+        # descriptions.
+        records = await self.run(["changes", "-l", "-s", "submitted", file_spec])
+        changes = [
+            Change(
+                ChangeList(int(record[b"change"])),
+                _decode(record[b"user"]),
+                _decode(record[b"client"]),
+                int(record[b"time"]),
+                record[b"desc"],
+            )
+            for record in records
+        ]
+        return sorted(changes, key=lambda change: change.changelist)
+
+    async def describe(self, changelist: ChangeList) -> list[FileRevision]:
+        # The files which the changelist changed.
+        [record] = await self.run(["describe", "-s", str(changelist)])
+        revisions = []
+        i = 0
+        while f"depotFile{i}".encode("utf-8") in record:
+            revisions.append(
+                FileRevision(
+                    _decode(record[f"depotFile{i}".encode("utf-8")]),
+                    FileVersion(int(record[f"rev{i}".encode("utf-8")])),
+                    changelist,
+                    _decode(record[f"action{i}".encode("utf-8")]),
+                )
+            )
+            i += 1
+        return revisions
+
+    async def iter_files(
+        self, file_spec: str, *, all_revisions: bool = False, allow_empty: bool = False
+    ) -> AsyncIterator[FileRevision]:
+        args = ["files", "-a", file_spec] if all_revisions else ["files", file_spec]
+        async for record in self.iter_run(args, allow_empty=allow_empty):
+            yield FileRevision(
+                _decode(record[b"depotFile"]),
+                FileVersion(int(record[b"rev"])),
+                ChangeList(int(record[b"change"])),
+                _decode(record[b"action"]),
+            )
+
+    async def filelog(self, paths: list[str], tz: datetime.tzinfo) -> list[ChangedFile]:
+        # -x - reads the paths from stdin, sparing us any limit on the
+        # length of the command line. -b stops p4 splitting the batch
+        # into several commands.
+        records = await self.run(
+            ["-x", "-", "-b", str(len(paths)), "filelog"],
+            input="".join(f"{path}\n" for path in paths).encode(
+                "utf-8", errors="surrogateescape"
+            ),
+        )
+        return [ChangedFile.from_tagged(record, tz) for record in records]
+
+    async def print_files(
+        self, file_specs: list[str]
+    ) -> AsyncIterator[tuple[str, FileVersion, bytes]]:
+        # The contents of each file, such as //depot/file#3. p4 -G print
+        # gives a record saying which file and revision, followed by the
+        # contents, in chunks.
+        path: Optional[str] = None
+        version = FileVersion(0)
+        chunks: list[bytes] = []
+        async for record in self.iter_run(
+            ["-x", "-", "-b", str(len(file_specs)), "print"],
+            input="".join(f"{file_spec}\n" for file_spec in file_specs).encode(
+                "utf-8", errors="surrogateescape"
+            ),
+        ):
+            if record[b"code"] == b"stat":
+                if path is not None:
+                    yield path, version, b"".join(chunks)
+                path = _decode(record[b"depotFile"])
+                version = FileVersion(int(record[b"rev"]))
+                chunks = []
+            else:
+                chunks.append(record[b"data"])
+        if path is not None:
+            yield path, version, b"".join(chunks)
+
+    async def fstat_digests(self, file_spec: str) -> list[FileDigest]:
+        # The head revision of each file in file_spec, as of a changelist
+        # or label, such as //depot/dir/...@1234, with the digest of its
+        # contents.
+        records = await self.run(["fstat", "-Ol", file_spec], allow_empty=True)
+        return [
+            FileDigest(
+                _decode(record[b"depotFile"]),
+                FileVersion(int(record[b"headRev"])),
+                ChangeList(int(record[b"headChange"])),
+                _decode(record[b"headAction"]),
+                _decode(record[b"headType"]),
+                _decode(record[b"digest"]) if b"digest" in record else None,
+                int(record[b"fileSize"]) if b"fileSize" in record else None,
+            )
+            for record in records
+        ]
+
+    async def labels(self) -> list[str]:
+        return [_decode(record[b"label"]) for record in await self.run(["labels"])]
+
+    async def label(self, name: str) -> dict[str, str]:
+        # The label's spec, as p4 label -o gives it, except that the
+        # fields with several lines (like View) come as View0, View1,
+        # and so on.
+        [record] = await self.run(["label", "-o", name])
+        return {
+            _decode(key): _decode(value)
+            for key, value in record.items()
+            if key != b"code"
+        }
+
+
+def check_records(args: list[str], records: list[Record]) -> None:
+    # p4 reports most errors as records, rather than by its exit status.
+    errors = [
+        _decode(record[b"data"]).strip()
+        for record in records
+        if record.get(b"code") == b"error"
+    ]
+    if errors:
+        raise Exception(f"p4 {' '.join(args)} failed: {'; '.join(errors)}")
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    # The options of every script which talks to the server.
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=8,
+        help="most p4 commands to run at once",
+    )
+    parser.add_argument(
+        "--commands-per-second",
+        type=float,
+        help="most p4 commands to start each second",
+    )
+    parser.add_argument(
+        "--p4",
+        default="p4",
+        help="command with which to run p4, for example a fake p4 for testing",
+    )
+    parser.add_argument(
+        "--server-timezone",
+        metavar="NAME",
+        help="the p4 server's timezone, such as America/Los_Angeles, if it"
+        " cannot be told from its abbreviation",
+    )
+
+
+def from_arguments(options: argparse.Namespace) -> Client:
+    return Client(
+        shlex.split(options.p4),
+        max_concurrency=options.max_concurrency,
+        commands_per_second=options.commands_per_second,
+        server_timezone=options.server_timezone,
+    )
+
+
+def _guess_timezone(now: datetime.datetime, abbreviation: str) -> datetime.tzinfo:
+    # The timezones with the server's offset and abbreviation now. It
+    # does not matter which, so long as they have had the same offsets
+    # all along, which we check at noon UTC on each day since p4 began.
+    # A change in the rules moves the date the clocks change on, so that
+    # is often enough to tell.
+    candidates = []
+    for name in sorted(zoneinfo.available_timezones()):
+        try:
+            tz = zoneinfo.ZoneInfo(name)
+        except (ValueError, OSError):
+            continue
+        local = now.astimezone(tz)
+        if local.utcoffset() == now.utcoffset() and local.tzname() == abbreviation:
+            candidates.append(tz)
+    if not candidates:
+        raise Exception(
+            f"no timezone has the server's abbreviation, {abbreviation}, and"
+            f" offset, {now:%z}: give it with --server-timezone"
+        )
+    day = datetime.datetime(1995, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    while day < now:
+        offsets = {day.astimezone(tz).utcoffset() for tz in candidates}
+        if len(offsets) > 1:
+            raise Exception(
+                f"the server's timezone could be any of"
+                f" {', '.join(str(tz) for tz in candidates)}, which have had"
+                " different offsets: give it with --server-timezone"
+            )
+        day += datetime.timedelta(days=1)
+    return candidates[0]
+
+
+def _check_transient(args: list[str], message: str) -> None:
+    if _TRANSIENT_ERRORS.search(message):
+        raise TransientError(f"p4 {' '.join(args)} failed: {message}")
+
+
+async def _write_input(
+    proc: asyncio.subprocess.Process, input: Optional[bytes]
+) -> None:
+    if proc.stdin is None:
+        return
+    assert input is not None
+    proc.stdin.write(input)
+    await proc.stdin.drain()
+    proc.stdin.close()
+
+
+def _parse_records(buffer: bytearray) -> list[Record]:
+    # The whole records at the start of the buffer, which are removed.
+    records = []
+    with io.BytesIO(buffer) as f:
+        while True:
+            start = f.tell()
+            try:
+                records.append(marshal.load(f))
+            except EOFError:
+                f.seek(start)
+                break
+        del buffer[: f.tell()]
+    return records
+
+
+async def _read_records(stream: asyncio.StreamReader) -> AsyncIterator[Record]:
+    # marshal cannot read from an asyncio stream, so we gather the output
+    # into a buffer, and parse each record once all of it has arrived.
+    # A record can be far larger than a read, as from p4 print -G of a
+    # big file; so after an incomplete record, we wait for the buffer to
+    # double before trying again, which keeps the parsing linear.
+    buffer = bytearray()
+    retry_at = 0
+    while chunk := await stream.read(1 << 16):
+        buffer += chunk
+        if len(buffer) >= retry_at:
+            for record in _parse_records(buffer):
+                yield record
+            retry_at = 2 * len(buffer)
+    for record in _parse_records(buffer):
+        yield record
+    if buffer:
+        raise Exception("p4 stopped in the middle of a record")
@@ -15,20 +15,113 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import datetime
+import functools
+import gc
+import io
+import mmap
+import os
+import pickle
 import re
+import sys
 from collections.abc import Iterator
 from dataclasses import dataclass
 from pathlib import PurePosixPath
 from typing import NewType, Optional, Self, TextIO, final
 
-from branchmap import Branch
+from git import Branch
 
 FileVersion = NewType("FileVersion", int)
 
 
+# The whole depot's history is held in memory at once, so we share
+# values that repeat. Every path appears many times over, as the source
+# and target of integrations; sharing one object per path also saves
+# its (slow) construction. Likewise for the few distinct revision
+# ranges, changelists, and days.
+@functools.cache
+def _depot_path(path: str) -> PurePosixPath:
+    return PurePosixPath(path)
+
+
+@functools.cache
+def _path_revs(path_revs: str) -> frozenset[FileVersion]:
+    return frozenset(FileVersion(int(rev[len("#") :])) for rev in path_revs.split(","))
+
+
+@functools.cache
+def _day(when: str) -> datetime.datetime:
+    return datetime.datetime.strptime(when, "%Y/%m/%d")
+
+
+@functools.cache
+def _checked_version(version: str) -> Optional[FileVersion]:
+    # The version from #12, or None if it is not like that.
+    if not version.startswith("#") or not _is_number(version[len("#") :]):
+        return None
+    return FileVersion(int(version[len("#") :]))
+
+
+@functools.cache
+def _checked_details(
+    details: str,
+) -> Optional[tuple[str, datetime.datetime, str, str]]:
+    # The action, day, author and file type from the middle of a
+    # revision's line, like
+    #
+    #     edit on 2003/01/24 by bartO (text+x)
+    #
+    # or None unless the regex for revisions would match them.
+    fields = details.split(" ")
+    if len(fields) != 6:
+        return None
+    action, on, when, by, author, file_type = fields
+    day = _checked_day(when)
+    if (
+        on != "on"
+        or by != "by"
+        or not _is_word(action)
+        or day is None
+        or not author
+        or not file_type.startswith("(")
+        or file_type[len("(") : -len(")")] not in _FILE_TYPES
+    ):
+        return None
+    chmod = file_type[len("(") : -len(")")]
+    return sys.intern(action), day, sys.intern(author), sys.intern(chmod)
+
+
+def _checked_day(when: str) -> Optional[datetime.datetime]:
+    # As _day, or None unless when is like 2003/01/24.
+    year, month, day = (when.split("/") + ["", ""])[:3]
+    if when.count("/") != 2 or len(month) != 2 or len(day) != 2:
+        return None
+    if not (_is_number(year) and _is_number(month) and _is_number(day)):
+        return None
+    return _day(when)
+
+
+def _is_number(digits: str) -> bool:
+    # Only ASCII digits, as with [0-9]+: str.isdigit allows others.
+    return digits.isascii() and digits.isdigit()
+
+
+def _is_word(word: str) -> bool:
+    # Only lower case ASCII letters, as with [a-z]+.
+    return word.isascii() and word.isalpha() and word.islower()
+
+
+# The only file types which the regex for revisions allows.
+_FILE_TYPES = frozenset(
+    f"{base}{modifier}"
+    for base in ["binary", "text"]
+    for modifier in ["", "+x", "+F", "+w"]
+)
+
+
 @final
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SubChange:
     action: str
     path: PurePosixPath
@@ -49,19 +142,38 @@ class SubChange:
         match = SubChange.__regex.match(line)
         if match is None:
             raise Exception(f"no match for line: {line}")
-        action = match.group(1)
+        action = sys.intern(match.group(1))
         path = f"//{match.group(2)}"
-        revs = frozenset(
-            FileVersion(int(rev[len("#") :])) for rev in match.group(3).split(",")
-        )
-        return SubChange(action, PurePosixPath(path), revs)
+        revs = _path_revs(match.group(3))
+        return SubChange(action, _depot_path(path), revs)
 
 
 ChangeList = NewType("ChangeList", int)
 
 
+@functools.cache
+def _changelist(changelist: str) -> ChangeList:
+    return ChangeList(int(changelist))
+
+
+def clear_caches() -> None:
+    # The values parsed are shared, so that a filelog held in memory
+    # holds each only once. When the parsed files are not kept, as when
+    # streaming the filelog, the caches would instead only grow with the
+    # depot: so such a caller clears them from time to time.
+    for cached in [
+        _depot_path,
+        _path_revs,
+        _day,
+        _checked_version,
+        _checked_details,
+        _changelist,
+    ]:
+        cached.cache_clear()
+
+
 @final
-@dataclass
+@dataclass(slots=True)
 class FileChange:
     version: FileVersion
     changelist: ChangeList
@@ -83,27 +195,66 @@ class FileChange:
 
     __regex = re.compile(
         "... #([0-9]+) change ([0-9]+) ([a-z]+)"
-        " on ([0-9]+/[0-9]{2}/[0-9]{2}) by ([^ ]+) \(((binary|text)(\+[xFw])?)\) '(.*?)'$"
+        " on ([0-9]+/[0-9]{2}/[0-9]{2}) by ([^ ]+)"
+        " \(((binary|text)(\+[xFw])?)\) '(.*?)'$"
     )
 
     @classmethod
-    def __parse_line(cls, line: str) -> Self:
+    def parse_line(cls, line: str) -> Self:
+        # Most of the time in parsing a filelog goes on these lines, one
+        # for every revision. So rather than the regex, we split the
+        # line at fixed places: most of it, from the action to the file
+        # type, is shared with many other lines, and checked only once.
+        # Only a line we are unsure of is left to the regex.
+        fields = line.split(" ", 4)
+        if len(fields) == 5:
+            dots, version, change, changelist, rest = fields
+            details_end = rest.find(") '") + len(")")
+            details = _checked_details(rest[:details_end]) if details_end else None
+            file_version = _checked_version(version)
+            if (
+                dots == "..."
+                and change == "change"
+                and file_version is not None
+                and _is_number(changelist)
+                and details is not None
+                and rest.endswith("'")
+                and len(rest) > details_end + len(" '")
+            ):
+                action, day, author, chmod = details
+                description = rest[details_end + len(" '") : -len("'")]
+                return FileChange(
+                    file_version,
+                    _changelist(changelist),
+                    action,
+                    day,
+                    author,
+                    chmod,
+                    sys.intern(description),
+                    [],
+                )
+        return cls.parse_line_with_regex(line)
+
+    @classmethod
+    def parse_line_with_regex(cls, line: str) -> Self:
         match = FileChange.__regex.match(line)
         if match is None:
             raise Exception(f"no match for line: {line}")
         version = int(match.group(1))
-        changelist = int(match.group(2))
-        action = match.group(3)
-        when = datetime.datetime.strptime(match.group(4), "%Y/%m/%d")
-        author = match.group(5)
-        chmod = match.group(6)
-        description = match.group(9)
+        changelist = _changelist(match.group(2))
+        action = sys.intern(match.group(3))
+        when = _day(match.group(4))
+        author = sys.intern(match.group(5))
+        chmod = sys.intern(match.group(6))
+        # Each changelist's description is repeated for every file in
+        # the changelist.
+        description = sys.intern(match.group(9))
         # The subchanges need to be added elsewhere; they are on other
         # lines.
         subchanges: list[SubChange] = []
         return FileChange(
             FileVersion(version),
-            ChangeList(changelist),
+            changelist,
             action,
             when,
             author,
@@ -127,7 +278,7 @@ class FileChange:
             if line.startswith("... #"):
                 if file_change is not None:
                     yield mk_file_change()
-                bh = FileChange.__parse_line(line)
+                bh = FileChange.parse_line(line)
                 file_change = bh
             else:
                 assert file_change is not None
@@ -137,7 +288,7 @@ class FileChange:
 
 
 @final
-@dataclass
+@dataclass(slots=True)
 class ChangedFile:
     path: PurePosixPath
     file_changes: list[FileChange]
@@ -158,9 +309,7 @@ class ChangedFile:
             body2 = body
             path = ""
             body = []
-            return ChangedFile(
-                PurePosixPath(path2), list(FileChange.parse_lines(body2))
-            )
+            return ChangedFile(_depot_path(path2), list(FileChange.parse_lines(body2)))
 
         for line in f:
             line = line.rstrip()
@@ -173,6 +322,58 @@ class ChangedFile:
         if path != "":
             yield mk_changed_file()
 
+    @classmethod
+    def from_tagged(cls, record: dict[bytes, bytes], tz: datetime.tzinfo) -> Self:
+        # From one record of p4 -G filelog. The fields of revision i are
+        # suffixed with i, and those of its integration j with "i,j".
+        # Times are in seconds since the epoch, whereas the text output
+        # gives the day in the server's timezone, tz.
+        def field(name: str) -> str:
+            return record[name.encode("utf-8")].decode("utf-8", errors="replace")
+
+        # Depot paths which are not UTF-8 are kept as they are, as
+        # elsewhere, so that they can be written out as p4 gave them.
+        def path_field(name: str) -> PurePosixPath:
+            value = record[name.encode("utf-8")]
+            return _depot_path(value.decode("utf-8", errors="surrogateescape"))
+
+        file_changes = []
+        i = 0
+        while f"rev{i}".encode("utf-8") in record:
+            sub_changes = []
+            j = 0
+            while f"how{i},{j}".encode("utf-8") in record:
+                # The range of source revisions is exclusive at the
+                # start, which is #none for a range from the first.
+                start_rev = field(f"srev{i},{j}")
+                start = 1 if start_rev == "#none" else int(start_rev[len("#") :]) + 1
+                end = int(field(f"erev{i},{j}")[len("#") :])
+                path_revs = f"#{end}" if start >= end else f"#{start},#{end}"
+                sub_changes.append(
+                    SubChange(
+                        sys.intern(field(f"how{i},{j}")),
+                        path_field(f"file{i},{j}"),
+                        _path_revs(path_revs),
+                    )
+                )
+                j += 1
+            when = datetime.datetime.fromtimestamp(int(field(f"time{i}")), tz)
+            file_changes.append(
+                FileChange(
+                    FileVersion(int(field(f"rev{i}"))),
+                    _changelist(field(f"change{i}")),
+                    sys.intern(field(f"action{i}")),
+                    _day(when.strftime("%Y/%m/%d")),
+                    sys.intern(f"{field(f'user{i}')}@{field(f'client{i}')}"),
+                    sys.intern(field(f"type{i}")),
+                    # The text output gives descriptions on one line.
+                    sys.intern(" ".join(field(f"desc{i}").splitlines())),
+                    sub_changes,
+                )
+            )
+            i += 1
+        return ChangedFile(path_field("depotFile"), file_changes)
+
 
 GitHash = NewType("GitHash", str)
 
@@ -187,11 +388,231 @@ class Commit:
         return f"{self.changelist} {self.branch}"
 
 
-def get_path_to_changed_file() -> dict[PurePosixPath, ChangedFile]:
+# Bump this whenever the pickled classes change, to invalidate existing
+# caches.
+_CACHE_FORMAT = 2
+
+
+def get_filelog_files(filename: str) -> list[str]:
+    # The filelog is either the one file, or a directory of shards, as
+    # written by export_filelogs.py. Every file's history is wholly
+    # within one shard, so we can read the shards one after another.
+    if os.path.isdir(filename):
+        return [os.path.join(filename, name) for name in sorted(os.listdir(filename))]
+    return [filename]
+
+
+def _open_filelog(filename: str) -> TextIO:
     # Encoding errors need to be non-fatal, because the filelog contains
     # changeset descriptions, and these might not all be UTF-8.
-    with open("filelogs.txt", "rt", errors="replace") as f:
-        path_to_changed_file: dict[PurePosixPath, ChangedFile] = {}
-        for changed_file in ChangedFile.parse(f):
-            path_to_changed_file[changed_file.path] = changed_file
+    return open(filename, "rt", errors="replace")
+
+
+def _iter_filelog_lines(filename: str) -> Iterator[str]:
+    for shard in get_filelog_files(filename):
+        with _open_filelog(shard) as f:
+            yield from f
+
+
+def _parse_path_to_changed_file(filename: str) -> dict[PurePosixPath, ChangedFile]:
+    path_to_changed_file: dict[PurePosixPath, ChangedFile] = {}
+    for changed_file in iter_changed_files(filename):
+        path_to_changed_file[changed_file.path] = changed_file
     return path_to_changed_file
+
+
+def iter_changed_files(filename: str = "filelogs") -> Iterator[ChangedFile]:
+    # Unlike get_path_to_changed_file, this never holds more than one
+    # file's history in memory.
+    for shard in get_filelog_files(filename):
+        with _open_filelog(shard) as f:
+            yield from ChangedFile.parse(f)
+
+
+def iter_integration_sources(
+    filename: str = "filelogs",
+) -> Iterator[tuple[PurePosixPath, FileVersion]]:
+    # The last source revision of each integration. Only these lines are
+    # parsed, so this is much quicker than a full parse.
+    for line in _iter_filelog_lines(filename):
+        if line.startswith("... ... ") and " from //" in line:
+            sub_change = SubChange.parse_line(line.rstrip())
+            yield sub_change.path, max(sub_change.path_revs)
+
+
+def iter_changelists(
+    filename: str = "filelogs",
+) -> Iterator[tuple[PurePosixPath, FileVersion, ChangeList]]:
+    # The changelist of every file revision, again without a full parse.
+    path = PurePosixPath()
+    for line in _iter_filelog_lines(filename):
+        if line.startswith("//"):
+            path = _depot_path(line.rstrip())
+        elif line.startswith("... #"):
+            # ... #<version> change <changelist> <action> on ...
+            _, version, _, changelist, _ = line.split(" ", 4)
+            yield path, FileVersion(int(version[len("#") :])), _changelist(changelist)
+
+
+def _get_shards(filename: str, num_shards: int) -> list[tuple[int, int]]:
+    # The filelog is a sequence of independent blocks, each starting
+    # with a line for the depot path. So we can split it before any such
+    # line.
+    size = os.path.getsize(filename)
+    if size == 0:
+        return [(0, 0)]
+    starts = [0]
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for i in range(1, num_shards):
+                start = mm.find(b"\n//", max(size * i // num_shards, starts[-1]))
+                if start == -1:
+                    break
+                starts.append(start + len(b"\n"))
+    return list(zip(starts, starts[1:] + [size]))
+
+
+# What a worker sends back for each ChangedFile. Objects we share are
+# sent as the strings they were parsed from, so the main process can
+# share them again across all of the shards.
+_SubChangeRecord = tuple[str, str, str]
+_FileChangeRecord = tuple[int, str, str, str, str, str, str, list[_SubChangeRecord]]
+_ChangedFileRecord = tuple[str, list[_FileChangeRecord]]
+
+
+def _to_record(changed_file: ChangedFile) -> _ChangedFileRecord:
+    return (
+        str(changed_file.path),
+        [
+            (
+                file_change.version,
+                str(file_change.changelist),
+                file_change.action,
+                file_change.when.strftime("%Y/%m/%d"),
+                file_change.author,
+                file_change.chmod,
+                file_change.description,
+                [
+                    (
+                        sub_change.action,
+                        str(sub_change.path),
+                        ",".join(f"#{rev}" for rev in sorted(sub_change.path_revs)),
+                    )
+                    for sub_change in file_change.sub_changes
+                ],
+            )
+            for file_change in changed_file.file_changes
+        ],
+    )
+
+
+def _from_record(record: _ChangedFileRecord) -> ChangedFile:
+    path, file_changes = record
+    return ChangedFile(
+        _depot_path(path),
+        [
+            FileChange(
+                FileVersion(version),
+                _changelist(changelist),
+                sys.intern(action),
+                _day(when),
+                sys.intern(author),
+                sys.intern(chmod),
+                sys.intern(description),
+                [
+                    SubChange(
+                        sys.intern(sub_action),
+                        _depot_path(sub_path),
+                        _path_revs(path_revs),
+                    )
+                    for sub_action, sub_path, path_revs in sub_changes
+                ],
+            )
+            for (
+                version,
+                changelist,
+                action,
+                when,
+                author,
+                chmod,
+                description,
+                sub_changes,
+            ) in file_changes
+        ],
+    )
+
+
+def _parse_shard(filename: str, start: int, end: int) -> list[_ChangedFileRecord]:
+    if start == end:
+        return []
+    gc.disable()
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[start:end]
+    # Decode just as open() does in _parse_path_to_changed_file.
+    with io.TextIOWrapper(io.BytesIO(data), errors="replace") as f:
+        return [_to_record(changed_file) for changed_file in ChangedFile.parse(f)]
+
+
+def _parse_path_to_changed_file_parallel(
+    filename: str, jobs: int
+) -> dict[PurePosixPath, ChangedFile]:
+    filelog_files = get_filelog_files(filename)
+    # Split each file further, so that a few large files still keep
+    # every worker busy.
+    num_shards = max(1, -(-jobs // len(filelog_files)))
+    path_to_changed_file: dict[PurePosixPath, ChangedFile] = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_parse_shard, filelog_file, start, end)
+            for filelog_file in filelog_files
+            for start, end in _get_shards(filelog_file, num_shards)
+        ]
+        # The shards are in file order, so the result is in the same
+        # order as with the serial parser.
+        for future in futures:
+            for record in future.result():
+                changed_file = _from_record(record)
+                path_to_changed_file[changed_file.path] = changed_file
+    return path_to_changed_file
+
+
+def get_path_to_changed_file(
+    filename: str = "filelogs", *, jobs: int = 1
+) -> dict[PurePosixPath, ChangedFile]:
+    # Parsing the filelog is slow, and we often rerun the conversion
+    # (for example when changing the branchmap) against the same
+    # filelog. So keep the parsed result next to it, and only reparse
+    # when the filelog looks different.
+    cache_filename = f"{filename.rstrip('/')}.cache"
+    cache_key = (
+        _CACHE_FORMAT,
+        [
+            (filelog_file, stat.st_size, stat.st_mtime_ns)
+            for filelog_file in get_filelog_files(filename)
+            for stat in [os.stat(filelog_file)]
+        ],
+    )
+    # We create millions of objects, none of which are garbage, so the
+    # collector would spend its time repeatedly scanning them in vain.
+    gc.disable()
+    try:
+        try:
+            with open(cache_filename, "rb") as f:
+                if pickle.load(f) == cache_key:
+                    return pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            pass
+        if jobs > 1:
+            path_to_changed_file = _parse_path_to_changed_file_parallel(filename, jobs)
+        else:
+            path_to_changed_file = _parse_path_to_changed_file(filename)
+        # Write then rename, so an interrupted run cannot leave behind
+        # a truncated cache.
+        with open(f"{cache_filename}.tmp", "wb") as f:
+            pickle.dump(cache_key, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(path_to_changed_file, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{cache_filename}.tmp", cache_filename)
+        return path_to_changed_file
+    finally:
+        gc.enable()
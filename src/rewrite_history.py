@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# The finishing touches to the history, all in one git filter-repo run:
+# tidy up the commit messages, make the grafted merges permanent, delete
+# email addresses, and apply the mailmap. Each of those used to be its
+# own filter-repo run, which rewrote every commit again.
+#
+# An incremental conversion only rewrites what it added: with
+# --previous-refs, just the branches and tags which are new or have
+# moved, and just their commits since.
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+from commit_index import GitHash, get_commit_index, remap_commit_index
+from git import git
+from stats import Step, count_subprocess
+
+# Literal replacements, then regex replacements, as in filter-repo.
+Replacements = tuple[list[tuple[bytes, bytes]], list[tuple[bytes, bytes]]]
+
+
+def parse_replacements(filename: str) -> Replacements:
+    # The format of git filter-repo --replace-message. Note that there
+    # are no comments: like filter-repo, we treat a line starting with #
+    # as text to replace.
+    literals = []
+    regexes = []
+    with open(filename, "rb") as f:
+        for line in f:
+            line = line.rstrip(b"\r\n")
+            replacement = b"***REMOVED***"
+            if b"==>" in line:
+                line, replacement = line.rsplit(b"==>", 1)
+            if line.startswith(b"regex:"):
+                regexes.append((line.removeprefix(b"regex:"), replacement))
+            elif line.startswith(b"glob:"):
+                raise ValueError(f"glob replacements are not supported: {line!r}")
+            else:
+                line = line.removeprefix(b"literal:")
+                if line:
+                    literals.append((line, replacement))
+    return literals, regexes
+
+
+def get_commit_callback(replacements: list[Replacements]) -> str:
+    # Rather than --replace-message, which only takes one file, and also
+    # rewrites tag messages. The tags are made from p4 labels, whose
+    # descriptions never had the replacements applied.
+    lines = []
+    for literals, regexes in replacements:
+        lines += [
+            f"for literal, replacement in {literals!r}:",
+            "  commit.message = commit.message.replace(literal, replacement)",
+            f"for regex, replacement in {regexes!r}:",
+            "  commit.message = re.sub(regex, replacement, commit.message)",
+        ]
+    return "\n".join(lines)
+
+
+def get_mailmap_emails(filename: str) -> set[bytes]:
+    # The proper email addresses in a mailmap. Each line starts with the
+    # proper name and email address.
+    emails = set()
+    with open(filename, "rb") as f:
+        for line in f:
+            line = re.sub(rb"\s*#.*", b"", line).strip()
+            match = re.match(rb"(.*?)\s*<([^>]*)>", line)
+            if match and match.group(2):
+                emails.add(match.group(2))
+    return emails
+
+
+def read_commit_map(filename: str) -> dict[GitHash, GitHash]:
+    # Written by filter-repo: a header, then the old and new hash of
+    # each commit it rewrote.
+    commit_map = {}
+    with open(filename, "rt", encoding="utf-8") as f:
+        next(f)
+        for line in f:
+            old, new = line.split()
+            commit_map[GitHash(old)] = GitHash(new)
+    return commit_map
+
+
+def main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Rewrite the messages, merges and authors of every branch."
+    )
+    parser.add_argument(
+        "--replace-message",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="as for git filter-repo, except this can be given more than once",
+    )
+    parser.add_argument("--mailmap", metavar="FILE")
+    parser.add_argument(
+        "--previous-refs",
+        metavar="FILE",
+        help="only rewrite what is new since these branches and tags, as listed"
+        " by git for-each-ref --format='%%(objectname) %%(refname)'",
+    )
+    options = parser.parse_args(args)
+    replacements = [
+        parse_replacements(filename) for filename in options.replace_message
+    ]
+    filter_repo_args = [
+        # Nothing else has run filter-repo in this repository, except
+        # for earlier runs of this script.
+        "--force",
+        # Makes the grafts from make_merges permanent.
+        "--replace-refs=delete-no-add",
+        "--commit-callback",
+        get_commit_callback(replacements),
+    ]
+    mailmap_emails = set()
+    if options.mailmap is not None:
+        # Convert from Perforce usernames, to full names.
+        filter_repo_args += ["--mailmap", options.mailmap]
+        mailmap_emails = get_mailmap_emails(options.mailmap)
+    # Delete email addresses for two reasons. First, p4-fusion may have
+    # given us placeholder email addresses instead of empty ones, where
+    # Perforce does not know the user’s email address. Second, I don’t
+    # think it’s fair to put email addresses into a git log without
+    # asking: git logs are more likely to be scraped by spammers than an
+    # old Perforce depot. Besides, tags do not end up with email
+    # addresses, because labels are exported using different commands
+    # to commits.
+    #
+    # So, if you want email addresses, add them to the mailmap.
+    # filter-repo applies the mailmap before the email callback, so we
+    # keep the addresses which came from the mailmap.
+    filter_repo_args += [
+        "--email-callback",
+        f'return email if email in {mailmap_emails!r} else b""',
+    ]
+    if options.previous_refs is not None:
+        with open(options.previous_refs, "rt") as f:
+            previous_refs = set(f.read().splitlines())
+        refs = git(
+            [
+                "for-each-ref",
+                "--format=%(objectname) %(refname)",
+                "refs/heads/",
+                "refs/tags/",
+            ]
+        ).splitlines()
+        new_refs = [ref.split(" ", 1)[1] for ref in refs if ref not in previous_refs]
+        if not new_refs:
+            print("Nothing new to rewrite", file=sys.stderr)
+            return
+        previous_heads = [
+            ref.split(" ", 1)[0]
+            for ref in previous_refs
+            if ref.split(" ", 1)[1].startswith("refs/heads/")
+        ]
+        filter_repo_args += ["--refs"] + new_refs
+        filter_repo_args += [f"^{hash}" for hash in sorted(previous_heads)]
+    # The saved commit index must be for the branches as they are now,
+    # before the rewrite, so that it can be kept up to date afterwards.
+    get_commit_index()
+    # Otherwise filter-repo would treat this as a continuation of the
+    # previous run, whose commit map would then go from the commits as
+    # they were before that run. (And, if the previous run was more than
+    # a day ago, it would ask us whether to.)
+    git_dir = git(["rev-parse", "--absolute-git-dir"]).strip()
+    metadata_dir = os.path.join(git_dir, "filter-repo")
+    if os.path.exists(os.path.join(metadata_dir, "already_ran")):
+        os.remove(os.path.join(metadata_dir, "already_ran"))
+    with Step("filter-repo", unit="commits") as step:
+        # Not git(), so that filter-repo can show its progress.
+        count_subprocess()
+        subprocess.run(["git", "filter-repo"] + filter_repo_args, check=True)
+        commit_map = read_commit_map(os.path.join(metadata_dir, "commit-map"))
+        step.advance(len(commit_map))
+    remap_commit_index(commit_map)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
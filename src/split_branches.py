@@ -0,0 +1,331 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Splits the history of the whole depot into one git branch per p4
+# branch, as decided by branchmap. This used to be a git filter-repo run
+# per branch, each of which read and rewrote the whole history. Instead
+# we read the history once, with git fast-export, and write every branch
+# in the one git fast-import stream.
+#
+# Like filter-repo --prune-empty=always, a commit only ends up in a
+# branch if it changes that branch's files.
+#
+# Blobs are referred to by hash, so none of the file contents need be
+# read or written again.
+#
+# An incremental conversion splits only the new commits, with --since,
+# and adds them onto the ends of the existing branches.
+
+import argparse
+import re
+import subprocess
+import sys
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from typing import IO, Optional, final
+
+from branchmap import split_path
+from commit_index import get_changelist
+from git import Branch, git, git_process
+from p4.filelog import ChangeList
+from stats import Step
+
+EVERYTHING_BRANCH = Branch("__p4_export__everything_no_branches")
+
+_UNESCAPES = {
+    b"a": b"\a",
+    b"b": b"\b",
+    b"f": b"\f",
+    b"n": b"\n",
+    b"r": b"\r",
+    b"t": b"\t",
+    b"v": b"\v",
+    b"\\": b"\\",
+    b'"': b'"',
+}
+_ESCAPES = {value: b"\\" + key for key, value in _UNESCAPES.items()}
+
+
+def _unquote_path(path: bytes) -> bytes:
+    # git quotes unusual paths like C string literals.
+    if not path.startswith(b'"'):
+        return path
+    return re.sub(
+        rb"\\([0-7]{3}|.)",
+        lambda match: (
+            bytes([int(match.group(1), 8)])
+            if len(match.group(1)) == 3
+            else _UNESCAPES[match.group(1)]
+        ),
+        path[1:-1],
+        flags=re.DOTALL,
+    )
+
+
+def quote_path(path: bytes) -> bytes:
+    # For paths in a fast-import stream.
+    if not path.startswith(b'"') and not any(c in path for c in b'\\\n"'):
+        return path
+    return b'"' + re.sub(rb'[\\\n"]', lambda m: _ESCAPES[m.group(0)], path) + b'"'
+
+
+def _get_changelist(message: bytes) -> Optional[ChangeList]:
+    for line in message.decode("utf-8", errors="replace").splitlines():
+        changelist = get_changelist(line)
+        if changelist is not None:
+            return changelist
+    return None
+
+
+@final
+@dataclass
+class _Commit:
+    # The author, committer and encoding lines, as they were exported.
+    header: list[bytes]
+    message: bytes
+    # (path, mode and blob hash), or (path, None) for a deletion.
+    file_changes: list[tuple[bytes, Optional[bytes]]]
+
+
+@final
+@dataclass
+class _BranchState:
+    # The files in the branch, as of the last commit written to it, and
+    # their mode and blob hash.
+    files: dict[bytes, bytes] = field(default_factory=dict)
+    # The last commit written to the branch, as either a mark or a hash.
+    parent: Optional[str] = None
+
+
+def _read_commits(stream: IO[bytes]) -> Iterator[_Commit]:
+    # Parses the git fast-export of a linear history, as exported with
+    # --no-data.
+    while line := stream.readline():
+        line = line.removesuffix(b"\n")
+        command, _, rest = line.partition(b" ")
+        match command:
+            case b"commit":
+                yield _read_commit(stream)
+            case b"done":
+                return
+            case b"feature" | b"reset" | b"from" | b"":
+                pass
+            case _:
+                raise Exception(f"unexpected fast-export command: {line!r}")
+    raise Exception("fast-export stopped without saying it was done")
+
+
+def _read_commit(stream: IO[bytes]) -> _Commit:
+    header = []
+    while True:
+        line = stream.readline().removesuffix(b"\n")
+        command, _, rest = line.partition(b" ")
+        if command == b"data":
+            message = stream.read(int(rest))
+            break
+        if command != b"mark" and command != b"original-oid":
+            header.append(line)
+    file_changes: list[tuple[bytes, Optional[bytes]]] = []
+    while line := stream.readline().removesuffix(b"\n"):
+        command, _, rest = line.partition(b" ")
+        match command:
+            case b"M":
+                mode, hash, path = rest.split(b" ", 2)
+                file_changes.append((_unquote_path(path), mode + b" " + hash))
+            case b"D":
+                file_changes.append((_unquote_path(rest), None))
+            case b"from":
+                pass
+            case _:
+                # Merges included: the history is expected to be linear.
+                raise Exception(f"unexpected line in fast-export commit: {line!r}")
+    return _Commit(header, message, file_changes)
+
+
+def _split_commit(
+    commit: _Commit,
+) -> dict[Branch, list[tuple[bytes, Optional[bytes]]]]:
+    changelist = _get_changelist(commit.message)
+    branch_to_file_changes: dict[Branch, list[tuple[bytes, Optional[bytes]]]] = {}
+    for path, mode_and_hash in commit.file_changes:
+        # Paths are not always UTF-8, but rules only match ASCII paths.
+        target = split_path(path.decode("utf-8", "surrogateescape"), changelist)
+        if target is None:
+            continue
+        branch, branch_path = target
+        branch_to_file_changes.setdefault(branch, []).append(
+            (branch_path.encode("utf-8", "surrogateescape"), mode_and_hash)
+        )
+    return branch_to_file_changes
+
+
+def _write_commit(
+    out: IO[bytes],
+    commit: _Commit,
+    branch: Branch,
+    state: _BranchState,
+    file_changes: list[tuple[bytes, Optional[bytes]]],
+    mark: int,
+) -> bool:
+    # Writes the commit to the branch, unless it leaves the branch's
+    # files as they were. Several depot paths can end up at the same
+    # path in a branch, so we compare the end result rather than
+    # trusting the individual changes.
+    before: dict[bytes, Optional[bytes]] = {}
+    for path, mode_and_hash in file_changes:
+        before.setdefault(path, state.files.get(path))
+        if mode_and_hash is None:
+            state.files.pop(path, None)
+        else:
+            state.files[path] = mode_and_hash
+    changed = [path for path in before if state.files.get(path) != before[path]]
+    if not changed:
+        return False
+    out.write(f"commit refs/heads/{branch}\nmark :{mark}\n".encode("utf-8"))
+    for line in commit.header:
+        out.write(line + b"\n")
+    out.write(f"data {len(commit.message)}\n".encode("utf-8"))
+    out.write(commit.message + b"\n")
+    if state.parent is not None:
+        out.write(f"from {state.parent}\n".encode("utf-8"))
+    # Deletions first, in case a file is replaced by a directory.
+    for path in changed:
+        if path not in state.files:
+            out.write(b"D " + quote_path(path) + b"\n")
+    for path in changed:
+        if path in state.files:
+            out.write(b"M " + state.files[path] + b" " + quote_path(path) + b"\n")
+    out.write(b"\n")
+    state.parent = f":{mark}"
+    return True
+
+
+def _read_branch_state(tip: str) -> _BranchState:
+    # The state of an existing branch, to carry on from.
+    with git_process(["ls-tree", "-r", "-z", tip], stdout=subprocess.PIPE) as ls_tree:
+        assert ls_tree.stdout is not None
+        output = ls_tree.stdout.read()
+    files = {}
+    for entry in output.split(b"\0")[:-1]:
+        info, _, path = entry.partition(b"\t")
+        mode, _, hash = info.split(b" ")
+        files[path] = mode + b" " + hash
+    return _BranchState(files, tip)
+
+
+def split_branches(
+    source: IO[bytes],
+    out: IO[bytes],
+    tips: Optional[dict[Branch, str]] = None,
+    step: Optional[Step] = None,
+) -> dict[Branch, int]:
+    # Returns the number of commits written to each branch. Commits are
+    # added onto the existing branches, whose tips are given. The step,
+    # if any, counts the commits read.
+    if tips is None:
+        tips = {}
+    out.write(b"feature done\n")
+    branch_to_state: dict[Branch, _BranchState] = {}
+    branch_to_num_commits: dict[Branch, int] = {}
+    mark = 0
+    commits = _read_commits(source)
+    for commit in commits if step is None else step.track(commits):
+        for branch, file_changes in _split_commit(commit).items():
+            state = branch_to_state.get(branch)
+            if state is None:
+                state = (
+                    _read_branch_state(tips[branch])
+                    if branch in tips
+                    else _BranchState()
+                )
+                branch_to_state[branch] = state
+            if _write_commit(out, commit, branch, state, file_changes, mark + 1):
+                mark += 1
+                branch_to_num_commits[branch] = branch_to_num_commits.get(branch, 0) + 1
+    out.write(b"done\n")
+    return branch_to_num_commits
+
+
+def _get_branch_tips(excluded: Branch) -> dict[Branch, str]:
+    tips = {}
+    for line in git(
+        ["for-each-ref", "--format=%(objectname) %(refname)", "refs/heads/"]
+    ).splitlines():
+        hash, ref = line.split(" ", 1)
+        branch = Branch(ref.removeprefix("refs/heads/"))
+        if branch != excluded:
+            tips[branch] = hash
+    return tips
+
+
+def main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Split the history of SOURCE_BRANCH into a branch per p4 branch."
+    )
+    parser.add_argument(
+        "source_branch",
+        metavar="SOURCE_BRANCH",
+        nargs="?",
+        default=EVERYTHING_BRANCH,
+    )
+    parser.add_argument(
+        "--since",
+        metavar="COMMIT",
+        help="only split the commits after COMMIT, of SOURCE_BRANCH,"
+        " adding them onto the existing branches",
+    )
+    options = parser.parse_args(args)
+    revisions = [f"refs/heads/{options.source_branch}"]
+    tips = _get_branch_tips(options.source_branch)
+    if options.since is not None:
+        revisions.append(f"^{options.since}")
+    elif tips:
+        # Otherwise a second run would stack a second copy of the
+        # history onto each branch.
+        raise Exception(
+            f"branches already exist, without --since: {', '.join(sorted(tips))}"
+        )
+    export_args = [
+        "fast-export",
+        "--no-data",
+        "--reencode=yes",
+        "--use-done-feature",
+    ] + revisions
+    if options.since is not None:
+        # Excluding the commits before, but still giving each new
+        # commit's changes relative to its parent, rather than every
+        # file.
+        export_args.append("--reference-excluded-parents")
+    # No --force, though that only guards against rewinding a branch:
+    # each branch's first commit is given its existing tip, if any, as
+    # its parent, and otherwise we made sure above that it has none.
+    import_args = ["fast-import", "--quiet", "--done"]
+    total = int(git(["rev-list", "--count"] + revisions).strip())
+    with Step("split branches", total=total, unit="commits") as step:
+        with git_process(export_args, stdout=subprocess.PIPE) as export, git_process(
+            import_args, stdin=subprocess.PIPE
+        ) as import_:
+            assert export.stdout is not None and import_.stdin is not None
+            branch_to_num_commits = split_branches(
+                export.stdout, import_.stdin, tips, step
+            )
+    for branch, num_commits in sorted(branch_to_num_commits.items()):
+        print(f"{branch}: {num_commits} commits")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
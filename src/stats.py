@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Where a conversion spends its time. main.sh runs each stage through
+# this script, which records the stage's wall time and the largest peak
+# RSS of any one of its processes: not their total, so a stage with a
+# pool of workers shows one worker's. Within the Python stages, each
+# step records the same, plus how many items it processed and how many
+# git and p4 processes it started, and prints its progress as it goes.
+#
+# The records are appended, as JSON lines, to the file named by
+# $MERGETASTIC_STATS. Without it, nothing is recorded, but the progress
+# is still printed.
+
+import contextvars
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from collections.abc import Iterable, Iterator
+from typing import Any, Optional, Self, TypeVar, final
+
+T = TypeVar("T")
+
+# How often to print progress.
+_PROGRESS_INTERVAL = 10.0
+
+
+def count_subprocess() -> None:
+    # Called for each git or p4 process we start, and counted against
+    # the step we are in, if any. Asynchronous tasks inherit the step
+    # they were created in, so steps running at once, such as exporting
+    # the filelogs and the labels, each count only their own.
+    step = _current_step.get()
+    if step is not None:
+        step.num_subprocesses += 1
+
+
+def _get_max_process_rss() -> int:
+    # In KiB: the most of any one process, whether us or one of our
+    # finished children. For us, this is the peak so far, not just
+    # during the current step.
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def _write_record(record: dict[str, Any]) -> None:
+    filename = os.environ.get("MERGETASTIC_STATS")
+    if not filename:
+        return
+    # One write of one line, appended, so that the records of processes
+    # running at once do not interleave.
+    with open(filename, "at", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def _format_duration(seconds: float) -> str:
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+@final
+class Step:
+    # A step of a stage, such as parsing the filelogs:
+    #
+    #     with Step("parse filelogs", total=len(paths), unit="files") as step:
+    #         for path in step.track(paths):
+    #             ...
+
+    def __init__(
+        self, name: str, *, total: Optional[int] = None, unit: str = "items"
+    ) -> None:
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.num_done = 0
+        self.num_subprocesses = 0
+        self.__start = 0.0
+        self.__last_printed = 0.0
+        self.__token: Optional[contextvars.Token[Optional[Step]]] = None
+
+    def __enter__(self) -> Self:
+        self.__start = self.__last_printed = time.perf_counter()
+        self.__token = _current_step.set(self)
+        return self
+
+    def __exit__(self, exc_type: object, *exc_info: object) -> None:
+        elapsed = time.perf_counter() - self.__start
+        assert self.__token is not None
+        _current_step.reset(self.__token)
+        _write_record(
+            {
+                "stage": os.environ.get("MERGETASTIC_STAGE"),
+                "step": self.name,
+                "ok": exc_type is None,
+                "seconds": round(elapsed, 3),
+                "items": self.num_done,
+                "unit": self.unit,
+                "items_per_second": round(self.num_done / elapsed, 1)
+                if elapsed > 0
+                else None,
+                "max_process_rss_kib": _get_max_process_rss(),
+                "subprocesses": self.num_subprocesses,
+            }
+        )
+        if elapsed >= _PROGRESS_INTERVAL:
+            print(
+                f"{self.name}: {self.num_done} {self.unit}"
+                f" in {_format_duration(elapsed)}",
+                file=sys.stderr,
+            )
+
+    def __str__(self) -> str:
+        elapsed = time.perf_counter() - self.__start
+        rate = self.num_done / elapsed if elapsed > 0 else 0.0
+        progress = f"{self.name}: {self.num_done}"
+        if self.total is not None:
+            percent = self.num_done / self.total * 100 if self.total else 100
+            progress += f" of {self.total}"
+        progress += f" {self.unit}"
+        if self.total is not None:
+            progress += f" ({percent:.1f}%)"
+        progress += f", {rate:.0f}/s"
+        if self.total is not None and rate > 0:
+            remaining = (self.total - self.num_done) / rate
+            progress += f", ETA {_format_duration(remaining)}"
+        return progress
+
+    def advance(self, num_items: int = 1) -> None:
+        self.num_done += num_items
+        now = time.perf_counter()
+        if now - self.__last_printed >= _PROGRESS_INTERVAL:
+            self.__last_printed = now
+            print(self, file=sys.stderr)
+
+    def track(self, items: Iterable[T]) -> Iterator[T]:
+        for item in items:
+            yield item
+            self.advance()
+
+
+_current_step = contextvars.ContextVar[Optional[Step]]("_current_step", default=None)
+
+
+def main(args: list[str]) -> None:
+    # Usage: stats.py STAGE COMMAND [ARG...]
+    if len(args) < 2:
+        raise Exception("usage: stats.py STAGE COMMAND [ARG...]")
+    stage = args[0]
+    filename = os.environ.get("MERGETASTIC_STATS")
+    # The subprocesses of a stage are counted by its steps, which have
+    # written their records by the time it finishes.
+    offset = os.path.getsize(filename) if filename and os.path.exists(filename) else 0
+    start = time.perf_counter()
+    proc = subprocess.run(args[1:], env=os.environ | {"MERGETASTIC_STAGE": stage})
+    elapsed = time.perf_counter() - start
+    num_subprocesses = 0
+    if filename and os.path.exists(filename):
+        with open(filename, "rt", encoding="utf-8") as f:
+            f.seek(offset)
+            for line in f:
+                record = json.loads(line)
+                if record["stage"] == stage:
+                    num_subprocesses += record["subprocesses"]
+    _write_record(
+        {
+            "stage": stage,
+            "step": None,
+            "ok": proc.returncode == 0,
+            "seconds": round(elapsed, 3),
+            "max_process_rss_kib": resource.getrusage(
+                resource.RUSAGE_CHILDREN
+            ).ru_maxrss,
+            "subprocesses": num_subprocesses,
+        }
+    )
+    print(f"Stage {stage} took {_format_duration(elapsed)}", file=sys.stderr)
+    sys.exit(proc.returncode)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,367 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Checks that the conversion has the same files, with the same contents,
+# as Perforce: each branch head against the branch's depot paths as of
+# its changelist, and each tag against its label. p4 fstat -Ol gives us
+# the MD5 of every file, so nothing need be synced, or printed: we only
+# hash the git side.
+#
+# The results are saved in the git directory, for each branch,
+# changelist and label, along with the tree they were for. So checking
+# again after an incremental conversion only checks what has changed.
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+from dataclasses import dataclass
+from typing import Optional, final
+
+from branchmap import RULES, split_path
+from commit_index import Commit, GitHash, get_commit_index
+from git import Branch, CatFile, git, git_lines, git_process
+from import_p4 import DELETE_ACTIONS
+from p4 import client
+from p4.client import Client, FileDigest
+from stats import Step
+
+# The keywords which p4 expands in files whose type has +k. The server
+# digests such files with the keywords unexpanded.
+_KEYWORD_RE = re.compile(
+    rb"\$(Id|Header|Author|Date|DateUTC|DateTime|DateTimeUTC|DateTimeTZ|Change"
+    rb"|File|Revision): [^$\n]*\$"
+)
+
+# Bump this whenever the saved format changes.
+_CACHE_FORMAT = 1
+
+# A branch, changelist and label (or None, for a branch head).
+CacheKey = tuple[Branch, int, Optional[str]]
+# The tree which was checked, and the differences found.
+CacheEntry = tuple[str, list[str]]
+
+
+@final
+@dataclass(frozen=True)
+class Target:
+    # A branch head, or a tag, which should have the same files as its
+    # branch in Perforce as of its changelist, or as its label.
+    ref: str
+    commit: Commit
+    label: Optional[str]
+
+    def get_revision_spec(self) -> str:
+        if self.label is not None:
+            return f"@{self.label}"
+        return f"@{self.commit.changelist}"
+
+    def get_cache_key(self) -> CacheKey:
+        return self.commit.branch, self.commit.changelist, self.label
+
+
+def get_targets(labels: set[str]) -> list[Target]:
+    commit_index = get_commit_index()
+    hash_to_commit = {
+        commit.hash: commit for commits in commit_index.values() for commit in commits
+    }
+    targets = [
+        Target(f"refs/heads/{branch}", commits[-1], None)
+        for branch, commits in commit_index.items()
+        if commits
+    ]
+    # make_tags.py names each tag after its label. The labels which p4
+    # does not have, from data/labels-extra/, are only a changelist.
+    for line in git_lines(
+        [
+            "for-each-ref",
+            "--format=%(refname) %(objectname) %(*objectname)",
+            "refs/tags/",
+        ]
+    ):
+        ref, *hashes = line.split()
+        commit = hash_to_commit.get(GitHash(hashes[-1]))
+        if commit is None:
+            raise Exception(f"{ref} is not on any branch")
+        label = ref.removeprefix("refs/tags/")
+        targets.append(Target(ref, commit, label if label in labels else None))
+    return targets
+
+
+def get_trees(targets: list[Target]) -> dict[str, str]:
+    if not targets:
+        return {}
+    trees = git(
+        ["rev-parse"] + [f"{target.commit.hash}^{{tree}}" for target in targets]
+    )
+    return {target.ref: tree for target, tree in zip(targets, trees.split())}
+
+
+def _get_cache_filename() -> str:
+    git_dir = git(["rev-parse", "--absolute-git-dir"]).strip()
+    return os.path.join(git_dir, "mergetastic", "verify-cache")
+
+
+def read_cache(filename: str) -> dict[CacheKey, CacheEntry]:
+    cache: dict[CacheKey, CacheEntry] = {}
+    try:
+        with open(filename, "rt", encoding="utf-8") as f:
+            if next(f, None) != f"format {_CACHE_FORMAT}\n":
+                return {}
+            for line in f:
+                entry = json.loads(line)
+                key = (Branch(entry["branch"]), entry["changelist"], entry["label"])
+                cache[key] = (entry["tree"], entry["differences"])
+    except FileNotFoundError:
+        pass
+    return cache
+
+
+def write_cache(filename: str, cache: dict[CacheKey, CacheEntry]) -> None:
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "wt", encoding="utf-8") as f:
+        f.write(f"format {_CACHE_FORMAT}\n")
+        for (branch, changelist, label), (tree, differences) in cache.items():
+            entry = {
+                "branch": branch,
+                "changelist": changelist,
+                "label": label,
+                "tree": tree,
+                "differences": differences,
+            }
+            f.write(json.dumps(entry) + "\n")
+    os.replace(tmp_filename, filename)
+
+
+def get_depot_specs(branch: Branch) -> list[str]:
+    # The depot paths which branchmap.py puts in the branch. Parts of
+    # these can belong to other branches, by more specific rules, which
+    # split_path sorts out.
+    return [
+        f"//depot/{rule.path}..." if rule.path.endswith("/") else f"//depot/{rule.path}"
+        for rule in RULES
+        if rule.branch == branch
+    ]
+
+
+async def get_depot_files(
+    p4: Client, target: Target
+) -> tuple[dict[str, FileDigest], set[str]]:
+    # The files which the target should have, by their paths in the
+    # branch. Also the paths whose head revision is in a changelist the
+    # conversion leaves out, which we cannot check: git has whichever
+    # revision came before.
+    results = await asyncio.gather(
+        *(
+            p4.fstat_digests(depot_spec + target.get_revision_spec())
+            for depot_spec in get_depot_specs(target.commit.branch)
+        )
+    )
+    depot_files = {}
+    unchecked = set()
+    for file_digest in itertools.chain.from_iterable(results):
+        rel_path = file_digest.path.removeprefix("//depot/")
+        location = split_path(rel_path, None)
+        if location is None or location[0] != target.commit.branch:
+            continue
+        branch_path = location[1]
+        if split_path(rel_path, file_digest.changelist) is None:
+            unchecked.add(branch_path)
+        elif file_digest.action not in DELETE_ACTIONS:
+            depot_files[branch_path] = file_digest
+    return depot_files, unchecked
+
+
+async def get_all_depot_files(
+    p4: Client, targets: list[Target], step: Step
+) -> list[tuple[dict[str, FileDigest], set[str]]]:
+    async def get(target: Target) -> tuple[dict[str, FileDigest], set[str]]:
+        result = await get_depot_files(p4, target)
+        step.advance()
+        return result
+
+    return await asyncio.gather(*(get(target) for target in targets))
+
+
+def get_git_files(commit: GitHash) -> dict[str, GitHash]:
+    # The blob of each file in the commit, from one git ls-tree.
+    with git_process(
+        ["ls-tree", "-r", "-z", commit], stdout=subprocess.PIPE
+    ) as ls_tree:
+        assert ls_tree.stdout is not None
+        output = ls_tree.stdout.read()
+    git_files = {}
+    for entry in output.split(b"\0"):
+        info, _, path = entry.partition(b"\t")
+        if info:
+            _, object_type, hash = info.decode("utf-8").split()
+            if object_type == "blob":
+                git_files[path.decode("utf-8", "surrogateescape")] = GitHash(hash)
+    return git_files
+
+
+def has_keywords(file_type: str) -> bool:
+    # Either a +k modifier, or one of the older names, like ktext.
+    base, _, modifiers = file_type.partition("+")
+    return "k" in modifiers or base.startswith("k")
+
+
+def get_md5(contents: bytes, keywords: bool) -> str:
+    # As Perforce digests the contents.
+    if keywords:
+        contents = _KEYWORD_RE.sub(rb"$\1$", contents)
+    return hashlib.md5(contents).hexdigest().upper()
+
+
+def hash_blobs(
+    blobs: set[tuple[GitHash, bool]], jobs: int
+) -> dict[tuple[GitHash, bool], str]:
+    # Each blob is read through the one git cat-file --batch, and hashed
+    # in a pool of threads. hashlib lets go of the GIL for all but the
+    # smallest inputs, so the threads hash in parallel, without copying
+    # the contents to other processes. Only so many blobs are in flight
+    # at once, to bound the memory.
+    keys = sorted(blobs)
+    md5s: dict[tuple[GitHash, bool], str] = {}
+    pending: collections.deque[
+        tuple[tuple[GitHash, bool], concurrent.futures.Future[str]]
+    ] = collections.deque()
+    with (
+        Step("hash blobs", total=len(keys), unit="blobs") as step,
+        CatFile() as cat_file,
+        concurrent.futures.ThreadPoolExecutor(jobs) as executor,
+    ):
+        for key, obj in zip(keys, cat_file.lookup_many(hash for hash, _ in keys)):
+            if obj is None or obj.content is None:
+                raise Exception(f"no such blob: {key[0]}")
+            pending.append((key, executor.submit(get_md5, obj.content, key[1])))
+            while len(pending) > 4 * jobs or (pending and pending[0][1].done()):
+                done_key, future = pending.popleft()
+                md5s[done_key] = future.result()
+                step.advance()
+        for done_key, future in pending:
+            md5s[done_key] = future.result()
+            step.advance()
+    return md5s
+
+
+def get_differences(
+    depot_files: dict[str, FileDigest],
+    git_files: dict[str, GitHash],
+    md5s: dict[tuple[GitHash, bool], str],
+) -> list[str]:
+    differences = []
+    for path in sorted(depot_files.keys() | git_files.keys()):
+        depot_file = depot_files.get(path)
+        blob = git_files.get(path)
+        if blob is None:
+            differences.append(f"missing {path}")
+        elif depot_file is None:
+            differences.append(f"extra {path}")
+        elif depot_file.digest is None:
+            # The server has not digested the file, so we cannot tell.
+            pass
+        elif md5s[(blob, has_keywords(depot_file.type))] != depot_file.digest:
+            differences.append(f"differs {path}")
+    return differences
+
+
+def main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Check that each branch head, and each tag, has the same files"
+        " as Perforce."
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of threads with which to hash the files",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="check everything afresh, not only what changed since the last check",
+    )
+    client.add_arguments(parser)
+    options = parser.parse_args(args)
+    p4 = client.from_arguments(options)
+    targets = get_targets(set(asyncio.run(p4.labels())))
+    trees = get_trees(targets)
+    cache_filename = _get_cache_filename()
+    cache = {} if options.no_cache else read_cache(cache_filename)
+    to_check = [
+        target
+        for target in targets
+        if cache.get(target.get_cache_key(), ("", []))[0] != trees[target.ref]
+    ]
+    with Step("get digests", total=len(to_check), unit="refs") as step:
+        depot_results = asyncio.run(get_all_depot_files(p4, to_check, step))
+    with Step("list trees", total=len(to_check), unit="refs") as step:
+        git_results = []
+        for target, (_, unchecked) in zip(step.track(to_check), depot_results):
+            git_files = get_git_files(target.commit.hash)
+            git_results.append(
+                {
+                    path: blob
+                    for path, blob in git_files.items()
+                    if path not in unchecked
+                }
+            )
+    blobs = {
+        (blob, has_keywords(depot_files[path].type))
+        for (depot_files, _), git_files in zip(depot_results, git_results)
+        for path, blob in git_files.items()
+        if path in depot_files and depot_files[path].digest is not None
+    }
+    md5s = hash_blobs(blobs, options.jobs)
+    for target, (depot_files, _), git_files in zip(
+        to_check, depot_results, git_results
+    ):
+        differences = get_differences(depot_files, git_files, md5s)
+        cache[target.get_cache_key()] = (trees[target.ref], differences)
+    write_cache(cache_filename, cache)
+    num_failed = 0
+    for target in targets:
+        _, differences = cache[target.get_cache_key()]
+        if differences:
+            num_failed += 1
+            print(
+                f"{target.ref} differs from {target.commit.branch}"
+                f"{target.get_revision_spec()}, in {len(differences)} files:"
+            )
+            for difference in differences:
+                print(f"  {difference}")
+    print(
+        f"Checked {len(targets)} branches and tags, {len(to_check)} of them afresh:"
+        f" {num_failed} differ from Perforce",
+        file=sys.stderr,
+    )
+    if num_failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+from pathlib import PurePosixPath
+from typing import Optional
+
+import pytest
+
+from branchmap import _TRIE, RULES, find_rule, get_branch_for_path, split_path
+from git import Branch
+from p4.filelog import ChangeList
+
+
+# get_branch_for_path as it was, a chain of ifs, before the rules.
+def old_get_branch_for_path(
+    path: PurePosixPath, changelist: ChangeList
+) -> Optional[Branch]:
+    assert str(path).startswith("//depot/")
+    rel_path = str(path).removeprefix("//depot/")
+    if rel_path.startswith("openwatcom/"):
+        return Branch("openwatcom")
+    if rel_path.startswith("ow_devel/CVDebug_dev5/"):
+        return Branch("CVDebug_dev")
+    if rel_path.startswith("ow_devel/fortran.F03.dev/"):
+        return Branch("F2003_Development")
+    if rel_path.startswith("ow_devel/fortran.F95.dev/"):
+        return Branch("F95_Development")
+    if rel_path.startswith("ow_devel/rdos/"):
+        return Branch("RDOS")
+    if rel_path.startswith("V2/"):
+        return Branch("V2")
+    if rel_path.startswith("ow_devel/bld/wasm/"):
+        if changelist in {ChangeList(31816), ChangeList(31829)}:
+            return None
+        return Branch("WASM")
+    if rel_path.startswith("ow_devel/zdos19/"):
+        return None
+    if (
+        rel_path.startswith("ow_devel/zdos/")
+        or rel_path.startswith("ow_devel/bld/build/")
+        or rel_path.startswith("ow_devel/bld/clib/")
+        or rel_path.startswith("ow_devel/bld/hdr/")
+        or rel_path.startswith("ow_devel/binnt/")
+        or rel_path.startswith("ow_devel/binw/")
+        or rel_path == "ow_devel/binz/wlink.lnk"
+        or rel_path.startswith("ow_devel/docs/")
+    ):
+        if changelist in {
+            # Added files from ow_devel/ to ow_devel/zdos, so these
+            # disappear because we merge those into the one dir/branch.
+            ChangeList(31810),
+            ChangeList(31812),
+            # The files were then deleted in the original dir; we
+            # deleted that commit because, again, we merged the dirs.
+            ChangeList(31816),
+        }:
+            return None
+        if changelist in {
+            # In addition to legit changes, wasm and wmake.dev were
+            # accidentally removed
+            ChangeList(31813),
+            ChangeList(31829),  # And this accidental change was undone.
+        }:
+            if rel_path.startswith("ow_devel/zdos/bld/wasm/") or rel_path.startswith(
+                "ow_devel/zdos/bld/wmake.dev/"
+            ):
+                return None
+        return Branch("ZDOS")
+    if rel_path == "ow_devel/binz/zdos/wlink.lnk":
+        return None
+    if rel_path == "ow_devel/bldhdr/watcom/zapi.mh":
+        return None
+    if rel_path.startswith("ow_devel/dwarf3/"):
+        return Branch("dwarf3")
+    if rel_path.startswith("ow_devel/long_double/"):
+        return Branch("long_double")
+    if rel_path.startswith("ow_release/1.0/"):
+        return Branch("openwatcom_1.0")
+    if rel_path.startswith("ow_devel/intel_owl/"):
+        return Branch("openwatcom_bld_devel")
+    if rel_path.startswith("ow_devel/plusplus.dev/"):
+        return Branch("plusplus.dev")
+    if rel_path.startswith("ow_devel/plusplus.ext/"):
+        return Branch("plusplus.ext")
+    if rel_path.startswith("ow_devel/bld/wmake.dev/"):
+        if changelist in {ChangeList(31816), ChangeList(31829)}:
+            return None
+        return Branch("wmake.dev")
+    if rel_path.startswith("ow_devel/bld/wl/"):
+        if changelist in {
+            ChangeList(31811),
+            ChangeList(31816),
+            ChangeList(32369),
+            ChangeList(32374),
+        }:
+            return None
+        return Branch("wlink")
+    if rel_path.startswith("ow_devel/bld/cvpack/") or rel_path.startswith(
+        "ow_devel/bld/watcom/"
+    ):
+        return None
+    if rel_path.startswith("ow_devel/fortran.dev/"):
+        if rel_path.startswith("ow_devel/fortran.dev/bld/F03/c/"):
+            return None
+        return Branch("fortran.dev")
+    if rel_path == "ow_release/bld/wipfc/cpp/fts.cpp":
+        return None
+    if rel_path.startswith("public/4os2/"):
+        return None
+    if rel_path.startswith("public/c4/"):
+        return None
+    if rel_path.startswith("public/convman/"):
+        return None
+    if rel_path.startswith("public/dmake/"):
+        return None
+    if rel_path.startswith("public/nasm/"):
+        return None
+    if rel_path.startswith("public/ozh/"):
+        return None
+    if rel_path.startswith("public/wcclibc/"):
+        return None
+    if rel_path.startswith("public/wcclinux/"):
+        return None
+    if rel_path.startswith("public/wp51vesa/"):
+        return None
+    if rel_path == "robots.txt":
+        return None
+    raise ValueError(path, changelist)
+
+
+# Where each branch was rooted by split-branches.sh, which ran git
+# filter-repo --subdirectory-filter once per branch. ZDOS also took the
+# files it had in ow_devel/, before ow_devel/zdos/ existed.
+_OLD_BRANCH_ROOTS = {
+    Branch("openwatcom"): "openwatcom/",
+    Branch("CVDebug_dev"): "ow_devel/CVDebug_dev5/",
+    Branch("F2003_Development"): "ow_devel/fortran.F03.dev/",
+    Branch("F95_Development"): "ow_devel/fortran.F95.dev/",
+    Branch("RDOS"): "ow_devel/rdos/",
+    Branch("V2"): "V2/",
+    Branch("WASM"): "ow_devel/bld/wasm/",
+    Branch("dwarf3"): "ow_devel/dwarf3/",
+    Branch("long_double"): "ow_devel/long_double/",
+    Branch("openwatcom_1.0"): "ow_release/1.0/",
+    Branch("openwatcom_bld_devel"): "ow_devel/intel_owl/",
+    Branch("plusplus.dev"): "ow_devel/plusplus.dev/",
+    Branch("plusplus.ext"): "ow_devel/plusplus.ext/",
+    Branch("wmake.dev"): "ow_devel/bld/wmake.dev/",
+    Branch("wlink"): "ow_devel/bld/wl/",
+    Branch("fortran.dev"): "ow_devel/fortran.dev/",
+}
+
+
+def old_split_path(
+    rel_path: str, changelist: ChangeList
+) -> Optional[tuple[Branch, str]]:
+    try:
+        branch = old_get_branch_for_path(
+            PurePosixPath(f"//depot/{rel_path}"), changelist
+        )
+    except ValueError:
+        return None
+    if branch is None:
+        return None
+    if branch == "ZDOS":
+        root = (
+            "ow_devel/zdos/" if rel_path.startswith("ow_devel/zdos/") else "ow_devel/"
+        )
+    else:
+        root = _OLD_BRANCH_ROOTS[branch]
+    return branch, rel_path.removeprefix(root)
+
+
+def _probe_paths() -> list[str]:
+    # Each rule's path, and paths either side of every boundary: in and
+    # below each directory of it, beside it, and just past its name.
+    paths = set()
+    for rule in RULES:
+        path = rule.path.removesuffix("/")
+        parts = path.split("/")
+        for i in range(len(parts) + 1):
+            ancestor = "/".join(parts[:i])
+            prefix = f"{ancestor}/" if ancestor else ""
+            paths.add(f"{prefix}file.c")
+            paths.add(f"{prefix}other/file.c")
+        paths |= {
+            path,
+            f"{path}x",
+            f"{path}x/file.c",
+            f"{path}/file.c",
+            f"{path}/sub/file.c",
+            f"{path}/bld/wasm/file.c",
+            f"{path}/bld/wmake.dev/file.c",
+        }
+    return sorted(paths)
+
+
+def _probe_changelists() -> list[ChangeList]:
+    # Each excluded changelist, and those either side of it.
+    excluded = set().union(*(rule.excluded_changelists for rule in RULES))
+    return sorted(
+        {ChangeList(1)}
+        | {
+            ChangeList(changelist + delta)
+            for changelist in excluded
+            for delta in (-1, 0, 1)
+        }
+    )
+
+
+def _branch_or_error(path: PurePosixPath, changelist: ChangeList, old: bool) -> object:
+    get_branch = old_get_branch_for_path if old else get_branch_for_path
+    try:
+        return get_branch(path, changelist)
+    except ValueError as e:
+        return ValueError, e.args
+
+
+@pytest.mark.parametrize("rel_path", _probe_paths())
+def test_get_branch_for_path(rel_path: str) -> None:
+    path = PurePosixPath(f"//depot/{rel_path}")
+    for changelist in _probe_changelists():
+        assert _branch_or_error(path, changelist, old=False) == _branch_or_error(
+            path, changelist, old=True
+        ), changelist
+
+
+@pytest.mark.parametrize("rel_path", _probe_paths())
+def test_split_path(rel_path: str) -> None:
+    for changelist in _probe_changelists():
+        assert split_path(rel_path, changelist) == old_split_path(
+            rel_path, changelist
+        ), changelist
+
+
+def test_probes_reach_every_rule() -> None:
+    # Otherwise the tests above would say little about the exceptions.
+    # Every changelist is tried with every path, so that covers each
+    # rule's excluded changelists too.
+    reached = {find_rule(_TRIE, rel_path) for rel_path in _probe_paths()}
+    assert reached - {None} == set(RULES)
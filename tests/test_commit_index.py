@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from commit_index import Commit, GitHash, _build_commit_index, _get_branch_tips
+from git import Branch
+from p4.filelog import ChangeList
+
+
+def _commit(message: str) -> GitHash:
+    subprocess.run(
+        ["git", "commit", "--quiet", "--allow-empty", "-m", message], check=True
+    )
+    return GitHash(
+        subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    )
+
+
+def test_changelist_only_from_body(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    for name, value in [
+        ("GIT_AUTHOR_NAME", "a"),
+        ("GIT_AUTHOR_EMAIL", "a@example.com"),
+        ("GIT_COMMITTER_NAME", "a"),
+        ("GIT_COMMITTER_EMAIL", "a@example.com"),
+    ]:
+        monkeypatch.setenv(name, value)
+    subprocess.run(["git", "init", "--quiet", "-b", "main"], check=True)
+    first = _commit(
+        "12 - Revert P4:5, from\n"
+        '[p4-fusion: depot-paths = "//depot/": change = 6]\n'
+        "\n"
+        '[p4-fusion: depot-paths = "//depot/": change = 12]'
+    )
+    second = _commit("P4:99\n\nP4:13")
+    index = _build_commit_index(_get_branch_tips())
+    assert index == {
+        Branch("main"): [
+            Commit(ChangeList(12), Branch("main"), first),
+            Commit(ChangeList(13), Branch("main"), second),
+        ]
+    }
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime
+from pathlib import Path
+
+import pytest
+
+from export_filelogs import update_filelogs
+from p4.filelog import ChangedFile
+
+# Not UTF-8: é in Latin-1.
+_PATH = b"//depot/caf\xe9.c"
+
+
+class _FakeLimit:
+    maximum = 2
+
+
+class _FakeClient:
+    # Just what export_filelogs needs, giving the new revision of _PATH.
+    limit = _FakeLimit()
+
+    async def get_server_timezone(self) -> datetime.tzinfo:
+        return datetime.timezone.utc
+
+    async def filelog(self, paths: list[str], tz: datetime.tzinfo) -> list[ChangedFile]:
+        assert paths == [_PATH.decode("utf-8", errors="surrogateescape")]
+        record = {
+            b"depotFile": _PATH,
+            b"rev0": b"2",
+            b"change0": b"7",
+            b"action0": b"edit",
+            b"time0": b"1000000000",
+            b"user0": b"u",
+            b"client0": b"c",
+            b"type0": b"text",
+            b"desc0": b"new",
+        }
+        return [ChangedFile.from_tagged(record, tz)]
+
+
+def test_update_non_utf8_path(tmp_path: Path) -> None:
+    out_dir = tmp_path / "filelogs"
+    out_dir.mkdir()
+    (out_dir / "filelog000.txt").write_bytes(
+        _PATH
+        + b"\n... #1 change 5 add on 2001/09/08 by u@c (text) 'old'\n"
+        + b"//depot/other.c\n"
+        + b"... #1 change 6 add on 2001/09/08 by u@c (text) 'other'\n"
+    )
+    paths = [_PATH.decode("utf-8", errors="surrogateescape")]
+    asyncio.run(
+        update_filelogs(_FakeClient(), paths, str(out_dir), batch_size=10)  # type: ignore[arg-type]
+    )
+    assert sorted(path.name for path in out_dir.iterdir()) == ["filelog000.txt"]
+    assert (out_dir / "filelog000.txt").read_bytes() == (
+        b"//depot/other.c\n"
+        + b"... #1 change 6 add on 2001/09/08 by u@c (text) 'other'\n"
+        + _PATH
+        + b"\n... #2 change 7 edit on 2001/09/09 by u@c (text) 'new'\n"
+    )
+
+
+def test_update_without_filelogs(tmp_path: Path) -> None:
+    out_dir = tmp_path / "filelogs"
+    out_dir.mkdir()
+    with pytest.raises(Exception, match="no filelogs"):
+        asyncio.run(
+            update_filelogs(_FakeClient(), [], str(out_dir), batch_size=10)  # type: ignore[arg-type]
+        )
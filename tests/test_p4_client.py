@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import marshal
+
+import pytest
+
+from p4.client import Record, _read_records
+
+
+async def _read(data: bytes, chunk_size: int) -> list[Record]:
+    stream = asyncio.StreamReader()
+    for i in range(0, len(data), chunk_size):
+        stream.feed_data(data[i : i + chunk_size])
+    stream.feed_eof()
+    return [record async for record in _read_records(stream)]
+
+
+_SMALL_RECORDS = [
+    {b"code": b"stat", b"depotFile": b"//depot/%d" % i} for i in range(100)
+]
+# As from p4 print -G of a big file, between small records.
+_BIG_RECORDS = (
+    _SMALL_RECORDS[:50]
+    + [{b"code": b"binary", b"data": bytes(range(256)) * 40000}]
+    + _SMALL_RECORDS[50:]
+)
+
+
+@pytest.mark.parametrize(
+    "records, chunk_size",
+    [
+        (_SMALL_RECORDS, 1),
+        (_SMALL_RECORDS, 10),
+        (_BIG_RECORDS, 1000),
+        (_BIG_RECORDS, 1 << 16),
+        (_BIG_RECORDS, 1 << 30),
+    ],
+)
+def test_read_records(records: list[Record], chunk_size: int) -> None:
+    data = b"".join(marshal.dumps(record) for record in records)
+    assert asyncio.run(_read(data, chunk_size)) == records
+
+
+def test_read_records_incomplete() -> None:
+    data = marshal.dumps({b"code": b"stat"}) + marshal.dumps({b"code": b"stat"})[:-1]
+    with pytest.raises(Exception, match="middle of a record"):
+        asyncio.run(_read(data, 3))
@@ -0,0 +1,1135 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Benchmarks for the conversion stages, run against synthetic depots.
+
+import argparse
+import asyncio
+import concurrent.futures
+import gc
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from collections.abc import Callable
+from pathlib import Path, PurePosixPath
+from typing import Any, Optional, TypeVar
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tests"))
+
+import synthetic_depot  # noqa: E402
+from test_branchmap import old_get_branch_for_path  # noqa: E402
+from branchmap import RULES, get_branch_for_path  # noqa: E402
+from commit_index import (  # noqa: E402
+    Commit,
+    GitHash,
+    get_commit_index,
+    read_commit_index,
+)
+from export_filelogs import export_filelogs  # noqa: E402
+from list_files import list_files, read_files  # noqa: E402
+from git import (  # noqa: E402
+    Branch,
+    CatFile,
+    git,
+    replace_grafts,
+    update_refs,
+    write_objects,
+)
+from make_merges import (  # noqa: E402
+    get_changelist_index,
+    get_commit_to_deps,
+    get_grafts,
+)
+from make_tags import make_git_tag, read_label  # noqa: E402
+from p4.client import Client  # noqa: E402
+from p4.filelog import (  # noqa: E402
+    ChangedFile,
+    ChangeList,
+    FileChange,
+    get_path_to_changed_file,
+    iter_changed_files,
+)
+
+FAKE_P4 = Path(__file__).resolve().parent / "fake_p4.py"
+MAKE_MERGES = Path(__file__).resolve().parent.parent / "src" / "make_merges.py"
+
+T = TypeVar("T")
+
+
+def get_branch_to_commits(
+    depot: synthetic_depot.SyntheticDepot,
+) -> dict[Branch, set[Commit]]:
+    branch_to_commits: dict[Branch, set[Commit]] = {}
+    for changelist, branch in depot.changelists:
+        commit = Commit(changelist, branch, GitHash(f"{changelist:040x}"))
+        branch_to_commits.setdefault(branch, set()).add(commit)
+    return branch_to_commits
+
+
+def _branch_or_error(
+    get_branch: Callable[[PurePosixPath, ChangeList], Optional[Branch]],
+    path: PurePosixPath,
+    changelist: ChangeList,
+) -> tuple[Optional[Branch], Optional[str]]:
+    try:
+        return get_branch(path, changelist), None
+    except ValueError as e:
+        return None, repr(e)
+
+
+def bench_branchmap(args: argparse.Namespace) -> None:
+    # Every depot path in the filelog, whether of a file or the source
+    # of an integration, with every changelist which some rule excludes,
+    # and one which none does.
+    if args.filelogs is not None:
+        changed_files = list(iter_changed_files(args.filelogs))
+    else:
+        changed_files = synthetic_depot.generate(
+            num_files=args.files,
+            num_branches=args.branches,
+            revisions_per_file=args.revisions,
+            integration_density=args.integration_density,
+        ).changed_files
+    paths = sorted(
+        {changed_file.path for changed_file in changed_files}
+        | {
+            sub_change.path
+            for changed_file in changed_files
+            for file_change in changed_file.file_changes
+            for sub_change in file_change.sub_changes
+        }
+    )
+    changelists = sorted(
+        set().union(*(rule.excluded_changelists for rule in RULES))
+    ) + [ChangeList(1)]
+    timings = []
+    results = []
+    for get_branch in [old_get_branch_for_path, get_branch_for_path]:
+        start = time.perf_counter()
+        results.append(
+            [
+                _branch_or_error(get_branch, path, changelist)
+                for path in paths
+                for changelist in changelists
+            ]
+        )
+        timings.append(time.perf_counter() - start)
+    checks = list(itertools.product(paths, changelists))
+    differences = [
+        (check, old, new)
+        for check, old, new in zip(checks, results[0], results[1])
+        if old != new
+    ]
+    for (path, changelist), old, new in differences[:10]:
+        print(f"{path} in {changelist}: if-chain {old}, rules {new}")
+    print(
+        f"paths: {len(paths)}  changelists: {len(changelists)}"
+        f"  checks: {len(checks)}  differences: {len(differences)}"
+    )
+    print(
+        f"if-chain {timings[0]:6.3f} s  rules {timings[1]:6.3f} s"
+        f"  speed-up {timings[0] / timings[1]:4.1f}x"
+    )
+    if differences:
+        sys.exit(1)
+
+
+def bench_deps(args: argparse.Namespace) -> None:
+    print("revisions/file  revisions  sub-changes  seconds")
+    for revisions_per_file in args.revisions:
+        depot = synthetic_depot.generate(
+            num_files=args.files,
+            num_branches=args.branches,
+            revisions_per_file=revisions_per_file,
+            integration_density=args.integration_density,
+        )
+        path_to_changed_file = {
+            changed_file.path: changed_file for changed_file in depot.changed_files
+        }
+        branch_to_commits = get_branch_to_commits(depot)
+        num_revisions = sum(len(cf.file_changes) for cf in depot.changed_files)
+        num_sub_changes = sum(
+            len(fc.sub_changes) for cf in depot.changed_files for fc in cf.file_changes
+        )
+        # Keep the collector from rescanning the synthetic depot, which
+        # would otherwise dominate the timings.
+        gc.collect()
+        gc.freeze()
+        start = time.perf_counter()
+        changelist_index = get_changelist_index(path_to_changed_file.values())
+        get_commit_to_deps(
+            path_to_changed_file.values(), changelist_index, branch_to_commits
+        )
+        elapsed = time.perf_counter() - start
+        gc.unfreeze()
+        print(
+            f"{revisions_per_file:14}  {num_revisions:9}"
+            f"  {num_sub_changes:11}  {elapsed:7.3f}"
+        )
+
+
+def bench_deps_jobs(args: argparse.Namespace) -> None:
+    # How get_commit_to_deps scales with the number of processes, each
+    # result checked against the serial one, down to its order.
+    depot = synthetic_depot.generate(
+        num_files=args.files,
+        num_branches=args.branches,
+        revisions_per_file=args.revisions,
+        integration_density=args.integration_density,
+    )
+    changed_files = depot.changed_files
+    changelist_index = get_changelist_index(changed_files)
+    branch_to_commits = get_branch_to_commits(depot)
+    num_jobs = args.jobs
+    if num_jobs is None:
+        cpus = os.cpu_count() or 1
+        num_jobs = sorted({1, cpus} | {2**i for i in range(cpus.bit_length())})
+    print(f"files: {len(changed_files)}  cpus: {os.cpu_count()}")
+    print("jobs  seconds  speed-up  same")
+    expected = None
+    serial = 0.0
+    for jobs in num_jobs:
+        gc.collect()
+        start = time.perf_counter()
+        commit_to_deps = get_commit_to_deps(
+            changed_files, changelist_index, branch_to_commits, jobs=jobs
+        )
+        elapsed = time.perf_counter() - start
+        result = [(commit, list(deps)) for commit, deps in commit_to_deps.items()]
+        if expected is None:
+            expected = result
+            serial = elapsed
+        print(
+            f"{jobs:4}  {elapsed:7.2f}  {serial / elapsed:8.2f}  {result == expected}"
+        )
+
+
+def bench_memory(args: argparse.Namespace) -> None:
+    depot = synthetic_depot.generate(
+        num_files=args.files,
+        num_branches=args.branches,
+        revisions_per_file=args.revisions,
+        integration_density=args.integration_density,
+    )
+    num_revisions = sum(len(cf.file_changes) for cf in depot.changed_files)
+    with tempfile.TemporaryFile("w+t") as f:
+        for changed_file in depot.changed_files:
+            print(changed_file, file=f)
+        f.seek(0)
+        del depot
+        gc.collect()
+        tracemalloc.start()
+        path_to_changed_file = {
+            changed_file.path: changed_file for changed_file in ChangedFile.parse(f)
+        }
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    assert len(path_to_changed_file) > 0
+    print(f"revisions:          {num_revisions}")
+    print(f"retained:           {current / 2**20:.1f} MiB")
+    print(f"peak:               {peak / 2**20:.1f} MiB")
+    print(f"bytes per revision: {current / num_revisions:.0f}")
+
+
+# Lines which the fast path must leave to the regex, or parse just as
+# the regex does.
+_ODD_LINES = [
+    "... #1 change 2 edit on 2003/01/24 by a@b (text+x) 'it's by me '",
+    "... #1 change 2 edit on 2003/01/24 by a@b (text) ''",
+    "... #1 change 2 edit on 2003/01/24 by a@b (text) '",
+    "... #1 change 2 edit on 2003/1/24 by a@b (text) 'x'",
+    "... #1 change 2 edit on 2003/01/24 by a@b (ktext) 'x'",
+    "... #1 change 2 move/delete on 2003/01/24 by a@b (text) 'x'",
+    "... #1 change 2 edit on 2003/01/24 by  (text) 'x'",
+    "... #١ change 2 edit on 2003/01/24 by a@b (text) 'x'",
+]
+
+
+def _parse_all(
+    parse_line: Callable[[str], Any], lines: list[str]
+) -> list[tuple[Optional[Any], Optional[str]]]:
+    results: list[tuple[Optional[Any], Optional[str]]] = []
+    for line in lines:
+        try:
+            results.append((parse_line(line), None))
+        except Exception as e:
+            results.append((None, str(e)))
+    return results
+
+
+def bench_parse(args: argparse.Namespace) -> None:
+    depot = synthetic_depot.generate(
+        num_files=args.files,
+        num_branches=args.branches,
+        revisions_per_file=args.revisions,
+        integration_density=args.integration_density,
+    )
+    lines = "\n".join(str(cf) for cf in depot.changed_files).splitlines()
+    del depot
+    file_change_lines = [line for line in lines if line.startswith("... #")]
+    print(f"lines: {len(lines)}  revisions: {len(file_change_lines)}")
+    # The best of a few runs, taking turns, as the timings are noisy.
+    timings = [float("inf"), float("inf")]
+    for _ in range(args.repeat):
+        for i, parse_line in enumerate(
+            [FileChange.parse_line_with_regex, FileChange.parse_line]
+        ):
+            gc.collect()
+            start = time.perf_counter()
+            for line in file_change_lines:
+                parse_line(line)
+            timings[i] = min(timings[i], time.perf_counter() - start)
+    # Every line, odd ones included, must give the same object, or the
+    # same error.
+    some_lines = file_change_lines + _ODD_LINES
+    same = _parse_all(FileChange.parse_line_with_regex, some_lines) == _parse_all(
+        FileChange.parse_line, some_lines
+    )
+    print(
+        f"revisions: regex {timings[0]:6.3f} s  fast {timings[1]:6.3f} s"
+        f"  speed-up {timings[0] / timings[1]:4.1f}x  same: {same}"
+    )
+
+    with tempfile.TemporaryFile("w+t") as f:
+        print("\n".join(lines), file=f)
+        f.seek(0)
+        # As in get_path_to_changed_file.
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter()
+        num_files = sum(1 for _ in ChangedFile.parse(f))
+        elapsed = time.perf_counter() - start
+        gc.enable()
+    print(
+        f"whole filelog: {num_files} files in {elapsed:.3f} s,"
+        f" {len(lines) / elapsed:.0f} lines/s"
+    )
+
+
+def make_repo(num_commits: int, num_branches: int) -> list[list[str]]:
+    # A repo in the current directory with num_commits commits, spread
+    # round robin across linear branches. Returns each branch's commits.
+    git(["init", "--quiet"])
+    stream = []
+    for i in range(num_commits):
+        message = f"Change {i + 1}\n\nP4:{i + 1}\n".encode("utf-8")
+        content = f"{i}\n".encode("utf-8")
+        stream += [
+            f"commit refs/heads/branch{i % num_branches}\n".encode("utf-8"),
+            f"mark :{i + 1}\n".encode("utf-8"),
+            f"committer Someone <> {1000000000 + i} +0000\n".encode("utf-8"),
+            f"data {len(message)}\n".encode("utf-8") + message,
+            f"M 644 inline file\ndata {len(content)}\n".encode("utf-8") + content,
+            b"\n",
+        ]
+    subprocess.run(
+        ["git", "fast-import", "--quiet"], input=b"".join(stream), check=True
+    )
+    return [
+        git(["rev-list", "--reverse", f"branch{branch}"]).split()
+        for branch in range(num_branches)
+    ]
+
+
+def bench_graft(args: argparse.Namespace) -> None:
+    # Graft every commit, except on the first branch, to merge from the
+    # previous branch.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        branch_commits = make_repo(args.commits, args.branches)
+        grafts: dict[str, list[str]] = {}
+        for branch, commits in enumerate(branch_commits[1:], start=1):
+            sources = branch_commits[branch - 1]
+            for i, commit in enumerate(commits):
+                parents = [commits[i - 1]] if i > 0 else []
+                grafts[commit] = parents + [sources[min(i, len(sources) - 1)]]
+        print(f"commits: {args.commits}  grafts: {len(grafts)}")
+
+        start = time.perf_counter()
+        with CatFile() as cat_file:
+            replace_grafts(grafts, cat_file)
+        elapsed = time.perf_counter() - start
+        print(f"bulk:                    {elapsed:8.2f} s")
+        bulk_refs = git(["for-each-ref", "refs/replace/"])
+
+        if args.compare:
+            update_refs([f"delete {ref.split()[-1]}" for ref in bulk_refs.splitlines()])
+            start = time.perf_counter()
+            for commit, parents in grafts.items():
+                git(["replace", "--graft", commit] + parents)
+            elapsed = time.perf_counter() - start
+            print(f"git replace per commit:  {elapsed:8.2f} s")
+            same = git(["for-each-ref", "refs/replace/"]) == bulk_refs
+            print(f"same replacements: {same}")
+
+
+def make_commit_graph(
+    num_commits: int, num_branches: int, merge_rate: float
+) -> tuple[dict[Branch, set[Commit]], dict[Commit, set[Commit]]]:
+    # Commits spread at random across the branches, each depending on a
+    # random earlier commit, of any branch, with probability merge_rate.
+    rng = random.Random(0)
+    branch_to_commits: dict[Branch, set[Commit]] = {}
+    commit_to_deps: dict[Commit, set[Commit]] = {}
+    commits: list[Commit] = []
+    for changelist in range(1, num_commits + 1):
+        branch = Branch(f"branch{rng.randrange(num_branches)}")
+        commit = Commit(ChangeList(changelist), branch, GitHash(f"{changelist:040x}"))
+        if commits and rng.random() < merge_rate:
+            dep = rng.choice(commits)
+            if dep.branch != branch:
+                commit_to_deps[commit] = {dep}
+        branch_to_commits.setdefault(branch, set()).add(commit)
+        commits.append(commit)
+    return branch_to_commits, commit_to_deps
+
+
+def networkx_grafts(
+    branch_to_commits: dict[Branch, set[Commit]],
+    commit_to_deps: dict[Commit, set[Commit]],
+) -> dict[str, list[str]]:
+    # make_merges.get_grafts as it was, with networkx, for comparison.
+    import networkx as nx
+
+    G = nx.DiGraph()
+    for branch, branch_commits in branch_to_commits.items():
+        commits = sorted(branch_commits, key=lambda commit: commit.changelist)
+        G.add_nodes_from(commits)
+        G.add_edges_from(itertools.pairwise(commits))
+    for commit, deps in commit_to_deps.items():
+        for dep_branch in {dep.branch for dep in deps}:
+            latest_dep = max(
+                (dep for dep in deps if dep.branch == dep_branch),
+                key=lambda commit: commit.changelist,
+            )
+            G.add_edge(latest_dep, commit)
+    assert nx.is_directed_acyclic_graph(G)
+    branch_starts = set(
+        min(commits, key=lambda commit: commit.changelist)
+        for commits in branch_to_commits.values()
+    )
+    H = G.reverse()
+    grafts = {}
+    for cmt in nx.topological_sort(H):
+        adj = H.adj[cmt]
+        if len(adj) > 1 or cmt in branch_starts:
+            grafts[cmt.hash] = [a.hash for a in adj]
+    return grafts
+
+
+def _measure(function: Callable[..., T], *args: Any) -> tuple[T, float, int]:
+    # The result, seconds taken, and peak memory allocated, of a call.
+    # The memory is measured by a second call, because tracemalloc
+    # slows everything down.
+    gc.collect()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_graph(args: argparse.Namespace) -> None:
+    print("   commits   grafts  seconds  peak MiB", end="")
+    if args.compare:
+        print("  networkx s  networkx MiB  same grafts", end="")
+    print()
+    for num_commits in args.commits:
+        branch_to_commits, commit_to_deps = make_commit_graph(
+            num_commits, args.branches, args.merge_rate
+        )
+        commit_grafts, elapsed, peak = _measure(
+            get_grafts, branch_to_commits, defaultdict(set, commit_to_deps)
+        )
+        grafts = {
+            commit.hash: [parent.hash for parent in parents]
+            for commit, parents in commit_grafts.items()
+        }
+        print(
+            f"{num_commits:10}  {len(grafts):7}  {elapsed:7.2f}  {peak / 2**20:8.1f}",
+            end="",
+        )
+        if args.compare:
+            old_grafts, elapsed, peak = _measure(
+                networkx_grafts, branch_to_commits, commit_to_deps
+            )
+            print(
+                f"  {elapsed:10.2f}  {peak / 2**20:12.1f}  {grafts == old_grafts}",
+                end="",
+            )
+        print()
+
+
+def bench_export(args: argparse.Namespace) -> None:
+    # Exports the filelogs of a synthetic depot, from the fake p4, and
+    # checks we get back what was recorded.
+    depot = synthetic_depot.generate(
+        num_files=args.files,
+        num_branches=args.branches,
+        revisions_per_file=args.revisions,
+        integration_density=args.integration_density,
+    )
+    expected = {cf.path: cf for cf in depot.changed_files}
+    paths = sorted(str(path) for path in expected)
+    p4 = [sys.executable, str(FAKE_P4)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        recording = os.path.join(tmpdir, "recording.txt")
+        with open(recording, "wt", encoding="utf-8") as f:
+            for changed_file in depot.changed_files:
+                print(changed_file, file=f)
+        os.environ["FAKE_P4_FILELOG"] = recording
+        os.environ["FAKE_P4_LATENCY"] = str(args.latency)
+        print(f"files: {len(paths)}  jobs: {args.jobs}  latency: {args.latency} s")
+
+        out_dir = os.path.join(tmpdir, "filelogs")
+        start = time.perf_counter()
+        client = Client(p4, max_concurrency=args.jobs)
+        asyncio.run(export_filelogs(client, paths, out_dir, batch_size=args.batch_size))
+        elapsed = time.perf_counter() - start
+        print(f"batches of {args.batch_size}: {elapsed:8.2f} s")
+        exported = {cf.path: cf for cf in iter_changed_files(out_dir)}
+        print(f"same filelogs: {exported == expected}")
+
+        if args.compare:
+            # As main.sh used to, with parallel --keep-order -n1.
+            start = time.perf_counter()
+            with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+                outputs = executor.map(
+                    lambda path: subprocess.run(
+                        p4 + ["filelog", path], stdout=subprocess.PIPE, check=True
+                    ).stdout,
+                    paths,
+                )
+                with open(os.path.join(tmpdir, "filelogs.txt"), "wb") as f:
+                    for output in outputs:
+                        f.write(output)
+            elapsed = time.perf_counter() - start
+            print(f"one file per p4:  {elapsed:8.2f} s")
+            exported = {
+                cf.path: cf
+                for cf in iter_changed_files(os.path.join(tmpdir, "filelogs.txt"))
+            }
+            print(f"same filelogs: {exported == expected}")
+
+
+# How main.sh used to list the files, with xargs standing in for GNU
+# parallel.
+OLD_LIST_FILES = r"""
+p4 changes -s submitted //depot/... |
+  sed -E -e 's/^Change ([0-9]+) on .*/\1/' >changelists.txt
+xargs <changelists.txt -P"$1" -d'\n' -n1 sh -c "p4 describe -s \"\$0\" |
+  sed -e '1,/Affected files \.\.\./d' | grep '^\.\.\.' |
+  sed -nE -e 's/ [a-z]+$//gp' | sed -nE -e 's/#[0-9]+$//gp' |
+  sed -n -e 's/^\.\.\. //gp'" |
+  LC_ALL=C sort | uniq >files.txt
+"""
+
+
+def bench_files(args: argparse.Namespace) -> None:
+    # Lists the files of a synthetic depot, from the fake p4.
+    depot = synthetic_depot.generate(
+        num_files=args.files,
+        num_branches=args.branches,
+        revisions_per_file=args.revisions,
+        integration_density=args.integration_density,
+    )
+    expected = sorted(str(cf.path) for cf in depot.changed_files)
+    num_revisions = sum(len(cf.file_changes) for cf in depot.changed_files)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        recording = os.path.join(tmpdir, "recording.txt")
+        with open(recording, "wt", encoding="utf-8") as f:
+            for changed_file in depot.changed_files:
+                print(changed_file, file=f)
+        os.environ["FAKE_P4_FILELOG"] = recording
+        os.environ["FAKE_P4_LATENCY"] = str(args.latency)
+        print(
+            f"files: {len(expected)}  revisions: {num_revisions}"
+            f"  changelists: {len(depot.changelists)}  latency: {args.latency} s"
+        )
+        p4 = [sys.executable, str(FAKE_P4)]
+        for chunk_size in args.chunk_sizes:
+            start = time.perf_counter()
+            client = Client(p4, max_concurrency=args.jobs)
+            paths = asyncio.run(list_files(client, chunk_size=chunk_size or None))
+            elapsed = time.perf_counter() - start
+            label = f"chunks of {chunk_size}" if chunk_size else "whole depot"
+            print(
+                f"{label:>18}: {elapsed:8.2f} s"
+                f"  {len(depot.changelists) / elapsed:8.0f} changelists/s"
+                f"  same files: {paths == expected}"
+            )
+
+        if args.compare:
+            # The old pipeline runs p4 by name.
+            with open(os.path.join(tmpdir, "p4"), "wt") as f:
+                f.write(f'#!/bin/sh\nexec {sys.executable} {FAKE_P4} "$@"\n')
+            os.chmod(os.path.join(tmpdir, "p4"), 0o755)
+            env = os.environ | {"PATH": f"{tmpdir}:{os.environ['PATH']}"}
+            start = time.perf_counter()
+            subprocess.run(
+                [
+                    "bash",
+                    "-e",
+                    "-o",
+                    "pipefail",
+                    "-c",
+                    OLD_LIST_FILES,
+                    "-",
+                    str(args.jobs),
+                ],
+                cwd=tmpdir,
+                env=env,
+                check=True,
+            )
+            elapsed = time.perf_counter() - start
+            paths = read_files(os.path.join(tmpdir, "files.txt"))
+            print(
+                f"{'describe per change':>18}: {elapsed:8.2f} s"
+                f"  {len(depot.changelists) / elapsed:8.0f} changelists/s"
+                f"  same files: {paths == expected}"
+            )
+
+
+class _Stages:
+    # Runs the stages one after another, either timing each or tracing
+    # the peak memory of each: not both at once, because tracemalloc
+    # slows everything down.
+    def __init__(self, trace_memory: bool) -> None:
+        self.trace_memory = trace_memory
+        self.results: dict[str, float] = {}
+
+    def run(self, name: str, function: Callable[..., T], *args: Any) -> T:
+        gc.collect()
+        if self.trace_memory:
+            tracemalloc.start()
+            result = function(*args)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.results[name] = peak
+        else:
+            start = time.perf_counter()
+            result = function(*args)
+            self.results[name] = time.perf_counter() - start
+        return result
+
+
+def _run_stages(
+    repo: str, filelogs: str, label_files: list[str], trace_memory: bool
+) -> dict[str, float]:
+    # make_merges.py and then make_tags.py, as main.sh runs them, split
+    # into their stages.
+    os.chdir(repo)
+    stages = _Stages(trace_memory)
+    path_to_changed_file = stages.run(
+        "merges: parse filelogs", get_path_to_changed_file, filelogs
+    )
+    changed_files = path_to_changed_file.values()
+    changelist_index = stages.run(
+        "merges: changelist index", get_changelist_index, changed_files
+    )
+    commit_index = stages.run("merges: commit index", get_commit_index)
+    branch_to_commits = {
+        branch: set(commits) for branch, commits in commit_index.items()
+    }
+    commit_to_deps = stages.run(
+        "merges: dependencies",
+        get_commit_to_deps,
+        changed_files,
+        changelist_index,
+        branch_to_commits,
+    )
+    grafts = stages.run("merges: grafts", get_grafts, branch_to_commits, commit_to_deps)
+
+    def replace(grafts: dict[Commit, list[Commit]]) -> None:
+        with CatFile() as cat_file:
+            replace_grafts(
+                {
+                    commit.hash: [parent.hash for parent in parents]
+                    for commit, parents in grafts.items()
+                },
+                cat_file,
+            )
+
+    stages.run("merges: replace", replace, grafts)
+    labels = stages.run(
+        "tags: parse labels", lambda: [read_label(name) for name in label_files]
+    )
+    tags = stages.run("tags: make tags", lambda: [make_git_tag(lbl) for lbl in labels])
+    hashes = stages.run("tags: write objects", write_objects, "tag", tags)
+    stages.run(
+        "tags: update refs",
+        update_refs,
+        [f"create refs/tags/{lbl.label} {tag}" for lbl, tag in zip(labels, hashes)],
+    )
+    return stages.results
+
+
+def _reset_stages(repo: str, filelogs: str) -> None:
+    # Undo what the stages did, and drop what they saved, so that the
+    # next run starts from scratch too.
+    cwd = os.getcwd()
+    os.chdir(repo)
+    refs = git(["for-each-ref", "--format=%(refname)", "refs/replace/", "refs/tags/"])
+    update_refs([f"delete {ref}" for ref in refs.split()])
+    os.chdir(cwd)
+    os.remove(f"{filelogs}.cache")
+    shutil.rmtree(os.path.join(repo, "mergetastic"))
+
+
+def bench_stages(args: argparse.Namespace) -> None:
+    # Each run of the stages is in a fresh process, as it is for real,
+    # so that nothing is already cached in memory.
+    context = multiprocessing.get_context("spawn")
+    commit = git(["-C", str(FAKE_P4.parent), "rev-parse", "--short", "HEAD"]).strip()
+    baseline: dict[tuple[int, str], dict[str, float]] = {}
+    if args.baseline is not None:
+        with open(args.baseline, "rt", encoding="utf-8") as f:
+            for result in json.load(f)["results"]:
+                baseline[(result["files"], result["stage"])] = result
+    results = []
+    print("   files  revisions  stage                      seconds  peak MiB", end="")
+    if baseline:
+        print("  baseline s  speedup", end="")
+    print()
+    for num_files in args.files:
+        depot = synthetic_depot.generate(
+            num_files=num_files,
+            num_branches=args.branches,
+            revisions_per_file=args.revisions,
+            integration_density=args.integration_density,
+        )
+        num_revisions = sum(len(cf.file_changes) for cf in depot.changed_files)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            repo = os.path.join(tmpdir, "repo.git")
+            filelogs = os.path.join(tmpdir, "filelogs.txt")
+            synthetic_depot.make_repo(depot, repo)
+            synthetic_depot.write_filelogs(depot, filelogs)
+            label_files = synthetic_depot.write_labels(
+                depot, os.path.join(tmpdir, "labels")
+            )
+            del depot
+            with concurrent.futures.ProcessPoolExecutor(1, context) as pool:
+                seconds = pool.submit(
+                    _run_stages, repo, filelogs, label_files, False
+                ).result()
+            _reset_stages(repo, filelogs)
+            with concurrent.futures.ProcessPoolExecutor(1, context) as pool:
+                peaks = pool.submit(
+                    _run_stages, repo, filelogs, label_files, True
+                ).result()
+        for stage in seconds:
+            result = {
+                "files": num_files,
+                "revisions": num_revisions,
+                "stage": stage,
+                "seconds": seconds[stage],
+                "peak_bytes": peaks[stage],
+            }
+            results.append(result)
+            print(
+                f"{num_files:8}  {num_revisions:9}  {stage:25}"
+                f"  {seconds[stage]:7.2f}  {peaks[stage] / 2**20:8.1f}",
+                end="",
+            )
+            old: Optional[dict[str, float]] = baseline.get((num_files, stage))
+            if old is not None:
+                print(
+                    f"  {old['seconds']:10.2f}"
+                    f"  {old['seconds'] / max(seconds[stage], 1e-6):7.2f}",
+                    end="",
+                )
+            print()
+    if args.save is not None:
+        with open(args.save, "wt", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "commit": commit,
+                    "branches": args.branches,
+                    "revisions_per_file": args.revisions,
+                    "integration_density": args.integration_density,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+            f.write("\n")
+
+
+def _run_make_merges(repo: str, options: list[str]) -> tuple[float, int]:
+    # The seconds, and peak RSS in KiB. A child's peak RSS starts from
+    # that of its parent, when forked, so this should run in a small
+    # process, not one holding a synthetic depot.
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, str(MAKE_MERGES)] + options, cwd=repo, env=os.environ
+    )
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise Exception(f"make_merges.py failed with status {proc.returncode}")
+    return elapsed, rusage.ru_maxrss
+
+
+def bench_store(args: argparse.Namespace) -> None:
+    # Plans the grafts with make_merges.py, holding everything in memory
+    # and then with --store, and checks the plans are the same.
+    context = multiprocessing.get_context("spawn")
+    print("   files  revisions  mode                 seconds  peak MiB  same plan")
+    for num_files in args.files:
+        depot = synthetic_depot.generate(
+            num_files=num_files,
+            num_branches=args.branches,
+            revisions_per_file=args.revisions,
+            integration_density=args.integration_density,
+        )
+        num_revisions = sum(len(cf.file_changes) for cf in depot.changed_files)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            repo = os.path.join(tmpdir, "repo.git")
+            filelogs = os.path.join(tmpdir, "filelogs.txt")
+            synthetic_depot.make_repo(depot, repo)
+            synthetic_depot.write_filelogs(depot, filelogs)
+            del depot
+            plans: list[str] = []
+            for mode, options in [
+                ("in memory", []),
+                (
+                    f"store, {args.cache_size} MiB cache",
+                    ["--store", tmpdir, "--cache-size", str(args.cache_size)],
+                ),
+            ]:
+                plan = os.path.join(tmpdir, f"plan{len(plans)}.txt")
+                with concurrent.futures.ProcessPoolExecutor(1, context) as pool:
+                    seconds, peak = pool.submit(
+                        _run_make_merges,
+                        repo,
+                        ["--filelogs", filelogs, "--plan", plan] + options,
+                    ).result()
+                with open(plan, "rt", encoding="utf-8") as f:
+                    plans.append(f.read())
+                print(
+                    f"{num_files:8}  {num_revisions:9}  {mode:19}"
+                    f"  {seconds:7.2f}  {peak / 2**10:8.1f}"
+                    f"  {plans[-1] == plans[0]}"
+                )
+            # The cached filelog is not for the next depot.
+            os.remove(f"{filelogs}.cache")
+
+
+def bench_direct(args: argparse.Namespace) -> None:
+    # Imports a synthetic depot with import_p4.py, from the fake p4, and
+    # checks each commit has the parents which make_merges.py would
+    # give it. The fake p4 prints distinct contents for every revision,
+    # except that a copy has its source's, so a copy can change nothing,
+    # in which case there is no commit for it, as with split_branches.py.
+    depot = synthetic_depot.generate(
+        num_files=args.files,
+        num_branches=args.branches,
+        revisions_per_file=args.revisions,
+        integration_density=args.integration_density,
+    )
+    num_revisions = sum(len(cf.file_changes) for cf in depot.changed_files)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filelogs = os.path.join(tmpdir, "filelogs.txt")
+        synthetic_depot.write_filelogs(depot, filelogs)
+        repo = os.path.join(tmpdir, "repo.git")
+        git(["init", "--quiet", "--bare", repo])
+        env = os.environ | {
+            "FAKE_P4_FILELOG": filelogs,
+            "FAKE_P4_LATENCY": str(args.latency),
+        }
+        start = time.perf_counter()
+        subprocess.run(
+            [
+                sys.executable,
+                str(FAKE_P4.parent.parent / "src" / "import_p4.py"),
+                "--filelogs",
+                filelogs,
+                "--p4",
+                f"{sys.executable} {FAKE_P4}",
+                "--max-concurrency",
+                str(args.jobs),
+                "--batch-size",
+                str(args.batch_size),
+            ],
+            cwd=repo,
+            env=env,
+            check=True,
+        )
+        elapsed = time.perf_counter() - start
+        os.chdir(repo)
+        commit_index = read_commit_index(
+            os.path.join(repo, "mergetastic", "commit-index")
+        )
+        hash_to_commit = {
+            commit.hash: commit
+            for commits in commit_index.values()
+            for commit in commits
+        }
+        branch_to_commits = {
+            branch: set(commits) for branch, commits in commit_index.items()
+        }
+        path_to_changed_file = {cf.path: cf for cf in depot.changed_files}
+        grafts = get_grafts(
+            branch_to_commits,
+            get_commit_to_deps(
+                path_to_changed_file.values(),
+                get_changelist_index(path_to_changed_file.values()),
+                branch_to_commits,
+            ),
+        )
+        expected = {}
+        for commits in commit_index.values():
+            previous_commits: list[Optional[Commit]] = [None, *commits]
+            for previous, commit in zip(previous_commits, commits):
+                parents = grafts.get(commit, [] if previous is None else [previous])
+                expected[commit] = {parent.hash for parent in parents}
+        actual = {}
+        for line in git(["log", "--all", "--format=%H %P"]).splitlines():
+            hash, *parent_hashes = line.split()
+            actual[hash_to_commit[GitHash(hash)]] = set(parent_hashes)
+        num_blobs = (
+            git(["cat-file", "--batch-all-objects", "--batch-check=%(objecttype)"])
+            .split()
+            .count("blob")
+        )
+        os.chdir(tmpdir)
+    num_same = sum(
+        actual.get(commit) == parents for commit, parents in expected.items()
+    )
+    print(
+        f"files: {args.files}  revisions: {num_revisions}"
+        f"  changelists: {len(depot.changelists)}  latency: {args.latency} s"
+    )
+    print(
+        f"imported in {elapsed:.2f} s: {len(actual)} commits"
+        f" ({len(depot.changelists) - len(actual)} changelists changed nothing),"
+        f" {num_blobs} blobs, {num_revisions / elapsed:.0f} revisions/s"
+    )
+    print(f"same parents as make_merges: {num_same} of {len(expected)} commits")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    branchmap = subparsers.add_parser(
+        "branchmap",
+        help="check the branchmap rules give the same branch as the old chain of"
+        " ifs, for every path in a filelog",
+    )
+    branchmap.add_argument(
+        "--filelogs",
+        metavar="FILE",
+        help="the filelog to take the paths from, rather than a synthetic one",
+    )
+    branchmap.add_argument("--files", type=int, default=2000)
+    branchmap.add_argument("--branches", type=int, default=10)
+    branchmap.add_argument("--revisions", type=int, default=10)
+    branchmap.add_argument("--integration-density", type=float, default=0.3)
+    branchmap.set_defaults(func=bench_branchmap)
+
+    deps = subparsers.add_parser(
+        "deps", help="time make_merges.get_commit_to_deps as files get longer"
+    )
+    deps.add_argument("--files", type=int, default=50)
+    deps.add_argument("--branches", type=int, default=4)
+    deps.add_argument(
+        "--revisions", type=int, nargs="+", default=[500, 1000, 2000, 4000]
+    )
+    deps.add_argument("--integration-density", type=float, default=0.3)
+    deps.set_defaults(func=bench_deps)
+
+    deps_jobs = subparsers.add_parser(
+        "deps-jobs",
+        help="time make_merges.get_commit_to_deps with more and more processes",
+    )
+    deps_jobs.add_argument("--files", type=int, default=2000)
+    deps_jobs.add_argument("--branches", type=int, default=5)
+    deps_jobs.add_argument("--revisions", type=int, default=50)
+    deps_jobs.add_argument("--integration-density", type=float, default=0.3)
+    deps_jobs.add_argument(
+        "--jobs",
+        type=int,
+        nargs="+",
+        help="the numbers of processes to try, by default from 1 to every CPU",
+    )
+    deps_jobs.set_defaults(func=bench_deps_jobs)
+
+    memory = subparsers.add_parser(
+        "memory", help="measure the memory held by a parsed filelog"
+    )
+    memory.add_argument("--files", type=int, default=1000)
+    memory.add_argument("--branches", type=int, default=5)
+    memory.add_argument("--revisions", type=int, default=40)
+    memory.add_argument("--integration-density", type=float, default=0.3)
+    memory.set_defaults(func=bench_memory)
+
+    parse = subparsers.add_parser(
+        "parse",
+        help="time parsing a filelog's revision lines, with and without the regex",
+    )
+    parse.add_argument("--files", type=int, default=2000)
+    parse.add_argument("--branches", type=int, default=5)
+    parse.add_argument("--revisions", type=int, default=100)
+    parse.add_argument("--integration-density", type=float, default=0.3)
+    parse.add_argument("--repeat", type=int, default=3)
+    parse.set_defaults(func=bench_parse)
+
+    graft = subparsers.add_parser(
+        "graft", help="time writing grafts, in a synthetic git repository"
+    )
+    graft.add_argument("--commits", type=int, default=50000)
+    graft.add_argument("--branches", type=int, default=10)
+    graft.add_argument(
+        "--compare",
+        action="store_true",
+        help="also time one git replace --graft per commit, as before",
+    )
+    graft.set_defaults(func=bench_graft)
+
+    graph = subparsers.add_parser(
+        "graph", help="time working out the grafts, from the commit graph"
+    )
+    graph.add_argument(
+        "--commits", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    graph.add_argument("--branches", type=int, default=20)
+    graph.add_argument(
+        "--merge-rate",
+        type=float,
+        default=0.1,
+        help="fraction of commits which merge from another branch",
+    )
+    graph.add_argument(
+        "--compare",
+        action="store_true",
+        help="also time networkx, as before, which must be installed",
+    )
+    graph.set_defaults(func=bench_graph)
+
+    export = subparsers.add_parser(
+        "export", help="time exporting filelogs from a fake p4"
+    )
+    export.add_argument("--files", type=int, default=2000)
+    export.add_argument("--branches", type=int, default=4)
+    export.add_argument("--revisions", type=int, default=10)
+    export.add_argument("--integration-density", type=float, default=0.3)
+    export.add_argument("--jobs", type=int, default=8)
+    export.add_argument("--batch-size", type=int, default=100)
+    export.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="seconds added to every p4 command, as for a round trip",
+    )
+    export.add_argument(
+        "--compare",
+        action="store_true",
+        help="also time one p4 filelog per file, as before",
+    )
+    export.set_defaults(func=bench_export)
+
+    files = subparsers.add_parser(
+        "files", help="time listing the depot's files from a fake p4"
+    )
+    files.add_argument("--files", type=int, default=500)
+    files.add_argument("--branches", type=int, default=4)
+    files.add_argument("--revisions", type=int, default=10)
+    files.add_argument("--integration-density", type=float, default=0.3)
+    files.add_argument("--jobs", type=int, default=4)
+    files.add_argument(
+        "--chunk-sizes",
+        type=int,
+        nargs="+",
+        default=[0, 100],
+        help="changelists per p4 files command, or 0 for the whole depot",
+    )
+    files.add_argument("--latency", type=float, default=0.05)
+    files.add_argument(
+        "--compare",
+        action="store_true",
+        help="also time a p4 describe per changelist, as before",
+    )
+    files.set_defaults(func=bench_files)
+
+    stages = subparsers.add_parser(
+        "stages",
+        help="time and measure the memory of each stage of make_merges.py and"
+        " make_tags.py, at several scales",
+    )
+    stages.add_argument("--files", type=int, nargs="+", default=[500, 2000, 8000])
+    stages.add_argument("--branches", type=int, default=5)
+    stages.add_argument("--revisions", type=int, default=10)
+    stages.add_argument("--integration-density", type=float, default=0.3)
+    stages.add_argument(
+        "--save", metavar="FILE", help="save the results to FILE, as JSON"
+    )
+    stages.add_argument(
+        "--baseline",
+        metavar="FILE",
+        help="compare with the results saved to FILE by an earlier run",
+    )
+    stages.set_defaults(func=bench_stages)
+
+    store = subparsers.add_parser(
+        "store",
+        help="compare the time and memory of make_merges.py with --store, and"
+        " without, and check they plan the same grafts",
+    )
+    store.add_argument("--files", type=int, nargs="+", default=[500, 2000, 8000])
+    store.add_argument("--branches", type=int, default=5)
+    store.add_argument("--revisions", type=int, default=10)
+    store.add_argument("--integration-density", type=float, default=0.3)
+    store.add_argument("--cache-size", type=int, default=16)
+    store.set_defaults(func=bench_store)
+
+    direct = subparsers.add_parser(
+        "direct",
+        help="time importing a depot straight from a fake p4, with import_p4.py,"
+        " and check its merges",
+    )
+    direct.add_argument("--files", type=int, default=500)
+    direct.add_argument("--branches", type=int, default=5)
+    direct.add_argument("--revisions", type=int, default=10)
+    direct.add_argument("--integration-density", type=float, default=0.3)
+    direct.add_argument("--jobs", type=int, default=8)
+    direct.add_argument("--batch-size", type=int, default=100)
+    direct.add_argument("--latency", type=float, default=0.0)
+    direct.set_defaults(func=bench_direct)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
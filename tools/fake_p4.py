@@ -0,0 +1,620 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A stand-in for p4, for testing and benchmarking the export stages
+# without a Perforce server. It replays a recorded filelog, in the text
+# format of p4 filelog, named by the FAKE_P4_FILELOG environment
+# variable, and the labels in the directory FAKE_P4_LABELS.
+# FAKE_P4_LATENCY, in seconds, is added to every command, to stand in
+# for the round trip to a server, and FAKE_P4_FAILURE_RATE is the chance
+# of any command failing as if the connection dropped.
+#
+# Only the commands, and options, which the conversion uses are here,
+# and the depot is whatever the filelog covers. The server is in UTC.
+
+import calendar
+import datetime
+import hashlib
+import io
+import itertools
+import marshal
+import os
+import random
+import sys
+import time
+from collections.abc import Iterator
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+from typing import Optional, final
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import more_itertools  # noqa: E402
+
+from p4.filelog import ChangedFile, FileChange  # noqa: E402
+
+Record = dict[bytes, bytes]
+
+
+def _read_filelog(paths: set[PurePosixPath]) -> dict[PurePosixPath, ChangedFile]:
+    # Only the files asked for are parsed, which keeps each command
+    # quick, however big the recording.
+    path_to_changed_file = {}
+    with open(os.environ["FAKE_P4_FILELOG"], "rt", errors="replace") as f:
+        block: list[str] = []
+        for line in itertools.chain(f, ["//"]):
+            if line.startswith("//"):
+                if block and PurePosixPath(block[0].rstrip()) in paths:
+                    changed_file = more_itertools.one(
+                        ChangedFile.parse(io.StringIO("".join(block)))
+                    )
+                    path_to_changed_file[changed_file.path] = changed_file
+                block = []
+            block.append(line)
+    return path_to_changed_file
+
+
+@final
+@dataclass(frozen=True)
+class _Revision:
+    path: str
+    version: int
+    changelist: int
+    action: str
+    chmod: str
+    author: str
+    when: str
+    description: str
+
+
+def _iter_revisions() -> Iterator[_Revision]:
+    # Every revision in the recording, without the cost of a full parse.
+    with open(os.environ["FAKE_P4_FILELOG"], "rt", errors="replace") as f:
+        path = ""
+        for line in f:
+            if line.startswith("//"):
+                path = line.rstrip()
+            elif line.startswith("... #"):
+                # ... #<version> change <changelist> <action> on <day>
+                # by <author> (<chmod>) '<description>'
+                (
+                    _,
+                    version,
+                    _,
+                    changelist,
+                    action,
+                    _,
+                    when,
+                    _,
+                    author,
+                    rest,
+                ) = line.split(" ", 9)
+                chmod = rest[len("(") : rest.index(")")]
+                description = rest[rest.index(") '") + len(") '") : rest.rindex("'")]
+                yield _Revision(
+                    path,
+                    int(version[len("#") :]),
+                    int(changelist),
+                    action,
+                    chmod,
+                    author,
+                    when,
+                    description,
+                )
+
+
+def _parse_file_spec(file_spec: str) -> tuple[str, int, int]:
+    # A path, optionally ending with /..., and an optional changelist
+    # range, as in //depot/...@1,@100 or //depot/...@101,@now.
+    path, _, revision_range = file_spec.partition("@")
+    first, last = 1, sys.maxsize
+    if revision_range:
+        first_spec, _, last_spec = revision_range.partition(",")
+        first = int(first_spec)
+        last_spec = last_spec.removeprefix("@")
+        if last_spec == "now":
+            last = sys.maxsize
+        else:
+            last = int(last_spec) if last_spec else first
+    return path.removesuffix("..."), first, last
+
+
+def _error(message: str, *, severity: int = 3) -> Record:
+    # Severity 2 is a warning, such as that there are no such files.
+    return {
+        b"code": b"error",
+        b"data": f"{message}\n".encode("utf-8"),
+        b"severity": str(severity).encode("utf-8"),
+        b"generic": b"17",
+    }
+
+
+def _to_tagged(changed_file: ChangedFile) -> Record:
+    # The inverse of ChangedFile.from_tagged.
+    record = {"code": "stat", "depotFile": str(changed_file.path)}
+    for i, file_change in enumerate(changed_file.file_changes):
+        user, _, client = file_change.author.partition("@")
+        record |= {
+            f"rev{i}": str(file_change.version),
+            f"change{i}": str(file_change.changelist),
+            f"action{i}": file_change.action,
+            f"type{i}": file_change.chmod,
+            f"time{i}": str(calendar.timegm(file_change.when.timetuple())),
+            f"user{i}": user,
+            f"client{i}": client,
+            f"desc{i}": file_change.description,
+        }
+        for j, sub_change in enumerate(file_change.sub_changes):
+            start = min(sub_change.path_revs)
+            record |= {
+                f"how{i},{j}": sub_change.action,
+                f"file{i},{j}": str(sub_change.path),
+                f"srev{i},{j}": "#none" if start == 1 else f"#{start - 1}",
+                f"erev{i},{j}": f"#{max(sub_change.path_revs)}",
+            }
+    return {key.encode("utf-8"): value.encode("utf-8") for key, value in record.items()}
+
+
+def _from_tagged(record: Record) -> ChangedFile:
+    return ChangedFile.from_tagged(record, datetime.timezone.utc)
+
+
+def _info(args: list[str]) -> list[Record]:
+    server_date = time.strftime("%Y/%m/%d %H:%M:%S +0000 UTC", time.gmtime())
+    return [{b"code": b"stat", b"serverDate": server_date.encode("utf-8")}]
+
+
+def _filelog(args: list[str]) -> list[Record]:
+    path_to_changed_file = _read_filelog({PurePosixPath(path) for path in args})
+    records = []
+    for path in args:
+        changed_file = path_to_changed_file.get(PurePosixPath(path))
+        if changed_file is None:
+            records.append(_error(f"{path} - no such file(s)."))
+        else:
+            records.append(_to_tagged(changed_file))
+    return records
+
+
+def _changes(args: list[str]) -> list[Record]:
+    # Only p4 changes [-l] -s submitted of a directory and changelist
+    # range, newest first. The descriptions are those of the filelog.
+    prefix, first, last = _parse_file_spec(args[-1])
+    changelist_to_revision = {
+        revision.changelist: revision
+        for revision in _iter_revisions()
+        if revision.path.startswith(prefix) and first <= revision.changelist <= last
+    }
+    records = []
+    for changelist, revision in sorted(changelist_to_revision.items(), reverse=True):
+        record = {
+            b"code": b"stat",
+            b"change": str(changelist).encode("utf-8"),
+            b"status": b"submitted",
+            b"time": str(
+                calendar.timegm(time.strptime(revision.when, "%Y/%m/%d"))
+            ).encode("utf-8"),
+            b"user": revision.author.partition("@")[0].encode("utf-8"),
+            b"client": revision.author.partition("@")[2].encode("utf-8"),
+        }
+        if "-l" in args:
+            record[b"desc"] = f"{revision.description}\n".encode("utf-8")
+        records.append(record)
+    return records
+
+
+def _get_contents(
+    revisions: list[tuple[PurePosixPath, int]]
+) -> dict[tuple[PurePosixPath, int], Optional[tuple[FileChange, bytes]]]:
+    # The recording has no contents, so they are made up: each revision
+    # has its own, except that a branch or copy has the contents of its
+    # source, as it would in p4. None for a revision which does not
+    # exist, or is deleted.
+    path_to_changed_file: dict[PurePosixPath, ChangedFile] = {}
+    wanted = {path for path, _ in revisions}
+    while wanted:
+        path_to_changed_file |= _read_filelog(wanted)
+        sources = {
+            sub_change.path
+            for changed_file in path_to_changed_file.values()
+            for file_change in changed_file.file_changes
+            for sub_change in file_change.sub_changes
+            if sub_change.action in ("branch from", "copy from")
+        }
+        wanted = sources - wanted - path_to_changed_file.keys()
+
+    def get_file_change(path: PurePosixPath, version: int) -> Optional[FileChange]:
+        changed_file = path_to_changed_file.get(path)
+        if changed_file is None:
+            return None
+        return next(
+            (fc for fc in changed_file.file_changes if fc.version == version), None
+        )
+
+    def get_contents(path: PurePosixPath, version: int) -> bytes:
+        file_change = get_file_change(path, version)
+        assert file_change is not None
+        for sub_change in file_change.sub_changes:
+            if file_change.action not in ("branch", "copy"):
+                break
+            if sub_change.action == f"{file_change.action} from":
+                source_version = max(sub_change.path_revs)
+                if get_file_change(sub_change.path, source_version) is not None:
+                    return get_contents(sub_change.path, source_version)
+        return f"{path}#{version}\n".encode("utf-8")
+
+    contents: dict[tuple[PurePosixPath, int], Optional[tuple[FileChange, bytes]]] = {}
+    for path, version in revisions:
+        file_change = get_file_change(path, version)
+        if file_change is None or "delete" in file_change.action:
+            contents[(path, version)] = None
+        else:
+            contents[(path, version)] = (file_change, get_contents(path, version))
+    return contents
+
+
+def _print(args: list[str]) -> list[Record]:
+    # Only p4 print of path#version.
+    specs = [(path, version) for path, _, version in (a.partition("#") for a in args)]
+    contents = _get_contents([(PurePosixPath(path), int(v)) for path, v in specs])
+    records = []
+    for path, version in specs:
+        found = contents[(PurePosixPath(path), int(version))]
+        if found is None:
+            records.append(_error(f"{path}#{version} - no file(s) at that revision."))
+            continue
+        file_change, data = found
+        records.append(
+            {
+                b"code": b"stat",
+                b"depotFile": path.encode("utf-8"),
+                b"rev": version.encode("utf-8"),
+                b"change": str(file_change.changelist).encode("utf-8"),
+                b"action": file_change.action.encode("utf-8"),
+                b"type": file_change.chmod.encode("utf-8"),
+                b"fileSize": str(len(data)).encode("utf-8"),
+            }
+        )
+        records.append({b"code": b"text", b"data": data})
+    return records
+
+
+def _fstat(args: list[str]) -> list[Record]:
+    # Only p4 fstat -Ol of a directory, as of a changelist or a label:
+    # the head revision of each file then, with the MD5 digest and size
+    # of its contents, as made up for p4 print. Deleted files have no
+    # digest or size.
+    if args[0] != "-Ol":
+        raise Exception("only p4 fstat -Ol is supported")
+    path_spec, _, revision_spec = args[1].partition("@")
+    prefix = path_spec.removesuffix("...")
+    if revision_spec.isdigit():
+        path_to_revision: dict[str, _Revision] = {}
+        for revision in _iter_revisions():
+            if revision.path.startswith(prefix) and revision.changelist <= int(
+                revision_spec
+            ):
+                latest = path_to_revision.get(revision.path)
+                if latest is None or latest.version < revision.version:
+                    path_to_revision[revision.path] = revision
+        revisions = [revision for _, revision in sorted(path_to_revision.items())]
+    else:
+        revisions = [
+            revision
+            for revision in _label_revisions(revision_spec)
+            if revision.path.startswith(prefix)
+        ]
+    contents = _get_contents(
+        [(PurePosixPath(revision.path), revision.version) for revision in revisions]
+    )
+    records = []
+    for revision in revisions:
+        record = {
+            b"code": b"stat",
+            b"depotFile": revision.path.encode("utf-8"),
+            b"headAction": revision.action.encode("utf-8"),
+            b"headType": revision.chmod.encode("utf-8"),
+            b"headRev": str(revision.version).encode("utf-8"),
+            b"headChange": str(revision.changelist).encode("utf-8"),
+        }
+        found = contents[(PurePosixPath(revision.path), revision.version)]
+        if found is not None:
+            data = found[1]
+            record[b"fileSize"] = str(len(data)).encode("utf-8")
+            record[b"digest"] = hashlib.md5(data).hexdigest().upper().encode("utf-8")
+        records.append(record)
+    return records or [_error(f"{args[1]} - no such file(s).", severity=2)]
+
+
+def _label_spec_fields(text: str) -> dict[str, list[str]]:
+    # The fields of a spec, in the text form of p4 label -o. Each field
+    # is either on one line after its name, or on the following lines,
+    # after tabs.
+    fields: dict[str, list[str]] = {}
+    name = None
+    for line in text.splitlines():
+        if line.startswith("#"):
+            continue
+        if line.startswith("\t") and name is not None:
+            fields[name].append(line[len("\t") :])
+        elif ":" in line:
+            name, _, value = line.partition(":")
+            fields[name] = [value.strip()] if value.strip() else []
+    return fields
+
+
+def _read_labels() -> dict[str, str]:
+    # The label specs named by FAKE_P4_LABELS: a directory of specs, in
+    # the text form of p4 label -o. Their Revision field, of the form
+    # @<changelist>, says which revisions the label holds.
+    directory = os.environ.get("FAKE_P4_LABELS")
+    if directory is None:
+        return {}
+    name_to_spec = {}
+    for filename in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, filename), "rt") as f:
+            spec = f.read()
+        [name] = _label_spec_fields(spec)["Label"]
+        name_to_spec[name] = spec
+    return name_to_spec
+
+
+def _label_revisions(name: str) -> list[_Revision]:
+    # The newest revision, as of the label's changelist, of each file in
+    # its view. Files deleted by then are not in the label.
+    fields = _label_spec_fields(_read_labels()[name])
+    [revision_spec] = fields["Revision"]
+    changelist = int(revision_spec.removeprefix("@"))
+    prefixes = tuple(view.removesuffix("...") for view in fields["View"])
+    path_to_revision: dict[str, _Revision] = {}
+    for revision in _iter_revisions():
+        if revision.path.startswith(prefixes) and revision.changelist <= changelist:
+            latest = path_to_revision.get(revision.path)
+            if latest is None or latest.version < revision.version:
+                path_to_revision[revision.path] = revision
+    return [
+        revision
+        for _, revision in sorted(path_to_revision.items())
+        if "delete" not in revision.action
+    ]
+
+
+def _files(args: list[str]) -> list[Record]:
+    # Only p4 files -a of a directory and changelist range, or p4 files
+    # of a label.
+    if args[-1].startswith("@"):
+        revisions = _label_revisions(args[-1].removeprefix("@"))
+    elif args[0] == "-a":
+        prefix, first, last = _parse_file_spec(args[1])
+        revisions = [
+            revision
+            for revision in _iter_revisions()
+            if revision.path.startswith(prefix) and first <= revision.changelist <= last
+        ]
+    else:
+        raise Exception(f"unsupported p4 files {' '.join(args)}")
+    records = [
+        {
+            b"code": b"stat",
+            b"depotFile": revision.path.encode("utf-8"),
+            b"rev": str(revision.version).encode("utf-8"),
+            b"change": str(revision.changelist).encode("utf-8"),
+            b"action": revision.action.encode("utf-8"),
+            b"type": revision.chmod.encode("utf-8"),
+        }
+        for revision in revisions
+    ]
+    return records or [_error(f"{args[-1]} - no such file(s).")]
+
+
+def _labels(args: list[str]) -> list[Record]:
+    records = []
+    for name, spec in _read_labels().items():
+        fields = _label_spec_fields(spec)
+        records.append(
+            {
+                b"code": b"stat",
+                b"label": name.encode("utf-8"),
+                b"Update": fields["Update"][0].encode("utf-8"),
+                b"Owner": fields["Owner"][0].encode("utf-8"),
+                b"Description": "".join(
+                    f"{line}\n" for line in fields["Description"]
+                ).encode("utf-8"),
+            }
+        )
+    return records
+
+
+def _label(args: list[str]) -> list[Record]:
+    # Only p4 label -o.
+    if args[0] != "-o":
+        raise Exception("only p4 label -o is supported")
+    spec = _read_labels().get(args[1])
+    if spec is None:
+        return [_error(f"Label '{args[1]}' doesn't exist.")]
+    record = {"code": "stat"}
+    for name, lines in _label_spec_fields(spec).items():
+        if name == "Description":
+            record[name] = "".join(f"{line}\n" for line in lines)
+        elif name == "View":
+            record |= {f"View{i}": line for i, line in enumerate(lines)}
+        else:
+            record[name] = "\n".join(lines)
+    return [
+        {key.encode("utf-8"): value.encode("utf-8") for key, value in record.items()}
+    ]
+
+
+def _describe(args: list[str]) -> list[Record]:
+    # Only p4 describe -s, of one changelist.
+    if args[0] != "-s":
+        raise Exception("only p4 describe -s is supported")
+    changelist = int(args[1])
+    revisions = [
+        revision for revision in _iter_revisions() if revision.changelist == changelist
+    ]
+    if not revisions:
+        return [_error(f"Change {changelist} unknown.")]
+    record = {
+        "code": "stat",
+        "change": str(changelist),
+        "user": revisions[0].author.partition("@")[0],
+        "client": revisions[0].author.partition("@")[2],
+        "time": str(calendar.timegm(time.strptime(revisions[0].when, "%Y/%m/%d"))),
+        "desc": f"Change {changelist}\n",
+    }
+    for i, revision in enumerate(sorted(revisions, key=lambda r: r.path)):
+        record |= {
+            f"depotFile{i}": revision.path,
+            f"rev{i}": str(revision.version),
+            f"action{i}": revision.action,
+            f"type{i}": revision.chmod,
+        }
+    return [
+        {key.encode("utf-8"): value.encode("utf-8") for key, value in record.items()}
+    ]
+
+
+def _print_text(command: str, records: list[Record]) -> None:
+    for record in records:
+        if record[b"code"] == b"error":
+            sys.stderr.write(record[b"data"].decode("utf-8"))
+        elif command == "filelog":
+            print(_from_tagged(record))
+        elif command == "describe":
+            _print_describe(record)
+        elif command == "files":
+            fields = {
+                key.decode("utf-8"): value.decode("utf-8")
+                for key, value in record.items()
+            }
+            print(
+                f"{fields['depotFile']}#{fields['rev']} - {fields['action']}"
+                f" change {fields['change']} ({fields['type']})"
+            )
+        elif command == "labels":
+            name = record[b"label"].decode("utf-8")
+            spec_fields = _label_spec_fields(_read_labels()[name])
+            day = spec_fields["Update"][0].split()[0]
+            description = " ".join(spec_fields["Description"])
+            print(f"Label {name} {day} '{description} '")
+        elif command == "label":
+            name = record[b"Label"].decode("utf-8")
+            sys.stdout.write(_read_labels()[name])
+        elif command == "changes":
+            fields = {
+                key.decode("utf-8"): value.decode("utf-8")
+                for key, value in record.items()
+            }
+            when = time.strftime("%Y/%m/%d", time.gmtime(int(fields["time"])))
+            print(
+                f"Change {fields['change']} on {when}"
+                f" by {fields['user']}@{fields['client']} 'Change {fields['change']}'"
+            )
+        elif command == "print" and record[b"code"] == b"stat":
+            fields = {
+                key.decode("utf-8"): value.decode("utf-8")
+                for key, value in record.items()
+            }
+            print(
+                f"{fields['depotFile']}#{fields['rev']} - {fields['action']}"
+                f" change {fields['change']} ({fields['type']})"
+            )
+        elif command == "print":
+            sys.stdout.flush()
+            sys.stdout.buffer.write(record[b"data"])
+        else:
+            raise Exception(f"no text output for p4 {command}")
+
+
+def _print_describe(record: Record) -> None:
+    fields = {
+        key.decode("utf-8"): value.decode("utf-8") for key, value in record.items()
+    }
+    when = time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(int(fields["time"])))
+    print(f"Change {fields['change']} by {fields['user']}@{fields['client']} on {when}")
+    print()
+    for line in fields["desc"].splitlines():
+        print(f"\t{line}")
+    print()
+    print("Affected files ...")
+    print()
+    i = 0
+    while f"depotFile{i}" in fields:
+        print(
+            f"... {fields[f'depotFile{i}']}#{fields[f'rev{i}']} {fields[f'action{i}']}"
+        )
+        i += 1
+    print()
+
+
+COMMANDS = {
+    "info": _info,
+    "filelog": _filelog,
+    "changes": _changes,
+    "files": _files,
+    "describe": _describe,
+    "print": _print,
+    "fstat": _fstat,
+    "labels": _labels,
+    "label": _label,
+}
+
+
+def main(args: list[str]) -> int:
+    tagged = False
+    arg_file = None
+    while args and args[0].startswith("-"):
+        option = args.pop(0)
+        match option:
+            case "-G":
+                tagged = True
+            case "-x":
+                arg_file = args.pop(0)
+            case "-b":
+                # Batches only change how often the command runs.
+                args.pop(0)
+            case _:
+                raise Exception(f"unsupported p4 option: {option}")
+    command, *command_args = args
+    if arg_file is not None:
+        with open(
+            sys.stdin.fileno() if arg_file == "-" else arg_file, "rt", closefd=False
+        ) as f:
+            command_args += [line.rstrip("\n") for line in f if line.strip()]
+    time.sleep(float(os.environ.get("FAKE_P4_LATENCY", "0")))
+    if random.random() < float(os.environ.get("FAKE_P4_FAILURE_RATE", "0")):
+        message = "Connect to server failed; check $P4PORT.\nTCP receive failed."
+        if tagged:
+            marshal.dump(_error(message), sys.stdout.buffer, 0)
+        else:
+            print(message, file=sys.stderr)
+        return 1
+    records = COMMANDS[command](command_args)
+    if tagged:
+        for record in records:
+            marshal.dump(record, sys.stdout.buffer, 0)
+    else:
+        _print_text(command, records)
+        # Like p4, only the text output has a failing exit status.
+        if any(record[b"code"] == b"error" for record in records):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
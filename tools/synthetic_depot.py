@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+
+# Copyright © 2023 Iain Nicol
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Generates a made up depot, in the same shape as the Open Watcom one,
+# for benchmarking. Paths are chosen so that branchmap recognises them.
+
+import argparse
+import datetime
+import os
+import random
+import subprocess
+import sys
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from git import Branch  # noqa: E402
+from p4.filelog import (  # noqa: E402
+    ChangedFile,
+    ChangeList,
+    FileChange,
+    FileVersion,
+    SubChange,
+)
+
+# The first branch is the trunk, which every other branch is branched
+# from.
+BRANCH_ROOTS: dict[Branch, str] = {
+    Branch("openwatcom"): "//depot/openwatcom/",
+    Branch("dwarf3"): "//depot/ow_devel/dwarf3/",
+    Branch("long_double"): "//depot/ow_devel/long_double/",
+    Branch("plusplus.dev"): "//depot/ow_devel/plusplus.dev/",
+    Branch("plusplus.ext"): "//depot/ow_devel/plusplus.ext/",
+    Branch("RDOS"): "//depot/ow_devel/rdos/",
+    Branch("V2"): "//depot/V2/",
+    Branch("openwatcom_1.0"): "//depot/ow_release/1.0/",
+    Branch("CVDebug_dev"): "//depot/ow_devel/CVDebug_dev5/",
+    Branch("openwatcom_bld_devel"): "//depot/ow_devel/intel_owl/",
+}
+
+# As p4 filelog shows them, as user@client.
+AUTHORS = [
+    f"{user}@{user.lower()}_ws"
+    for user in ["AlexanderK", "BartO", "KendallB", "MichalN", "PeterC"]
+]
+
+
+@dataclass
+class SyntheticDepot:
+    changed_files: list[ChangedFile]
+    # Every changelist, in order, with the one branch it changed.
+    changelists: list[tuple[ChangeList, Branch]]
+
+
+def generate(
+    *,
+    num_files: int,
+    num_branches: int,
+    revisions_per_file: int,
+    integration_density: float,
+    seed: int = 0,
+) -> SyntheticDepot:
+    if not 1 <= num_branches <= len(BRANCH_ROOTS):
+        raise ValueError(f"num_branches must be between 1 and {len(BRANCH_ROOTS)}")
+    rng = random.Random(seed)
+    branches = list(BRANCH_ROOTS)[:num_branches]
+    rel_paths = [
+        f"bld/dir{i % 97}/file{i}.{rng.choice(['c', 'h', 'mif'])}"
+        for i in range(num_files)
+    ]
+    history: dict[tuple[Branch, int], list[FileChange]] = {}
+    changelists: list[tuple[ChangeList, Branch]] = []
+    when = datetime.datetime(1999, 1, 1)
+
+    def path_of(branch: Branch, file_index: int) -> PurePosixPath:
+        return PurePosixPath(BRANCH_ROOTS[branch] + rel_paths[file_index])
+
+    def new_changelist(branch: Branch) -> ChangeList:
+        nonlocal when
+        changelist = ChangeList(len(changelists) + 1)
+        changelists.append((changelist, branch))
+        when += datetime.timedelta(minutes=rng.randrange(1, 240))
+        return changelist
+
+    def add_revision(
+        branch: Branch, file_index: int, changelist: ChangeList, action: str
+    ) -> FileChange:
+        revisions = history.setdefault((branch, file_index), [])
+        file_change = FileChange(
+            FileVersion(len(revisions) + 1),
+            changelist,
+            action,
+            # p4 filelog only shows the day.
+            datetime.datetime.combine(when.date(), datetime.time()),
+            rng.choice(AUTHORS),
+            "text",
+            f"Change {changelist} on {branch}",
+            [],
+        )
+        revisions.append(file_change)
+        return file_change
+
+    def integrate(
+        source: Branch,
+        target: Branch,
+        file_index: int,
+        changelist: ChangeList,
+        action: str,
+    ) -> None:
+        source_revisions = history[(source, file_index)]
+        source_change = source_revisions[-1]
+        file_change = add_revision(target, file_index, changelist, action)
+        # Integrations name a range of source revisions, and we are
+        # interested in the last one.
+        first_version = FileVersion(max(1, source_change.version - 2))
+        path_revs = frozenset({first_version, source_change.version})
+        file_change.sub_changes.append(
+            SubChange(f"{action} from", path_of(source, file_index), path_revs)
+        )
+        source_change.sub_changes.append(
+            SubChange(
+                f"{action} into",
+                path_of(target, file_index),
+                frozenset({file_change.version}),
+            )
+        )
+
+    # Everything starts life in the trunk, and is then branched.
+    trunk = branches[0]
+    changelist = new_changelist(trunk)
+    for file_index in range(num_files):
+        add_revision(trunk, file_index, changelist, "add")
+    for branch in branches[1:]:
+        changelist = new_changelist(branch)
+        for file_index in range(num_files):
+            integrate(trunk, branch, file_index, changelist, "branch")
+
+    files_per_change = max(1, min(8, num_files))
+    target_revisions = num_files * num_branches * revisions_per_file
+    num_revisions = num_files * num_branches
+    while num_revisions < target_revisions:
+        branch = rng.choice(branches)
+        file_indices = rng.sample(range(num_files), files_per_change)
+        changelist = new_changelist(branch)
+        if len(branches) > 1 and rng.random() < integration_density:
+            source = rng.choice([b for b in branches if b != branch])
+            action = rng.choice(["merge", "copy"])
+            for file_index in file_indices:
+                integrate(source, branch, file_index, changelist, action)
+        else:
+            for file_index in file_indices:
+                add_revision(branch, file_index, changelist, "edit")
+        num_revisions += len(file_indices)
+
+    changed_files = [
+        ChangedFile(path_of(branch, file_index), list(reversed(revisions)))
+        for (branch, file_index), revisions in sorted(history.items())
+    ]
+    return SyntheticDepot(changed_files, changelists)
+
+
+def write_filelogs(depot: SyntheticDepot, filename: str) -> None:
+    with open(filename, "wt", encoding="utf-8") as f:
+        for changed_file in depot.changed_files:
+            print(changed_file, file=f)
+
+
+def write_labels(depot: SyntheticDepot, directory: str, *, every: int = 7) -> list[str]:
+    # A label on every so many changelists, as export_labels.py writes
+    # them. Returns the label files.
+    os.makedirs(directory, exist_ok=True)
+    filenames = []
+    for i, (changelist, branch) in enumerate(depot.changelists[::every]):
+        filename = os.path.join(directory, f"label{i}.txt")
+        with open(filename, "wt", encoding="utf-8") as f:
+            f.write(
+                f"Label:\tlabel{i}\n\n"
+                f"Update:\t2003/01/24 22:40:{i % 60:02}\n\n"
+                "Owner:\tKendallB\n\n"
+                f"Description:\n\tLabel {i}, of {branch}.\n\n"
+                f"View:\n\t{BRANCH_ROOTS[branch]}...\n\n"
+                f"Changelist:\t{changelist}\n"
+            )
+        filenames.append(filename)
+    return filenames
+
+
+def make_repo(depot: SyntheticDepot, directory: str) -> None:
+    # A bare repository as split_branches.py leaves it: a branch for
+    # each p4 branch, with a commit for each changelist, the changelist
+    # in a P4:<n> line of its message. The branches do not share any
+    # history until make_merges grafts them together.
+    changes: dict[ChangeList, list[str]] = {}
+    authors: dict[ChangeList, str] = {}
+    dates: dict[ChangeList, datetime.datetime] = {}
+    roots = {root: branch for branch, root in BRANCH_ROOTS.items()}
+    for changed_file in depot.changed_files:
+        path = str(changed_file.path)
+        root = next(root for root in roots if path.startswith(root))
+        for file_change in changed_file.file_changes:
+            changes.setdefault(file_change.changelist, []).append(
+                path.removeprefix(root)
+            )
+            authors[file_change.changelist] = file_change.author.partition("@")[0]
+            dates[file_change.changelist] = file_change.when
+    subprocess.run(["git", "init", "--quiet", "--bare", directory], check=True)
+    fast_import = subprocess.Popen(
+        ["git", "-C", directory, "fast-import", "--quiet"], stdin=subprocess.PIPE
+    )
+    assert fast_import.stdin is not None
+    for mark, (changelist, branch) in enumerate(depot.changelists, start=1):
+        author = authors[changelist]
+        when = int(dates[changelist].timestamp())
+        message = f"Change {changelist} on {branch}\n\nP4:{changelist}\n"
+        content = f"{changelist}\n"
+        stream = [
+            f"commit refs/heads/{branch}\n",
+            f"mark :{mark}\n",
+            f"committer {author} <{author}@p4-server> {when} +0000\n",
+            f"data {len(message)}\n{message}",
+        ]
+        for path in changes[changelist]:
+            stream.append(f"M 644 inline {path}\ndata {len(content)}\n{content}")
+        stream.append("\n")
+        fast_import.stdin.write("".join(stream).encode("utf-8"))
+    fast_import.stdin.close()
+    if fast_import.wait() != 0:
+        raise Exception(f"git fast-import failed with status {fast_import.returncode}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic filelogs.txt to standard output."
+    )
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--branches", type=int, default=4)
+    parser.add_argument("--revisions", type=int, default=20)
+    parser.add_argument("--integration-density", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--repo",
+        metavar="DIR",
+        help="also make a matching git repository, with a branch per p4 branch",
+    )
+    parser.add_argument(
+        "--labels",
+        metavar="DIR",
+        help="also write label files, for make_tags.py, to DIR",
+    )
+    args = parser.parse_args()
+    depot = generate(
+        num_files=args.files,
+        num_branches=args.branches,
+        revisions_per_file=args.revisions,
+        integration_density=args.integration_density,
+        seed=args.seed,
+    )
+    if args.repo is not None:
+        make_repo(depot, args.repo)
+    if args.labels is not None:
+        write_labels(depot, args.labels)
+    for changed_file in depot.changed_files:
+        print(changed_file)
+
+
+if __name__ == "__main__":
+    main()